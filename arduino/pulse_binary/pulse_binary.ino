@@ -0,0 +1,384 @@
+// Binary protocol version of pulse_stepper, driven by pycnic/arduino.py
+//
+// Frames: SYNC (0xA5) | LEN | CMD | PAYLOAD (LEN-1 bytes) | CRC8
+// LEN counts CMD and PAYLOAD, CRC8 (poly 0x07) covers LEN, CMD and PAYLOAD.
+// Integers are little endian. Each frame is answered with CMD | 0x80 or ERROR.
+//
+// Moves and segments are converted to step blocks and stored in a ring
+// buffer, then acknowledged immediately. A Timer1 interrupt running at
+// TICK_HZ consumes the blocks: the step rate follows a constant acceleration
+// ramp and the axis are coordinated with Bresenham, so frames keep being
+// received while moving.
+
+#define BAUDRATE 250000
+#define RING_SIZE 16 // must be a power of 2, one slot is kept empty
+                     // (QUEUE_SIZE in arduino.py)
+#define TICK_HZ 30000L // frequency of the step interrupt = max step rate
+
+// set arduino pins
+#define X_PULSE 4
+#define X_DIRECTION 8
+#define X_ENABLE 6
+#define X_SWITCH 5
+#define Y_PULSE 2
+#define Y_DIRECTION 9
+#define Z_PULSE 3
+#define Z_DIRECTION 10
+#define PULSE_PORT PORTD
+#define DIRECTION_PORT PORTB
+
+const byte pulse_bits[3] = {(1<<4), (1<<2), (1<<3)};
+const byte direction_bits[3] = {(1<<0), (1<<1), (1<<2)}; // pins 8, 9, 10
+
+// protocol
+#define SYNC 0xA5
+#define CMD_IDENT 0x01
+#define CMD_VERSION 0x02
+#define CMD_SPEED 0x10
+#define CMD_SET_POS 0x11
+#define CMD_RESET 0x12
+#define CMD_MOVE 0x20
+#define CMD_SEGMENT 0x21
+#define CMD_POS 0x30
+#define CMD_STATUS 0x31
+#define CMD_ERROR 0xFF
+#define REPLY 0x80
+
+#define ERR_CRC 1
+#define ERR_UNKNOWN 2
+#define ERR_FULL 3
+#define ERR_LENGTH 4
+
+#define MOVE_RAMP 0x01
+#define MOVE_SIZE 17 // flags + 4 longs
+#define SEGMENT_SIZE 37 // flags + 9 longs
+#define MAX_PAYLOAD 40
+
+#define VERSION_MAJOR 1
+#define VERSION_MINOR 1
+
+// A block is a move ready for the step interrupt. Rates are in steps/s of
+// the axis doing the most steps, multiplied by 256.
+struct Block {
+  byte direction_bits;
+  long steps[3];
+  long total; // steps of the longest axis
+  long entry;
+  long cruise;
+  long exit;
+  long accel; // rate increment per tick
+  long accel_until; // step where the acceleration stops
+  long decel_after; // step where the deceleration starts
+};
+
+// ring buffer of blocks: head is the next slot to write (main loop), tail
+// the block being run (interrupt)
+Block ring[RING_SIZE];
+volatile byte head = 0;
+volatile byte tail = 0;
+
+volatile long pos[3] = {0, 0, 0}; // current step position
+long planned[3] = {0, 0, 0}; // position at the end of the last queued block
+long speed = 8000; // default speed (steps/s)
+long startspeed = 200; // speed at the start and the end of a ramp
+long acceleration = 50000; // default acceleration (steps/s^2)
+
+// state of the step interrupt
+volatile boolean moving = false;
+Block *block = NULL;
+long step_count;
+long rate;
+long phase;
+long error[3];
+
+byte queue_count() {
+  return (head - tail) & (RING_SIZE - 1);
+}
+
+byte crc8_update(byte crc, byte data) {
+  crc ^= data;
+  for (byte i = 0; i < 8; i++) {
+    crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : (crc << 1);
+  }
+  return crc;
+}
+
+long read_long(byte *data) {
+  return (long) data[0] | ((long) data[1] << 8)
+       | ((long) data[2] << 16) | ((long) data[3] << 24);
+}
+
+void write_long(byte *data, long value) {
+  for (byte i = 0; i < 4; i++) {
+    data[i] = (value >> (8 * i)) & 0xFF;
+  }
+}
+
+long read_position(byte axis) {
+  noInterrupts();
+  long value = pos[axis];
+  interrupts();
+  return value;
+}
+
+// Compute a trapezoidal profile and push the block. Return false if full.
+boolean queue_block(long *delta, long entry, long cruise, long exit,
+                    long accel, long accel_until, long decel_after) {
+  if (queue_count() == RING_SIZE - 1) return false;
+  Block *b = &ring[head];
+  b->direction_bits = 0;
+  b->total = 0;
+  for (byte i = 0; i < 3; i++) {
+    if (delta[i] >= 0) b->direction_bits |= direction_bits[i];
+    b->steps[i] = abs(delta[i]);
+    if (b->steps[i] > b->total) b->total = b->steps[i];
+    planned[i] += delta[i];
+  }
+  cruise = constrain(cruise, 1, TICK_HZ);
+  entry = constrain(entry, 1, cruise);
+  exit = constrain(exit, 1, cruise);
+  b->entry = entry << 8;
+  b->cruise = cruise << 8;
+  b->exit = exit << 8;
+  b->accel = (accel << 8) / TICK_HZ;
+  if (accel_until < 0) { // let the board compute the profile
+    accel_until = b->total;
+    decel_after = 0;
+    if (accel > 0) {
+      long up = (cruise * cruise - entry * entry) / (2 * accel);
+      long down = (cruise * cruise - exit * exit) / (2 * accel);
+      if (up + down > b->total) {
+        up = (2.0 * accel * b->total + (float) exit * exit
+              - (float) entry * entry) / (4.0 * accel);
+        up = constrain(up, 0, b->total);
+        down = b->total - up;
+      }
+      accel_until = up;
+      decel_after = b->total - down;
+    }
+  }
+  b->accel_until = accel_until;
+  b->decel_after = decel_after;
+  if (b->total > 0) head = (head + 1) & (RING_SIZE - 1);
+  return true;
+}
+
+void send_frame(byte cmd, byte *payload, byte len) {
+  byte crc = crc8_update(0, len + 1);
+  crc = crc8_update(crc, cmd);
+  Serial.write(SYNC);
+  Serial.write(len + 1);
+  Serial.write(cmd);
+  for (byte i = 0; i < len; i++) {
+    Serial.write(payload[i]);
+    crc = crc8_update(crc, payload[i]);
+  }
+  Serial.write(crc);
+}
+
+void send_error(byte code) {
+  send_frame(CMD_ERROR, &code, 1);
+}
+
+void handle_frame(byte cmd, byte *payload, byte len) {
+  byte out[4];
+  long delta[3];
+  long move_speed;
+  switch (cmd) {
+    case CMD_IDENT:
+      send_frame(cmd | REPLY, (byte *) "arduino", 7);
+      return;
+    case CMD_VERSION:
+      out[0] = VERSION_MAJOR;
+      out[1] = VERSION_MINOR;
+      send_frame(cmd | REPLY, out, 2);
+      return;
+    case CMD_SPEED:
+      if (len != 4) break;
+      speed = read_long(payload);
+      send_frame(cmd | REPLY, out, 0);
+      return;
+    case CMD_SET_POS:
+      if (len != 5 || payload[0] > 2) break;
+      noInterrupts();
+      pos[payload[0]] = planned[payload[0]] = read_long(payload + 1);
+      interrupts();
+      send_frame(cmd | REPLY, out, 0);
+      return;
+    case CMD_RESET:
+      noInterrupts();
+      for (byte i = 0; i < 3; i++) pos[i] = planned[i] = 0;
+      interrupts();
+      send_frame(cmd | REPLY, out, 0);
+      return;
+    case CMD_MOVE: // absolute move, the profile is computed here
+      if (len != MOVE_SIZE) break;
+      for (byte i = 0; i < 3; i++) {
+        delta[i] = 0;
+        if (payload[0] & (2 << i)) {
+          delta[i] = read_long(payload + 1 + 4 * i) - planned[i];
+        }
+      }
+      move_speed = read_long(payload + 13);
+      if (move_speed > 0) speed = move_speed;
+      if (!(payload[0] & MOVE_RAMP)) {
+        if (!queue_block(delta, speed, speed, speed, 0, 0, 0)) {
+          send_error(ERR_FULL);
+          return;
+        }
+      } else if (!queue_block(delta, startspeed, speed, startspeed,
+                              acceleration, -1, 0)) {
+        send_error(ERR_FULL);
+        return;
+      }
+      out[0] = RING_SIZE - 1 - queue_count();
+      send_frame(cmd | REPLY, out, 1);
+      return;
+    case CMD_SEGMENT: // relative segment planned by the host
+      if (len != SEGMENT_SIZE) break;
+      for (byte i = 0; i < 3; i++) {
+        delta[i] = read_long(payload + 1 + 4 * i);
+      }
+      if (!queue_block(delta,
+                       read_long(payload + 13), read_long(payload + 17),
+                       read_long(payload + 21), read_long(payload + 25),
+                       read_long(payload + 29), read_long(payload + 33))) {
+        send_error(ERR_FULL);
+        return;
+      }
+      out[0] = RING_SIZE - 1 - queue_count();
+      send_frame(cmd | REPLY, out, 1);
+      return;
+    case CMD_POS:
+      if (len != 1 || payload[0] > 2) break;
+      write_long(out, read_position(payload[0]));
+      send_frame(cmd | REPLY, out, 4);
+      return;
+    case CMD_STATUS:
+      out[0] = RING_SIZE - 1 - queue_count();
+      out[1] = moving;
+      send_frame(cmd | REPLY, out, 2);
+      return;
+    default:
+      send_error(ERR_UNKNOWN);
+      return;
+  }
+  send_error(ERR_LENGTH);
+}
+
+// frame parser state
+byte rx_state = 0; // 0: wait sync, 1: wait len, 2: body, 3: crc
+byte rx_len;
+byte rx_count;
+byte rx_buffer[MAX_PAYLOAD + 1];
+byte rx_crc;
+
+void read_serial() {
+  while (Serial.available()) {
+    byte c = Serial.read();
+    switch (rx_state) {
+      case 0:
+        if (c == SYNC) rx_state = 1;
+        break;
+      case 1:
+        if (c == 0 || c > MAX_PAYLOAD + 1) {
+          rx_state = 0;
+          break;
+        }
+        rx_len = c;
+        rx_count = 0;
+        rx_crc = crc8_update(0, c);
+        rx_state = 2;
+        break;
+      case 2:
+        rx_buffer[rx_count++] = c;
+        rx_crc = crc8_update(rx_crc, c);
+        if (rx_count == rx_len) rx_state = 3;
+        break;
+      case 3:
+        rx_state = 0;
+        if (c != rx_crc) {
+          send_error(ERR_CRC);
+          break;
+        }
+        handle_frame(rx_buffer[0], rx_buffer + 1, rx_len - 1);
+        break;
+    }
+  }
+}
+
+// Step interrupt: one call per tick, at most one step per axis per tick.
+// Only additions are done here, the divisions are done by queue_block().
+ISR(TIMER1_COMPA_vect) {
+  if (block == NULL) {
+    if (tail == head) {
+      moving = false;
+      return;
+    }
+    block = &ring[tail];
+    DIRECTION_PORT = (DIRECTION_PORT & ~(direction_bits[0] | direction_bits[1]
+                      | direction_bits[2])) | block->direction_bits;
+    step_count = 0;
+    rate = block->entry;
+    phase = 0;
+    for (byte i = 0; i < 3; i++) error[i] = block->total / 2;
+    moving = true;
+  }
+
+  // constant acceleration ramp
+  if (step_count < block->accel_until) {
+    rate += block->accel;
+    if (rate > block->cruise) rate = block->cruise;
+  } else if (step_count >= block->decel_after) {
+    rate -= block->accel;
+    if (rate < block->exit) rate = block->exit;
+  }
+
+  // the longest axis steps when the phase overflows
+  phase += rate >> 8;
+  if (phase < TICK_HZ) return;
+  phase -= TICK_HZ;
+
+  // Bresenham for the other axis
+  byte bits = 0;
+  for (byte i = 0; i < 3; i++) {
+    error[i] += block->steps[i];
+    if (error[i] >= block->total) {
+      error[i] -= block->total;
+      bits |= pulse_bits[i];
+      pos[i] += (block->direction_bits & direction_bits[i]) ? 1 : -1;
+    }
+  }
+  PULSE_PORT |= bits;
+  delayMicroseconds(2);
+  PULSE_PORT &= ~bits;
+
+  if (++step_count >= block->total) {
+    block = NULL;
+    tail = (tail + 1) & (RING_SIZE - 1);
+  }
+}
+
+void setup() {
+  pinMode(X_PULSE, OUTPUT);
+  pinMode(Y_PULSE, OUTPUT);
+  pinMode(Z_PULSE, OUTPUT);
+  pinMode(X_DIRECTION, OUTPUT);
+  pinMode(Y_DIRECTION, OUTPUT);
+  pinMode(Z_DIRECTION, OUTPUT);
+  pinMode(X_ENABLE, OUTPUT);
+  pinMode(X_SWITCH, INPUT);
+  Serial.begin(BAUDRATE);
+
+  // Timer1 in CTC mode, prescaler 8 (2MHz), interrupt every 1/TICK_HZ s
+  noInterrupts();
+  TCCR1A = 0;
+  TCCR1B = (1 << WGM12) | (1 << CS11);
+  OCR1A = 2000000L / TICK_HZ - 1;
+  TIMSK1 |= (1 << OCIE1A);
+  interrupts();
+}
+
+void loop() {
+  read_serial();
+}
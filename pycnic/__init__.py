@@ -1 +1,5 @@
 #
+import logging
+
+# the application decides where the logs go
+logging.getLogger('PyCNiC').addHandler(logging.NullHandler())
@@ -0,0 +1,179 @@
+# coding: utf-8
+"""Single-owner I/O actor
+
+A driver is shared between threads: a job streams moves while a monitoring
+thread reads the position. Each command is a write followed by the read of
+its response, and two threads using the link at the same time would get
+each other's responses. So each driver owns its link through an IOActor:
+one thread which runs the requests of all the other threads, one after the
+other, from a submission queue.
+
+The methods of the drivers which talk to the controller are decorated with
+serialized, or with query for those without side effects: while a query is
+waiting in the queue, the same query submitted by other threads is merged
+with it, and they all get the response of a single round trip. A serialized
+method called from the actor thread, by another serialized method, runs
+right away, so that a sequence of commands can be made atomic.
+
+Control requests (feed hold, resume, abort) do not go through the queue:
+they must not wait behind the moves.
+
+>>> import threading
+>>> from pycnic.actor import IOActor
+>>> actor = IOActor()
+>>> calls = []
+>>> def position():
+...     calls.append(threading.current_thread() is actor.thread)
+...     return 42
+>>> actor.call(position), calls
+(42, [True])
+>>> actor.close()
+"""
+from collections import deque
+import atexit
+import functools
+import logging
+import sys
+import threading
+import types
+import weakref
+
+logger = logging.getLogger('PyCNiC')
+
+_actors = weakref.WeakSet() # stopped at exit, before the interpreter shutdown
+
+
+class Request(object):
+    """A call waiting for the actor, and its result
+    """
+    __slots__ = ('function', 'args', 'kwargs', 'key', 'done', 'result',
+                 'error')
+
+    def __init__(self, function, args, kwargs, key):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class IOActor(object):
+    """Thread running the calls submitted by any other thread, in order.
+    The thread is started on the first call.
+    """
+
+    def __init__(self, name='PyCNiC I/O'):
+        self.name = name
+        self.thread = None
+        self.merged = 0 # requests answered by the round trip of another one
+        self._queue = deque()
+        self._condition = threading.Condition(threading.Lock())
+        _actors.add(self)
+
+    def call(self, function, args=(), kwargs=None, key=None):
+        """Run function(*args, **kwargs) in the actor and return its result,
+        or raise its exception. The calls with the same key, other than
+        None, waiting at the same time are merged in a single call.
+        """
+        if threading.current_thread() is self.thread:
+            return function(*args, **(kwargs or {}))
+        request = Request(function, args, kwargs or {}, key)
+        self._condition.acquire()
+        try:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+            self._queue.append(request)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error[0], request.error[1], request.error[2]
+        return request.result
+
+    def close(self):
+        """Stop the thread once the submitted calls are done
+        """
+        self._condition.acquire()
+        try:
+            if self.thread is None:
+                return
+            thread, self.thread = self.thread, None
+            self._queue.append(None)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def _next(self):
+        """Return the next request and the ones merged with it
+        """
+        self._condition.acquire()
+        try:
+            while not self._queue:
+                self._condition.wait()
+            request = self._queue.popleft()
+            if request is None or request.key is None:
+                return request, ()
+            merged = [other for other in self._queue
+                      if other is not None and other.key == request.key]
+            for other in merged:
+                self._queue.remove(other)
+            self.merged += len(merged)
+            return request, merged
+        finally:
+            self._condition.release()
+
+    def _run(self):
+        while True:
+            request, merged = self._next()
+            if request is None:
+                return
+            try:
+                result, error = request.function(*request.args,
+                                                 **request.kwargs), None
+            except:
+                result, error = None, sys.exc_info()
+            for waiting in (request,) + tuple(merged):
+                waiting.result, waiting.error = result, error
+                waiting.done.set()
+
+
+@atexit.register
+def _close_all():
+    for actor in list(_actors):
+        actor.close()
+
+
+def _wrap(method, call):
+    """Return the call wrapper with the name, docstring and globals of the
+    method, so that doctest still finds its examples in the driver module
+    """
+    wrapper = types.FunctionType(call.func_code, method.func_globals,
+                                 method.__name__, call.func_defaults,
+                                 call.func_closure)
+    return functools.wraps(method)(wrapper)
+
+
+def serialized(method):
+    """Run a method of a driver in the actor of the driver
+    """
+    def call(self, *args, **kwargs):
+        return self.actor.call(method, (self,) + args, kwargs)
+    return _wrap(method, call)
+
+
+def query(method):
+    """Run a method of a driver without side effects in the actor of the
+    driver, merged with the identical calls waiting at the same time
+    """
+    def call(self, *args, **kwargs):
+        return self.actor.call(method, (self,) + args, kwargs,
+                               key=(method, args, sorted(kwargs.items())))
+    return _wrap(method, call)
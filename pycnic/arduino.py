@@ -0,0 +1,611 @@
+# coding: utf-8
+"""Module supporting the open Arduino firmware
+See arduino/pulse_binary/pulse_binary.ino
+
+The host and the board exchange binary frames:
+
+    SYNC (0xA5) | LEN | CMD | PAYLOAD (LEN-1 bytes) | CRC8
+
+LEN counts CMD and PAYLOAD, the CRC8 (polynomial 0x07) covers LEN, CMD and
+PAYLOAD. Integers are little endian. The board answers each frame with a
+frame whose CMD is the request CMD | 0x80, or ERROR.
+
+Moves are stored in a ring buffer on the board and acknowledged immediately,
+so the board keeps receiving while it moves. A timer interrupt generates the
+steps of the X, Y and Z axis with constant acceleration ramps. Segments
+planned on the host by pycnic.planner can be streamed to keep the queue
+filled, and are chained without stopping, with stream_segments(). Like
+the other drivers, stream() sends absolute records, one move each.
+
+The Simulator below implements the firmware on the host, for tests:
+
+>>> from pycnic.arduino import ArduinoCNC, Simulator
+>>> cnc = ArduinoCNC(port=Simulator())
+>>> cnc.name
+'arduino'
+>>> cnc.reset_all_axis()
+>>> cnc.move(x=10, y=20)
+>>> cnc.x, cnc.y, cnc.z
+(10, 20, 0)
+>>> cnc.speed = 2000
+>>> cnc.move(z=-5, speed=500)
+>>> cnc.x, cnc.y, cnc.z
+(10, 20, -5)
+"""
+import logging
+import struct
+import time
+from pycnic.actor import IOActor, serialized
+from pycnic.completion import Predictor, Completion, wait_for
+from pycnic.control import ControlChannel, HOLD, RESUME, ABORT
+from pycnic.stateboard import STREAMING, control_flags
+from pycnic.tracing import FlightRecorder, WRITE, READ, event
+
+logger = logging.getLogger('PyCNiC')
+
+TIMEOUT = 2 # in seconds, for serial port reads or writes
+MAXTIMEOUT = 30 # in seconds, for any move command
+BAUDRATE = 250000 # 0% error with the 16MHz clock of the board
+QUEUE_SIZE = 15 # usable slots of the ring buffer of the firmware
+ACCELERATION = 50000 # in steps/s², of the ramps computed by the firmware
+
+SYNC = 0xA5
+CMD_IDENT = 0x01
+CMD_VERSION = 0x02
+CMD_SPEED = 0x10
+CMD_SET_POS = 0x11
+CMD_RESET = 0x12
+CMD_MOVE = 0x20
+CMD_SEGMENT = 0x21
+CMD_POS = 0x30
+CMD_STATUS = 0x31
+CMD_ERROR = 0xFF
+QUERIES = (CMD_IDENT, CMD_VERSION, CMD_POS, CMD_STATUS) # no side effect
+REPLY = 0x80
+
+ERR_CRC = 1
+ERR_UNKNOWN = 2
+ERR_FULL = 3
+ERR_LENGTH = 4
+
+MOVE_RAMP = 0x01 # move flags, followed by one bit per axis
+AXES = ('x', 'y', 'z')
+MOVE = struct.Struct('<B4i') # flags, x, y, z, speed
+SEGMENT = struct.Struct('<B9i') # flags, dx, dy, dz, then planner.Segment
+LONG = struct.Struct('<i')
+
+
+def _crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for i in range(8):
+            crc = ((crc << 1) ^ 0x07 if crc & 0x80 else crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data):
+    """Compute the CRC8 (polynomial 0x07) of a byte string
+
+    >>> crc8('123456789')
+    244
+    """
+    crc = 0
+    for char in data:
+        crc = CRC8_TABLE[crc ^ ord(char)]
+    return crc
+
+
+def encode_frame(cmd, payload=''):
+    """Build a frame
+
+    >>> encode_frame(CMD_POS, '\\x00')
+    '\\xa5\\x020\\x00/'
+    """
+    body = chr(len(payload) + 1) + chr(cmd) + payload
+    return chr(SYNC) + body + chr(crc8(body))
+
+
+def read_frame(port):
+    """Read one frame from a serial-like port and return (cmd, payload)
+    """
+    deadline = time.time() + TIMEOUT
+    while True:
+        char = port.read(1)
+        if char == chr(SYNC):
+            break
+        if time.time() > deadline:
+            raise IOError(u'Could not read from the device')
+    length = port.read(1)
+    if not length:
+        raise IOError(u'Could not read from the device')
+    body = port.read(ord(length))
+    crc = port.read(1)
+    if len(body) != ord(length) or not crc:
+        raise IOError(u'Truncated frame')
+    if crc8(length + body) != ord(crc):
+        raise IOError(u'Bad CRC in frame')
+    return ord(body[0]), body[1:]
+
+
+class ArduinoCNC(object):
+    """This class represents a board running the binary pulse firmware.
+    It has the same interface as soprolec.InterpCNC
+    """
+    serial_speed = BAUDRATE
+    name = None
+    port = None
+    _speed = None
+    board = None # stateboard.StateBoard where the state is published
+    _done = 0 # moves sent by the current stream
+
+    def __init__(self, speed=1000, port=None):
+        self._speed = speed
+        self.port = port
+        self.control = ControlChannel(self._send_control)
+        self.motion = Predictor()
+        self.recorder = FlightRecorder()
+        self.actor = IOActor()
+        self._targets = [None] * 3 # last commanded positions
+        try:
+            self.connect()
+        except IOError:
+            logger.warning(u'Did you plug and turn on the device?')
+
+    def __repr__(self):
+        return '<%s.%s object at %s name="%s">' % (
+                self.__module__,
+                self.__class__.__name__,
+                hex(id(self)),
+                self.name)
+
+    #
+    # Lowlevel methods
+    #
+    def connect(self, serial_port=0):
+        if self.port is None or self.port.fd is None:
+            import serial
+            self.port = serial.Serial(serial_port,
+                                      self.serial_speed,
+                                      timeout=TIMEOUT)
+        self.name = self.execute(CMD_IDENT)
+        self.speed = self._speed
+
+    def disconnect(self):
+        self.actor.close()
+        if self.port is not None and self.port.fd is not None:
+            self.port.flush()
+            self.port.close()
+        self.name = None
+
+    def execute(self, cmd, payload=''):
+        """Send a command frame and return the payload of the response.
+        The commands of all the threads are sent one after the other by the
+        actor of the driver, and the identical queries waiting at the same
+        time share one round trip.
+        """
+        key = (cmd, payload) if cmd in QUERIES else None
+        return self.actor.call(self._execute, (cmd, payload), key=key)
+
+    def _execute(self, cmd, payload=''):
+        if not self.name and cmd != CMD_IDENT:
+            raise IOError(u'The device is not connected')
+        frame = encode_frame(cmd, payload)
+        event('execute', command=cmd, size=len(frame))
+        self.recorder.record(WRITE, frame)
+        try:
+            self.port.write(frame)
+            self.port.flush()
+            rcmd, rpayload = read_frame(self.port)
+            self.recorder.record(READ, chr(rcmd) + rpayload)
+            if rcmd == CMD_ERROR:
+                code = ord(rpayload[0]) if rpayload else 0
+                if code == ERR_FULL:
+                    raise BufferError(u'The move queue is full')
+                raise IOError(u'The device returned error %s' % code)
+            if rcmd != cmd | REPLY:
+                raise IOError(u'Unexpected response %02X' % rcmd)
+        except IOError, e:
+            self.recorder.fault(e)
+            raise
+        return rpayload
+
+    #
+    # Informative commands
+    #
+    @property
+    def firmware_major(self):
+        return ord(self.execute(CMD_VERSION)[0])
+
+    @property
+    def firmware_minor(self):
+        return ord(self.execute(CMD_VERSION)[1])
+
+    def status(self):
+        """Return the number of free slots in the move queue and whether the
+        board is moving
+        """
+        free, busy = struct.unpack('<BB', self.execute(CMD_STATUS))
+        self._publish(fifo=QUEUE_SIZE - free)
+        return free, bool(busy)
+
+    def _publish(self, **state):
+        """Publish the commanded position and the given fields on the
+        state board, if any
+        """
+        if self.board is None:
+            return
+        for axis, value in zip(AXES, self._targets):
+            if value is not None:
+                state[axis] = value
+        self.board.publish(**state)
+
+    #
+    # linear moves
+    #
+    def move(self, x=None, y=None, z=None, speed=None, ramp=True):
+        """Queue a move of the specified axis to the specified step.
+        Wait for a free slot if the queue of the board is full.
+
+        >>> cnc = ArduinoCNC(port=Simulator())
+        >>> cnc.move()
+        Traceback (most recent call last):
+        ...
+        ValueError: Please specify at least one axis to move
+        >>> cnc.move(x=10.2)
+        >>> cnc.x
+        10
+        """
+        if (x, y, z) == (None, None, None):
+            raise ValueError(u'Please specify at least one axis to move')
+        flags = MOVE_RAMP if ramp else 0
+        targets = []
+        for i, value in enumerate((x, y, z)):
+            if value is not None:
+                flags |= 2 << i
+            targets.append(int(round(value or 0)))
+        payload = MOVE.pack(flags, *(targets + [int(speed or 0)]))
+        deadline = time.time() + MAXTIMEOUT
+        while True:
+            try:
+                self.execute(CMD_MOVE, payload)
+                break
+            except BufferError:
+                if time.time() > deadline:
+                    raise IOError(u'The move queue stayed full')
+                time.sleep(0.01)
+        if speed:
+            self._speed = int(speed)
+        steps = 0
+        for i, value in enumerate((x, y, z)):
+            if value is None:
+                continue
+            if steps is not None and self._targets[i] is not None:
+                steps = max(steps, abs(int(round(value)) - self._targets[i]))
+            else:
+                steps = None
+            self._targets[i] = int(round(value))
+        self.motion.add(steps, self._speed, ACCELERATION if ramp else None)
+        self._publish()
+
+    def stream(self, records):
+        """Move through a sequence of (x, y, z[, a[, speed]]) records, such as
+        a toolpath.Toolpath, and return the number of moves sent. The a axis
+        is ignored. The stream can be held, resumed or aborted from another
+        thread.
+
+        >>> cnc = ArduinoCNC(port=Simulator())
+        >>> cnc.stream([(10, 0, 0, 0, 500), (10, 20, 0, 0, 0)])
+        2
+        >>> cnc.x, cnc.y
+        (10, 20)
+        """
+        self._done = 0
+        self._publish(flags=STREAMING, done=0, total=
+                      len(records) if hasattr(records, '__len__') else 0)
+        try:
+            return self.control.stream(records, self._stream_record)
+        finally:
+            self._publish(flags=control_flags(self.control), done=self._done)
+
+    def _stream_record(self, record):
+        speed = record[4] if len(record) > 4 and record[4] else None
+        self._done += 1
+        self.move(x=record[0], y=record[1], z=record[2], speed=speed)
+        self._publish(flags=control_flags(self.control), done=self._done)
+
+    def _send_control(self, action):
+        """The firmware has no stop command: feed hold, resume and abort are
+        handled on the host, and the board finishes the queued moves.
+        """
+
+    def feed_hold(self):
+        """Stop sending moves after the current one.
+        Return the latency of the acknowledgement.
+        """
+        return self.control.request(HOLD)
+
+    def resume(self):
+        """Resume the stream after a feed hold
+        """
+        return self.control.request(RESUME)
+
+    def abort(self):
+        """Drop the remaining moves of the stream. The moves already queued
+        on the board are still executed.
+        """
+        return self.control.request(ABORT)
+
+    def stream_segments(self, segments):
+        """Send planned segments (see pycnic.planner) as fast as the queue of
+        the board accepts them. Return the number of segments sent.
+
+        >>> from pycnic.planner import plan
+        >>> cnc = ArduinoCNC(port=Simulator())
+        >>> cnc.stream_segments(plan([(100, 0, 0), (100, 50, 0), (0, 0, 10)],
+        ...                 speed=4000, accel=20000))
+        3
+        >>> cnc.x, cnc.y, cnc.z
+        (0, 0, 10)
+        """
+        count = 0
+        self._publish(flags=STREAMING, done=0, total=
+                      len(segments) if hasattr(segments, '__len__') else 0)
+        deadline = time.time() + MAXTIMEOUT
+        for segment in segments:
+            payload = SEGMENT.pack(0, *segment)
+            while True:
+                try:
+                    self.execute(CMD_SEGMENT, payload)
+                    break
+                except BufferError:
+                    if time.time() > deadline:
+                        raise IOError(u'The move queue stayed full')
+                    time.sleep(0.001)
+            deadline = time.time() + MAXTIMEOUT
+            count += 1
+            self._predict_segment(segment)
+            self._publish(flags=STREAMING, done=count)
+        self._publish(flags=0)
+        return count
+
+    def _predict_segment(self, segment):
+        """Account for a planned segment in the predicted end time. It is
+        estimated from the slowest of its entry and exit speeds.
+        """
+        dx, dy, dz, entry, cruise, exit, accel = segment[:7]
+        for i, delta in enumerate((dx, dy, dz)):
+            if self._targets[i] is not None:
+                self._targets[i] += delta
+        self.motion.add(max(abs(dx), abs(dy), abs(dz)), cruise, accel,
+                        min(entry, exit))
+
+    def measure_step_rate(self, rate, steps=None, axis='x'):
+        """Run a constant speed move at the requested rate (Hz) forth and
+        back, and return the rate actually measured from the host, in Hz.
+        This is the step rate benchmark of the firmware.
+        """
+        steps = steps or 5 * rate # about 5 seconds
+        delta = [0, 0, 0]
+        delta[AXES.index(axis)] = steps
+        self.wait()
+        start = time.time()
+        for sign in (1, -1):
+            segment = [sign * d for d in delta] + [rate, rate, rate, 0, 0, steps]
+            self.execute(CMD_SEGMENT, SEGMENT.pack(0, *segment))
+            self._predict_segment(segment)
+        self.wait()
+        return 2 * steps / (time.time() - start)
+
+    def _idle(self):
+        free, busy = self.status()
+        return free == QUEUE_SIZE and not busy
+
+    def wait(self):
+        """Wait until all the queued moves are finished: sleep until their
+        predicted end, then poll the status with a backoff.
+        """
+        wait_for(self._idle, self.motion.end, MAXTIMEOUT)
+        self.motion.reset()
+
+    def completion(self):
+        """Return a Completion of the moves sent so far, without blocking.
+        No other command must be sent until it is done.
+
+        >>> cnc = ArduinoCNC(port=Simulator())
+        >>> cnc.reset_all_axis()
+        >>> cnc.move(x=100, speed=1000, ramp=False)
+        >>> end = cnc.motion.end
+        >>> cnc.completion().result(timeout=1) > 0
+        True
+
+        It is done once the predicted end of the moves is reached:
+
+        >>> from pycnic.completion import MARGIN
+        >>> time.time() >= end - MARGIN
+        True
+        """
+        return Completion(self._idle, self.motion.end)
+
+    def _get_axis(self, axis):
+        """Get the position of the axis once the queued moves are finished
+        """
+        if axis not in AXES:
+            raise ValueError(u'Bad axis')
+        self.wait()
+        return LONG.unpack(self.execute(CMD_POS, chr(AXES.index(axis))))[0]
+
+    @serialized
+    def _set_axis(self, axis, value):
+        """Reset the specified axis to the specified value without moving.
+        The board has no home sensor input, so unlike the InterpCNC, a
+        value of None cannot calibrate the axis.
+
+        >>> cnc = ArduinoCNC(port=Simulator())
+        >>> cnc.x = 10
+        >>> cnc.x
+        10
+        >>> cnc.x = None
+        Traceback (most recent call last):
+        ...
+        ValueError: The board has no home sensor, give a position
+        """
+        if axis not in AXES:
+            raise ValueError(u'Bad axis')
+        if value is None:
+            raise ValueError(u'The board has no home sensor, give a position')
+        self.execute(CMD_SET_POS, chr(AXES.index(axis)) + LONG.pack(value))
+        self._targets[AXES.index(axis)] = value
+
+    x = property(lambda self: self._get_axis('x'), lambda self, val: self._set_axis('x', val))
+    y = property(lambda self: self._get_axis('y'), lambda self, val: self._set_axis('y', val))
+    z = property(lambda self: self._get_axis('z'), lambda self, val: self._set_axis('z', val))
+
+    def _get_speed(self):
+        return self._speed
+
+    @serialized
+    def _set_speed(self, speed):
+        self.execute(CMD_SPEED, LONG.pack(speed))
+        self._speed = speed
+
+    speed = property(_get_speed, _set_speed)
+
+    @serialized
+    def reset_all_axis(self):
+        """Reset all axis to zero
+        """
+        self.execute(CMD_RESET)
+        self._targets = [0] * 3
+
+
+class Simulator(object):
+    """Host-side implementation of the firmware, behaving as a serial port.
+
+    With auto_run=False, the queued moves are only executed by run(), which
+    allows to fill the queue:
+
+    >>> sim = Simulator(auto_run=False)
+    >>> cnc = ArduinoCNC(port=sim)
+    >>> for i in range(QUEUE_SIZE):
+    ...     cnc.move(x=i)
+    >>> cnc.execute(CMD_MOVE, MOVE.pack(2, 0, 0, 0, 0))
+    Traceback (most recent call last):
+    ...
+    BufferError: The move queue is full
+    >>> sim.run()
+    >>> cnc.x
+    14
+    """
+    name = 'arduino'
+    version = (1, 1)
+    fd = 1
+
+    def __init__(self, auto_run=True):
+        self.auto_run = auto_run
+        self.position = [0, 0, 0]
+        self.planned = [0, 0, 0] # position at the end of the queue
+        self.speed = 8000
+        self.queue = []
+        self._input = ''
+        self._output = ''
+
+    # serial port interface
+    def write(self, data):
+        self._input += data
+        self._process()
+        return len(data)
+
+    def read(self, size=1):
+        data, self._output = self._output[:size], self._output[size:]
+        return data
+
+    def inWaiting(self):
+        return len(self._output)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.fd = None
+
+    # firmware
+    def run(self):
+        """Execute all the queued moves
+        """
+        while self.queue:
+            delta = self.queue.pop(0)
+            for i in range(3):
+                self.position[i] += delta[i]
+
+    def _reply(self, cmd, payload=''):
+        self._output += encode_frame(cmd, payload)
+
+    def _process(self):
+        while True:
+            start = self._input.find(chr(SYNC))
+            if start < 0:
+                self._input = ''
+                return
+            self._input = self._input[start:]
+            if len(self._input) < 2:
+                return
+            length = ord(self._input[1])
+            if len(self._input) < length + 3:
+                return
+            body = self._input[1:length + 2]
+            crc = ord(self._input[length + 2])
+            self._input = self._input[length + 3:]
+            if crc8(body) != crc:
+                self._reply(CMD_ERROR, chr(ERR_CRC))
+                continue
+            self._handle(ord(body[1]), body[2:])
+
+    def _handle(self, cmd, payload):
+        if cmd == CMD_IDENT:
+            self._reply(cmd | REPLY, self.name)
+        elif cmd == CMD_VERSION:
+            self._reply(cmd | REPLY, chr(self.version[0]) + chr(self.version[1]))
+        elif cmd == CMD_SPEED and len(payload) == LONG.size:
+            self.speed = LONG.unpack(payload)[0]
+            self._reply(cmd | REPLY)
+        elif cmd == CMD_SET_POS and len(payload) == 1 + LONG.size:
+            axis = ord(payload[0])
+            self.position[axis] = self.planned[axis] = \
+                LONG.unpack(payload[1:])[0]
+            self._reply(cmd | REPLY)
+        elif cmd == CMD_RESET:
+            self.position = [0, 0, 0]
+            self.planned = [0, 0, 0]
+            self._reply(cmd | REPLY)
+        elif cmd in (CMD_MOVE, CMD_SEGMENT) and len(payload) == {
+                CMD_MOVE: MOVE, CMD_SEGMENT: SEGMENT}[cmd].size:
+            if len(self.queue) >= QUEUE_SIZE:
+                self._reply(CMD_ERROR, chr(ERR_FULL))
+                return
+            if cmd == CMD_MOVE:
+                values = MOVE.unpack(payload)
+                if values[4]:
+                    self.speed = values[4]
+                delta = [values[1 + i] - self.planned[i]
+                         if values[0] & (2 << i) else 0 for i in range(3)]
+            else:
+                delta = list(SEGMENT.unpack(payload)[1:4])
+            for i in range(3):
+                self.planned[i] += delta[i]
+            self.queue.append(delta)
+            if self.auto_run:
+                self.run()
+            self._reply(cmd | REPLY, chr(QUEUE_SIZE - len(self.queue)))
+        elif cmd == CMD_POS and len(payload) == 1:
+            self._reply(cmd | REPLY, LONG.pack(self.position[ord(payload)]))
+        elif cmd == CMD_STATUS:
+            self._reply(cmd | REPLY, chr(QUEUE_SIZE - len(self.queue)) + '\x00')
+        elif cmd in (CMD_IDENT, CMD_VERSION, CMD_SPEED, CMD_SET_POS,
+                     CMD_RESET, CMD_MOVE, CMD_SEGMENT, CMD_POS, CMD_STATUS):
+            self._reply(CMD_ERROR, chr(ERR_LENGTH))
+        else:
+            self._reply(CMD_ERROR, chr(ERR_UNKNOWN))
@@ -0,0 +1,269 @@
+# coding: utf-8
+"""Benchmark suite
+
+Measure the throughput of the drivers against their simulators, and of the
+codecs, the G-code compiler and the motion planner. The time spent on the
+simulated links is counted by a virtual clock instead of being slept, so
+the results add the real host cost to a fixed model of the link, and runs
+are fast and repeatable. Every result is a rate: the higher, the better.
+
+Run the suite, save the results as a baseline, and compare later runs
+against it. The command fails when a result is slower than the baseline by
+more than the tolerance:
+
+    python -m pycnic.bench --save baseline.json
+    python -m pycnic.bench --compare baseline.json --tolerance 0.2
+
+The rates depend on the machine, so a baseline is only meaningful on the
+machine where it was saved.
+
+>>> from pycnic.bench import compare
+>>> compare({'gcode.parse': 900.0, 'planner.plan': 500.0},
+...         {'gcode.parse': 1000.0, 'planner.plan': 1000.0}, tolerance=0.2)
+[('planner.plan', 500.0, 1000.0)]
+"""
+import fnmatch
+import json
+import sys
+import time
+
+REPEAT = 3 # runs of each benchmark, the best one is kept
+TOLERANCE = 0.2 # slowdown allowed against the baseline
+SERIAL_LATENCY = 0.006 # in seconds, for a command and its response at 19200 bauds
+USB_LATENCY = 0.001 # in seconds, for a bulk write
+
+BENCHMARKS = [] # (name, unit, function) in the order they run
+
+
+def benchmark(name, unit):
+    """Register a function taking a VirtualClock, and returning the number
+    of operations it ran
+    """
+    def register(function):
+        BENCHMARKS.append((name, unit, function))
+        return function
+    return register
+
+
+class VirtualClock(object):
+    """Time spent on simulated links, counted instead of slept
+    """
+
+    def __init__(self):
+        self.elapsed = 0.0
+
+    def sleep(self, seconds):
+        self.elapsed += seconds
+
+
+def measure(function, repeat=REPEAT):
+    """Return the best rate of the function, in operations per second
+    """
+    best = 0.0
+    for i in range(repeat):
+        clock = VirtualClock()
+        start = time.time()
+        count = function(clock)
+        elapsed = time.time() - start + clock.elapsed
+        best = max(best, count / elapsed)
+    return best
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Return the list of (name, result, reference) slower than the
+    baseline by more than the tolerance
+    """
+    return [(name, results[name], baseline[name]) for name in sorted(results)
+            if name in baseline
+            and results[name] < baseline[name] * (1 - tolerance)]
+
+
+def _records(count):
+    return [(i % 500, (i * 7) % 500, i % 3, 0, 1000 if i % 10 else 0)
+            for i in xrange(count)]
+
+
+@benchmark('interpcnc.roundtrip', 'commands/s')
+def bench_interpcnc_roundtrip(clock, count=1000):
+    from pycnic.soprolec import InterpCNC, Simulator
+    cnc = InterpCNC(port=Simulator(SERIAL_LATENCY, clock.sleep))
+    try:
+        for i in xrange(count):
+            cnc.execute('RX')
+    finally:
+        cnc.disconnect()
+    return count
+
+
+@benchmark('interpcnc.move', 'moves/s')
+def bench_interpcnc_move(clock, count=5000):
+    from pycnic.soprolec import InterpCNC, Simulator
+    cnc = InterpCNC(port=Simulator())
+    try:
+        cnc.reset_all_axis()
+        for x, y, z, a, speed in _records(count):
+            cnc.move(x, y, z, speed or None)
+    finally:
+        cnc.disconnect()
+    return count
+
+
+@benchmark('interpcnc.stream', 'moves/s')
+def bench_interpcnc_stream(clock, count=1000):
+    from pycnic.soprolec import InterpCNC, Simulator
+    cnc = InterpCNC(port=Simulator(SERIAL_LATENCY, clock.sleep))
+    try:
+        return cnc.stream(_records(count))
+    finally:
+        cnc.disconnect()
+
+
+@benchmark('tinycn.stream', 'moves/s')
+def bench_tinycn_stream(clock, count=1000):
+    from pycnic.techlf import TinyCN, Simulator
+    tiny = TinyCN(handle=Simulator(USB_LATENCY, clock.sleep))
+    try:
+        return tiny.stream(_records(count))
+    finally:
+        tiny.off()
+
+
+@benchmark('arduino.stream', 'segments/s')
+def bench_arduino_stream(clock, count=5000):
+    from pycnic.arduino import ArduinoCNC, Simulator
+    from pycnic.planner import plan
+    segments = list(plan([record[:3] for record in _records(count)],
+                         speed=4000, accel=20000))
+    cnc = ArduinoCNC(port=Simulator())
+    try:
+        return cnc.stream_segments(segments)
+    finally:
+        cnc.disconnect()
+
+
+@benchmark('codec.int2tuple', 'conversions/s')
+def bench_int2tuple(clock, count=100000):
+    from pycnic.techlf import int2tuple
+    for i in xrange(count):
+        int2tuple(i)
+    return count
+
+
+@benchmark('codec.tuple2int', 'conversions/s')
+def bench_tuple2int(clock, count=100000):
+    from pycnic.techlf import tuple2int
+    values = [(i & 0xFF, i >> 8 & 0xFF, 0, 0) for i in xrange(count)]
+    for value in values:
+        tuple2int(value)
+    return count
+
+
+@benchmark('codec.frame', 'frames/s')
+def bench_frame(clock, count=20000):
+    from pycnic.arduino import encode_frame, read_frame, CMD_MOVE, MOVE
+
+    class Port(object):
+        data = ''
+
+        def read(self, size=1):
+            data, self.data = self.data[:size], self.data[size:]
+            return data
+
+    port = Port()
+    for i in xrange(count):
+        port.data = encode_frame(CMD_MOVE, MOVE.pack(1, i, -i, 0, 1000))
+        read_frame(port)
+    return count
+
+
+@benchmark('gcode.parse', 'lines/s')
+def bench_gcode_parse(clock, count=50000):
+    from pycnic.gcode import parse_line
+    lines = ['G1 X%.3f Y%.3f Z-0.1 F600 ; cut' % (i * 0.01, i * 0.02)
+             for i in xrange(count)]
+    for line in lines:
+        parse_line(line)
+    return count
+
+
+@benchmark('gcode.compile', 'lines/s')
+def bench_gcode_compile(clock, count=50000):
+    from pycnic.gcode import State, compile_lines
+    lines = ['G1 X%.3f Y%.3f Z-0.1 F600' % (i * 0.01, i * 0.02)
+             for i in xrange(count)]
+    compile_lines(lines, State(), (80, 80, 400, 10))
+    return count
+
+
+@benchmark('planner.plan', 'segments/s')
+def bench_planner(clock, count=20000):
+    from pycnic.planner import plan
+    return len(list(plan([record[:3] for record in _records(count)],
+                         speed=4000, accel=20000)))
+
+
+@benchmark('machine.convert', 'records/s')
+def bench_convert(clock, count=50000):
+    from pycnic.machine import MachineModel, Converter
+    converter = Converter(MachineModel((80, 80, 400, 10),
+                                       backlash=(0.05, 0.05, 0, 0)))
+    records = [(i * 0.013 % 40, i * 0.007 % 50, -0.1, 0, 600)
+               for i in xrange(count)]
+    return len(converter.convert(records)) // 5
+
+
+@benchmark('probing.compensate', 'records/s')
+def bench_compensate(clock, count=50000):
+    from pycnic.probing import HeightMap, compensate
+    heights = HeightMap((0, 0), 50, 11, 11, [i % 7 for i in range(121)])
+    return sum(1 for record in compensate(_records(count), heights))
+
+
+def run(pattern='*', repeat=REPEAT, output=sys.stdout):
+    """Run the benchmarks whose name matches the pattern and return the
+    dict of their rates
+    """
+    results = {}
+    for name, unit, function in BENCHMARKS:
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        results[name] = measure(function, repeat)
+        if output is not None:
+            print >> output, '%-22s %12.1f %s' % (name, results[name], unit)
+    return results
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=u'pycnic benchmarks')
+    parser.add_argument('-k', '--select', default='*',
+                        help=u'only run the benchmarks matching this pattern')
+    parser.add_argument('-r', '--repeat', type=int, default=REPEAT)
+    parser.add_argument('--json', metavar='FILE',
+                        help=u'write the results to this json file')
+    parser.add_argument('--save', metavar='FILE',
+                        help=u'save the results as the new baseline')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help=u'compare the results with this baseline file')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    options = parser.parse_args(argv)
+    results = run(options.select, options.repeat)
+    for filename in (options.json, options.save):
+        if filename:
+            output = open(filename, 'w')
+            json.dump(results, output, indent=1, sort_keys=True,
+                      separators=(',', ': '))
+            output.close()
+    if options.compare:
+        baseline = json.load(open(options.compare))
+        regressions = compare(results, baseline, options.tolerance)
+        for name, result, reference in regressions:
+            print >> sys.stderr, 'REGRESSION %s: %.1f instead of %.1f' % (
+                name, result, reference)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
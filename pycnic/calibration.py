@@ -0,0 +1,115 @@
+# coding: utf-8
+"""Homing and calibration routine
+
+The home sensor input of each axis is read from the parameters of the
+card. Z is homed first to lift the tool, then the other axes are homed
+together, unless they share the same sensor input, in which case they are
+homed one after the other. The axes of a group are homed at the same time
+only if the card has concurrent_homing.
+
+Each phase is timed. The sensor inputs and the durations are cached with
+the identity of the card, so that the next calibration skips reading the
+sensor inputs. The timeout of a phase covers the whole course of its axes,
+since the time to reach the sensors depends on where the axes start: the
+last duration only extends it. Writing one of the homing parameters
+invalidates the cache.
+
+>>> from pycnic.soprolec import InterpCNC, Simulator
+>>> from pycnic.discovery import IdentityCache
+>>> from pycnic.calibration import calibrate
+>>> cnc = InterpCNC(port=Simulator())
+>>> cnc.identities = IdentityCache()
+>>> cnc.params['EE_FDC_ORIGINEY'] = 2
+>>> cnc.params['EE_FDC_ORIGINEZ'] = 3
+>>> cnc.move(x=10, y=20, z=30)
+>>> [phase.axes for phase in calibrate(cnc)]
+['z', 'xy']
+>>> cnc.x, cnc.y, cnc.z
+(0, 0, 0)
+>>> reads = len([c for c in cnc.port.commands if c.startswith('RP')])
+>>> [phase.axes for phase in calibrate(cnc)]
+['z', 'xy']
+>>> len([c for c in cnc.port.commands if c.startswith('RP')]) - reads
+0
+"""
+from collections import namedtuple
+import logging
+import time
+
+logger = logging.getLogger('PyCNiC')
+
+AXES = ('x', 'y', 'z')
+FIRST = 'z' # homed alone before the others, to lift the tool
+TIMEOUT_FACTOR = 2 # the timeout of a phase is this times its last duration
+TIMEOUT_MARGIN = 1 # in seconds, added to the timeout of a phase
+
+AxisConfig = namedtuple('AxisConfig', 'axis sensor')
+Phase = namedtuple('Phase', 'axes duration')
+
+
+def read_config(cnc, axes=AXES):
+    """Return the AxisConfig of the axes which have a home sensor
+    """
+    configs = []
+    for axis in axes:
+        name = axis.upper()
+        sensor = int(cnc.params['EE_FDC_ORIGINE' + name])
+        if not 0 < sensor <= 8:
+            logger.info(u'No home sensor for the %s axis', name)
+            continue
+        configs.append(AxisConfig(axis, sensor))
+    return configs
+
+
+def plan_phases(configs):
+    """Return the list of groups of axes homed at the same time: the first
+    axis alone, then the others, split when they share a sensor input.
+
+    >>> plan_phases([AxisConfig('x', 1), AxisConfig('y', 1),
+    ...              AxisConfig('z', 2)])
+    ['z', 'x', 'y']
+    """
+    phases = [config.axis for config in configs if config.axis == FIRST]
+    others = [config for config in configs if config.axis != FIRST]
+    while others:
+        group, sensors, rest = '', set(), []
+        for config in others:
+            if config.sensor in sensors:
+                rest.append(config)
+            else:
+                group += config.axis
+                sensors.add(config.sensor)
+        phases.append(group)
+        others = rest
+    return phases
+
+
+def calibrate(cnc, axes=AXES, use_cache=True):
+    """Home the axes of the card and return the list of timed Phases
+    """
+    cached = use_cache and cnc.recall('calibration') or None
+    if (cached is not None and set(cached['axes']) == set(axes)
+        and all(len(config) == len(AxisConfig._fields)
+                for config in cached['configs'])):
+        configs = [AxisConfig(*config) for config in cached['configs']]
+        durations = cached['durations']
+    else:
+        configs = read_config(cnc, axes)
+        durations = {}
+    if not configs:
+        raise Warning(u'The input port is not configured')
+    phases = []
+    for group in plan_phases(configs):
+        timeout = cnc._homing_timeout(group.upper()) # the whole course
+        if group in durations:
+            timeout = max(timeout,
+                          TIMEOUT_FACTOR * durations[group] + TIMEOUT_MARGIN)
+        start = time.time()
+        cnc.home(group, timeout=timeout)
+        phases.append(Phase(group, time.time() - start))
+        logger.info(u'Homed %s in %.2fs', group.upper(), phases[-1].duration)
+    cnc.remember(calibration={
+        'axes': list(axes),
+        'configs': [list(config) for config in configs],
+        'durations': dict(phases)})
+    return phases
@@ -0,0 +1,165 @@
+# coding: utf-8
+"""Waiting for the end of the moves
+
+Instead of polling the controller at a fixed rate, the drivers predict when
+the queued moves will be finished from their length and speed, sleep until
+shortly before that time, and only then poll the controller, with an
+exponential backoff.
+
+>>> from pycnic.completion import estimate, Predictor, wait_for
+>>> estimate(1000, 2000)
+0.5
+>>> estimate(1000, 2000, accel=8000)
+0.75
+>>> motion = Predictor()
+>>> end = motion.add(100, 1000)
+>>> polls = []
+>>> elapsed = wait_for(lambda: polls.append(1) or True, motion.end)
+>>> time.time() >= end - MARGIN, len(polls)
+(True, 1)
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger('PyCNiC')
+
+MAXTIMEOUT = 30 # in seconds, for any move
+MARGIN = 0.02 # in seconds, polling starts this long before the predicted end
+MIN_INTERVAL = 0.005 # in seconds, first polling interval
+MAX_INTERVAL = 0.25 # in seconds, longest polling interval
+
+
+def estimate(steps, speed, accel=None, start_speed=0):
+    """Return the duration in seconds of a move of `steps` at `speed` (Hz),
+    with a trapezoidal ramp if the acceleration (steps/s²) is given.
+    """
+    steps = abs(steps)
+    if not accel:
+        return float(steps) / speed
+    ramp = (speed * speed - start_speed * start_speed) / (2.0 * accel)
+    if 2 * ramp > steps: # triangular profile
+        top = (accel * steps + start_speed * start_speed) ** 0.5
+        return 2 * (top - start_speed) / accel
+    return (2 * (speed - start_speed) / float(accel)
+            + (steps - 2 * ramp) / float(speed))
+
+
+class Predictor(object):
+    """Predicted end time of the moves queued on a controller. The end is
+    None when a move of unknown duration was queued.
+    """
+
+    def __init__(self):
+        self.end = 0
+
+    def add(self, steps, speed, accel=None, start_speed=0):
+        """Account for a new move and return the predicted end time
+        """
+        if self.end is None or steps is None or not speed:
+            self.end = None
+            return None
+        self.end = (max(time.time(), self.end)
+                    + estimate(steps, speed, accel, start_speed))
+        return self.end
+
+    def remaining(self):
+        """Return the predicted time left, in seconds, or None
+        """
+        if self.end is None:
+            return None
+        return max(0, self.end - time.time())
+
+    def reset(self):
+        """The controller is known to be idle
+        """
+        self.end = 0
+
+
+def wait_for(done, expected_end=None, timeout=MAXTIMEOUT, margin=MARGIN,
+             min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+    """Sleep until shortly before expected_end, then call done() with an
+    exponential backoff until it returns True. Return the elapsed time.
+    """
+    start = time.time()
+    deadline = start + timeout
+    if expected_end:
+        time.sleep(max(0, min(expected_end - margin, deadline) - start))
+    interval = min_interval
+    while not done():
+        if time.time() > deadline:
+            raise IOError(u'The moves did not finish in %ss' % timeout)
+        time.sleep(interval)
+        interval = min(2 * interval, max_interval)
+    return time.time() - start
+
+
+class Completion(object):
+    """Future-like object waiting in a thread for done() to return True.
+    done() must be safe to call from another thread.
+
+    >>> from threading import Event
+    >>> moved, called = Event(), Event()
+    >>> completion = Completion(moved.is_set)
+    >>> completion.add_done_callback(lambda c: called.set())
+    >>> moved.set()
+    >>> completion.result(timeout=1) < 1
+    True
+    >>> called.wait(1)
+    True
+    """
+
+    def __init__(self, done, expected_end=None, timeout=MAXTIMEOUT):
+        self._done = done
+        self._expected_end = expected_end
+        self._timeout = timeout
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._elapsed = None
+        self._error = None
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        try:
+            self._elapsed = wait_for(self._done, self._expected_end,
+                                     self._timeout)
+        except Exception, e:
+            self._error = e
+        self._lock.acquire()
+        try:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception(u'Error in a completion callback')
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the completion and return the time it took
+        """
+        if not self._event.wait(timeout):
+            raise IOError(u'The moves are not finished')
+        if self._error is not None:
+            raise self._error
+        return self._elapsed
+
+    def add_done_callback(self, callback):
+        """Call callback(completion) when done, in the waiting thread
+        """
+        self._lock.acquire()
+        try:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        callback(self)
@@ -0,0 +1,167 @@
+# coding: utf-8
+"""Priority control channel
+
+Feed hold, resume and abort must not wait behind the moves already queued on
+the host. Each driver owns a ControlChannel: a control request is first sent
+to the controller on the fast path of the driver, then the streaming loop
+drops or holds its pending moves and acknowledges the request before sending
+anything else. The latency between the request and the acknowledgement is
+measured, and the worst one is kept for each action.
+
+>>> from pycnic.control import ControlChannel, HOLD, RESUME, ABORT
+>>> sent = []
+>>> channel = ControlChannel(sent.append)
+>>> channel.request(ABORT) < 0.1
+True
+>>> sent
+['abort']
+>>> channel.stream(range(5), sent.append)
+5
+
+Run this module to benchmark the stop latency under full streaming load
+against the simulators:
+
+    python -m pycnic.control
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger('PyCNiC')
+
+HOLD = 'hold'
+RESUME = 'resume'
+ABORT = 'abort'
+TIMEOUT = 2 # in seconds, for the acknowledgement of a control request
+
+
+class ControlChannel(object):
+    """Coordinates control requests with the streaming loop of a driver.
+    `send` is called with the action and must bypass the command queue.
+    """
+
+    def __init__(self, send):
+        self._send = send
+        self._condition = threading.Condition()
+        self._pending = [] # events of the requests not acknowledged yet
+        self.held = False
+        self.aborted = False
+        self.streaming = False
+        self.worst_latency = {HOLD: 0.0, RESUME: 0.0, ABORT: 0.0}
+
+    def request(self, action, timeout=TIMEOUT):
+        """Send the control action and wait until the streaming loop has
+        taken it into account. Return the latency in seconds.
+
+        >>> channel = ControlChannel(lambda action: None)
+        >>> channel.request('jump')
+        Traceback (most recent call last):
+        ...
+        ValueError: Unknown control action
+        """
+        if action not in self.worst_latency:
+            raise ValueError(u'Unknown control action')
+        start = time.time()
+        self._send(action)
+        acknowledged = threading.Event()
+        self._condition.acquire()
+        try:
+            if action == HOLD:
+                self.held = True
+            elif action == RESUME:
+                self.held = False
+            else:
+                # an abort also ends the feed hold, or the next stream
+                # would block at its first checkpoint
+                self.held = False
+                self.aborted = True
+            if self.streaming:
+                self._pending.append(acknowledged)
+            else:
+                acknowledged.set()
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+        if not acknowledged.wait(timeout):
+            raise IOError(u'The %s request was not acknowledged' % action)
+        latency = time.time() - start
+        self.worst_latency[action] = max(self.worst_latency[action], latency)
+        logger.info(u'%s acknowledged in %.1f ms', action, latency * 1000)
+        return latency
+
+    def _acknowledge(self):
+        for event in self._pending:
+            event.set()
+        del self._pending[:]
+
+    def checkpoint(self):
+        """Called by the streaming loop before each command. Acknowledge the
+        pending requests, block during a feed hold, and return False if the
+        stream was aborted.
+        """
+        self._condition.acquire()
+        try:
+            self._acknowledge()
+            while self.held and not self.aborted:
+                self._condition.wait()
+                self._acknowledge()
+            return not self.aborted
+        finally:
+            self._condition.release()
+
+    def stream(self, records, send):
+        """Call `send` for each record until the end or an abort.
+        Return the number of records sent.
+        """
+        self._condition.acquire()
+        try:
+            if self.streaming:
+                raise IOError(u'Already streaming')
+            self.streaming = True
+            self.aborted = False
+        finally:
+            self._condition.release()
+        count = 0
+        try:
+            for record in records:
+                if not self.checkpoint():
+                    logger.warning(u'Stream aborted after %s moves', count)
+                    break
+                send(record)
+                count += 1
+        finally:
+            self._condition.acquire()
+            try:
+                self.streaming = False
+                self._acknowledge()
+            finally:
+                self._condition.release()
+        return count
+
+
+def bench_stop_latency(cnc, records, delay=0.2, trials=5):
+    """Stream the records in a thread, abort after `delay` seconds, and
+    return the list of measured abort latencies.
+    """
+    latencies = []
+    for i in range(trials):
+        thread = threading.Thread(target=cnc.stream, args=(records,))
+        thread.start()
+        time.sleep(delay)
+        latencies.append(cnc.abort())
+        thread.join()
+    return latencies
+
+
+if __name__ == '__main__':
+    from pycnic import soprolec, techlf
+    records = [(i, i, 0, 0, 0) for i in xrange(100000)]
+    # 19200 bauds, about 12 characters per move and response
+    interpcnc = soprolec.InterpCNC(port=soprolec.Simulator(latency=0.006))
+    interpcnc.abort_command = 'S' # the simulator answers it with a prompt
+    tinycn = techlf.TinyCN(handle=techlf.Simulator(latency=0.001))
+    for cnc in (interpcnc, tinycn):
+        latencies = bench_stop_latency(cnc, records)
+        print '%s: abort latency worst %.2f ms, mean %.2f ms' % (
+            cnc.__class__.__name__, max(latencies) * 1000,
+            sum(latencies) / len(latencies) * 1000)
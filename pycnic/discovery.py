@@ -0,0 +1,197 @@
+# coding: utf-8
+"""Device discovery and identity cache
+
+Candidate serial ports are probed in parallel instead of one after the
+other, and the USB busses are walked only once.
+
+The identity of a controller (name, firmware version, speed calc...) does
+not change between two connections, so it is cached by serial number and
+the drivers skip the handshake queries they already know the answer of.
+The cache lives in memory, and can be persisted in a json file:
+
+>>> import os, tempfile
+>>> from pycnic.discovery import IdentityCache
+>>> filename = tempfile.mktemp()
+>>> cache = IdentityCache(filename)
+>>> cache.set('0001', name='TinyCN', speed_calc=[1, 2])
+>>> IdentityCache(filename).get('0001') == {'name': 'TinyCN',
+...                                         'speed_calc': [1, 2]}
+True
+>>> os.remove(filename)
+"""
+from collections import namedtuple
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('PyCNiC')
+
+PROBE_TIMEOUT = 0.5 # in seconds, for each probed port
+SERIAL_PATTERNS = ('/dev/ttyUSB*', '/dev/ttyACM*', '/dev/ttyS*',
+                   '/dev/tty.usbserial*', '/dev/cu.usbserial*')
+
+Device = namedtuple('Device', 'driver address name serial')
+
+
+class IdentityCache(object):
+    """Identities of the known controllers, keyed by serial number
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename and os.path.expanduser(filename)
+        self._identities = {}
+        if self.filename and os.path.exists(self.filename):
+            cachefile = open(self.filename)
+            try:
+                self._identities = json.load(cachefile)
+            except ValueError:
+                logger.warning(u'Ignoring the corrupted %s', self.filename)
+            cachefile.close()
+
+    def __len__(self):
+        return len(self._identities)
+
+    def get(self, serial):
+        """Return a copy of the identity of the device, or None
+        """
+        identity = self._identities.get(serial)
+        return dict(identity) if identity is not None else None
+
+    def set(self, serial, **identity):
+        self._identities[serial] = identity
+        self.save()
+
+    def forget(self, serial=None):
+        """Forget one device, or all of them
+        """
+        if serial is None:
+            self._identities.clear()
+        else:
+            self._identities.pop(serial, None)
+        self.save()
+
+    def save(self):
+        if not self.filename:
+            return
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmpname = self.filename + '.tmp'
+        cachefile = open(tmpname, 'w')
+        json.dump(self._identities, cachefile)
+        cachefile.close()
+        os.rename(tmpname, self.filename)
+
+# shared by all the drivers of the process
+identities = IdentityCache()
+
+
+def serial_ports():
+    """Return the list of (port name, serial number or None) to probe
+    """
+    try:
+        from serial.tools import list_ports
+    except ImportError:
+        return [(name, None) for pattern in SERIAL_PATTERNS
+                             for name in sorted(glob.glob(pattern))]
+    return [(port[0], getattr(port, 'serial_number', None))
+            for port in list_ports.comports()]
+
+
+def usb_devices(ids):
+    """Walk the USB busses once and return the devices whose
+    (vendor id, product id) is in the list
+    """
+    import usb
+    return [device for bus in usb.busses() for device in bus.devices
+            if (device.idVendor, device.idProduct) in ids]
+
+
+def in_parallel(function, arguments, timeout=PROBE_TIMEOUT):
+    """Call function(*args) for each args of the list in its own thread,
+    and return the list of results. A call which raises an exception or does
+    not finish within the timeout gives None.
+
+    >>> in_parallel(lambda x: 10 / x, [(1,), (0,), (5,)])
+    [10, None, 2]
+    """
+    results = [None] * len(arguments)
+
+    def run(index, args):
+        try:
+            results[index] = function(*args)
+        except Exception, e:
+            logger.debug(u'    probe %s failed: %s', args, e)
+
+    threads = [threading.Thread(target=run, args=(i, args))
+               for i, args in enumerate(arguments)]
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    return list(results)
+
+
+def probe_interpcnc(port_name, baudrate=19200, timeout=PROBE_TIMEOUT):
+    """Send RI on the port and return the name of the card, or None
+    """
+    import serial
+    port = serial.Serial(port_name, baudrate, timeout=timeout)
+    try:
+        port.write('RI;')
+        port.flush()
+        deadline = time.time() + timeout
+        response = ''
+        while not response.endswith('>') and time.time() < deadline:
+            response += port.read()
+    finally:
+        port.close()
+    if response.startswith('=') and response.endswith('>'):
+        return response[1:-1]
+
+
+def _probe_serial_ports(timeout):
+    ports = serial_ports()
+    names = in_parallel(probe_interpcnc,
+                        [(port, 19200, timeout) for port, serial in ports],
+                        timeout + 0.5)
+    return [Device('InterpCNC', port, name, serial)
+            for (port, serial), name in zip(ports, names) if name]
+
+
+def discover(timeout=PROBE_TIMEOUT):
+    """Probe all the serial ports and USB devices at the same time and return
+    the list of Devices found.
+    """
+    from pycnic import soprolec, techlf
+    drivers = {
+        (techlf.VENDOR_ID, techlf.PRODUCT_ID):
+            ('TinyCN', techlf.PRODUCT_NAME),
+        (soprolec.VENDOR_ID, soprolec.PRODUCT_ID):
+            ('InterpCNC', soprolec.PRODUCT_NAME),
+    }
+    serials, usbs = in_parallel(lambda probe: probe(), [
+        (lambda: _probe_serial_ports(timeout),),
+        (lambda: usb_devices(drivers.keys()),),
+    ], timeout + 1)
+    devices = serials or []
+    for device in usbs or []:
+        driver, name = drivers[(device.idVendor, device.idProduct)]
+        devices.append(Device(driver, device, name, None))
+    logger.info(u'Found %s devices', len(devices))
+    return devices
+
+
+def find_interpcnc(timeout=PROBE_TIMEOUT):
+    """Return (port name, serial number) of the first InterpCNC answering on
+    a serial port. Raise IOError if there is none.
+    """
+    for device in _probe_serial_ports(timeout):
+        logger.info(u'found %s on %s', device.name, device.address)
+        return device.address, device.serial
+    raise IOError(u'No device found')
@@ -0,0 +1,53 @@
+# coding: utf-8
+"""Registry of the controller drivers
+
+Drivers are registered by the dotted path of their class, and their module,
+with its transport library, is only imported the first time the driver is
+used. Importing pycnic or this registry does not import serial or usb.
+
+>>> from pycnic import drivers
+>>> sorted(drivers.names())
+['arduino', 'interpcnc', 'tinycn']
+>>> drivers.get('tinycn')
+<class 'pycnic.techlf.TinyCN'>
+>>> drivers.get('mach3')
+Traceback (most recent call last):
+...
+ValueError: Unknown driver: mach3
+"""
+import importlib
+
+_registry = {
+    'interpcnc': 'pycnic.soprolec:InterpCNC',
+    'tinycn': 'pycnic.techlf:TinyCN',
+    'arduino': 'pycnic.arduino:ArduinoCNC',
+}
+
+
+def register(name, path):
+    """Register a driver class given as 'package.module:Class'
+    """
+    if ':' not in path:
+        raise ValueError(u'The path must be "module:Class"')
+    _registry[name] = path
+
+
+def names():
+    return list(_registry)
+
+
+def get(name):
+    """Import and return the class of the driver
+    """
+    try:
+        path = _registry[name]
+    except KeyError:
+        raise ValueError(u'Unknown driver: %s' % name)
+    module, cls = path.split(':')
+    return getattr(importlib.import_module(module), cls)
+
+
+def connect(name, *args, **kwargs):
+    """Instantiate the driver, which connects to the controller
+    """
+    return get(name)(*args, **kwargs)
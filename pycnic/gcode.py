@@ -0,0 +1,333 @@
+# coding: utf-8
+"""G-code compiler
+
+Convert a G-code program into toolpath records (see pycnic.toolpath): the
+target position of each move in steps and its speed in Hz. Linear moves
+(G0, G1), absolute and relative distances (G90, G91), inches and
+millimeters (G20, G21) and feed rates (F, in units per minute) are
+supported. The other G and M codes, which do not move the machine, are
+ignored.
+
+Very large programs are compiled in parallel: the file is split into
+chunks at line boundaries and a pool of processes first summarizes the
+effect of each chunk on the modal state, then compiles each chunk from the
+state left by the previous ones. The chunks are yielded in order as soon as
+they are ready, so that streaming can start before the end of the
+compilation:
+
+>>> import os, tempfile
+>>> from pycnic.gcode import compile_file, records
+>>> filename = tempfile.mktemp()
+>>> program = open(filename, 'w')
+>>> program.write('''G21 G90 (millimeters, absolute)
+... G0 X10 Y5
+... G1 X20 F600 ; feed in mm/min
+... G91 Y-5
+... G20 X1
+... ''')
+>>> program.close()
+>>> parallel = list(records(compile_file(filename, resolution=(10, 10, 10, 10),
+...                                       processes=2, chunk_size=16)))
+>>> for record in parallel:
+...     print record
+(100, 50, 0, 0, 447)
+(200, 50, 0, 0, 100)
+(200, 0, 0, 0, 100)
+(454, 0, 0, 0, 100)
+>>> parallel == list(records(compile_file(filename, (10, 10, 10, 10),
+...                                       processes=1)))
+True
+>>> os.remove(filename)
+
+To stream a program while it is compiled:
+
+    cnc.stream(records(compile_file(filename, resolution)))
+"""
+from array import array
+import logging
+import os
+import Queue
+import re
+
+logger = logging.getLogger('PyCNiC')
+
+AXES = ('X', 'Y', 'Z', 'A')
+CHUNK_SIZE = 8 * 1024 * 1024 # in bytes, of G-code compiled at once
+RAPID = 3000 # in mm/min, speed of the G0 moves
+INCH = 25.4
+
+WORD = re.compile(r'([A-Z])\s*([-+]?[0-9]*\.?[0-9]+)')
+COMMENT = re.compile(r'\([^)]*\)|;.*')
+MODES = (20, 21, 90, 91) # G codes changing how the values are read
+UNSUPPORTED = (2, 3, 92) # arcs and coordinate offsets
+
+
+def parse_line(line):
+    """Return the list of (letter, value) words of a line of G-code
+
+    >>> parse_line('N10 G1 x-1.5 (comment) Y.5 ; other comment')
+    [('N', 10.0), ('G', 1.0), ('X', -1.5), ('Y', 0.5)]
+    """
+    return [(letter, float(value)) for letter, value
+            in WORD.findall(COMMENT.sub('', line.upper()))]
+
+
+class State(object):
+    """Modal state of the machine, with the position in mm
+    """
+
+    def __init__(self, absolute=True, scale=1.0, feed=None, motion=0,
+                 position=(0.0,) * len(AXES)):
+        self.absolute = absolute
+        self.scale = scale
+        self.feed = feed
+        self.motion = motion
+        self.position = list(position)
+
+    def __repr__(self):
+        return 'State(%r, %r, %r, %r, %r)' % (
+            self.absolute, self.scale, self.feed, self.motion, self.position)
+
+    def set_mode(self, code):
+        """Apply a G code which changes the distance mode or the units
+        """
+        if code == 90:
+            self.absolute = True
+        elif code == 91:
+            self.absolute = False
+        elif code == 20:
+            self.scale = INCH
+        elif code == 21:
+            self.scale = 1.0
+
+    def execute(self, words):
+        """Apply the words of a line. Return the motion code (0 or 1) if the
+        line moves the machine, None otherwise. The G codes apply to the
+        whole line, wherever they are.
+        """
+        for letter, value in words:
+            if letter == 'G':
+                code = int(value)
+                if code in (0, 1):
+                    self.motion = code
+                elif code in MODES:
+                    self.set_mode(code)
+                elif code in UNSUPPORTED:
+                    raise ValueError(u'Unsupported G-code: G%s' % code)
+        moved = False
+        for letter, value in words:
+            if letter == 'F':
+                self.feed = value * self.scale
+            elif letter in AXES:
+                i = AXES.index(letter)
+                if self.absolute:
+                    self.position[i] = value * self.scale
+                else:
+                    self.position[i] += value * self.scale
+                moved = True
+        if moved:
+            return self.motion
+
+    def then(self, summary):
+        """Return the state after a chunk, given the summary of the chunk
+        """
+        state = State(self.absolute, self.scale, self.feed, self.motion,
+                      self.position)
+        for modes, motion, feed, last, total in summary:
+            for code in modes:
+                state.set_mode(code)
+            if motion is not None:
+                state.motion = motion
+            if feed is not None:
+                state.feed = feed * state.scale
+            for i in range(len(AXES)):
+                if not state.absolute:
+                    state.position[i] += total[i] * state.scale
+                elif last[i] is not None:
+                    state.position[i] = last[i] * state.scale
+        return state
+
+
+def read_lines(filename, start, end):
+    """Return the lines of the file between the start and end offsets
+    """
+    chunkfile = open(filename, 'rb')
+    try:
+        chunkfile.seek(start)
+        return chunkfile.read(end - start).splitlines()
+    finally:
+        chunkfile.close()
+
+
+def split(filename, chunk_size=CHUNK_SIZE):
+    """Return the list of (start, end) offsets of the chunks of the file,
+    cut after an end of line.
+    """
+    size = os.path.getsize(filename)
+    ranges = []
+    chunkfile = open(filename, 'rb')
+    try:
+        start = 0
+        while start < size:
+            chunkfile.seek(min(start + chunk_size, size))
+            chunkfile.readline() # finish the line
+            end = min(chunkfile.tell(), size)
+            ranges.append((start, end))
+            start = end
+    finally:
+        chunkfile.close()
+    return ranges
+
+
+def summarize(filename, start, end):
+    """Return the effect of a chunk on the state, without knowing the state
+    at its start: the chunk is cut at each change of distance mode or units,
+    and the list of (modes, motion, feed, last, total) of the parts is
+    returned, where `last` is the last value of each axis in the part and
+    `total` is the sum of its values.
+    """
+    summary = []
+    modes, motion, feed = (), None, None
+    last, total = [None] * len(AXES), [0.0] * len(AXES)
+    for line in read_lines(filename, start, end):
+        words = parse_line(line)
+        changes = tuple(int(value) for letter, value in words
+                        if letter == 'G' and int(value) in MODES)
+        if changes:
+            summary.append((modes, motion, feed, last, total))
+            modes, motion, feed = changes, None, None
+            last, total = [None] * len(AXES), [0.0] * len(AXES)
+        for letter, value in words:
+            if letter == 'G':
+                code = int(value)
+                if code in (0, 1):
+                    motion = code
+                elif code in UNSUPPORTED:
+                    raise ValueError(u'Unsupported G-code: G%s' % code)
+            elif letter == 'F':
+                feed = value
+            elif letter in AXES:
+                i = AXES.index(letter)
+                last[i] = value
+                total[i] += value
+    summary.append((modes, motion, feed, last, total))
+    return summary
+
+
+def compile_lines(lines, state, resolution, rapid=RAPID):
+    """Compile lines of G-code from a concrete state. Return a flat array of
+    toolpath records, and update the state.
+    """
+    values = array('i')
+    steps = [int(round(p * r)) for p, r in zip(state.position, resolution)]
+    for line in lines:
+        motion = state.execute(parse_line(line))
+        if motion is None:
+            continue
+        target = [int(round(p * r))
+                  for p, r in zip(state.position, resolution)]
+        deltas = [abs(t - s) for t, s in zip(target, steps)]
+        if not max(deltas):
+            continue
+        # the speed is the step rate of the axis doing the most steps
+        length = sum((d / float(r)) ** 2
+                     for d, r in zip(deltas, resolution)) ** 0.5
+        feed = rapid if motion == 0 else state.feed
+        speed = int(round(feed / 60.0 * max(deltas) / length)) if feed else 0
+        values.extend(target)
+        values.append(speed)
+        steps = target
+    return values
+
+
+def compile_range(filename, start, end, state, resolution, rapid=RAPID):
+    """Compile the chunk of the file between the start and end offsets
+    """
+    return compile_lines(read_lines(filename, start, end), state,
+                         resolution, rapid)
+
+
+def compile_file(filename, resolution, processes=None, rapid=RAPID,
+                 chunk_size=CHUNK_SIZE):
+    """Yield the flat arrays of toolpath records of the G-code file, in
+    order. `resolution` is the number of steps per mm of each axis.
+    With processes=1, the file is compiled in this process.
+    """
+    ranges = split(filename, chunk_size)
+    if processes == 1:
+        state = State()
+        for start, end in ranges:
+            yield compile_lines(read_lines(filename, start, end), state,
+                                resolution, rapid)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    processes = processes or multiprocessing.cpu_count()
+    try:
+        for values in _schedule(pool, 2 * processes, filename, ranges,
+                                resolution, rapid):
+            yield values
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _run(function, args):
+    """Run a task in the pool, returning its exception instead of raising
+    it, so that the result callback is always called.
+    """
+    try:
+        return function(*args), None
+    except Exception, e:
+        return None, e
+
+
+def _schedule(pool, width, filename, ranges, resolution, rapid):
+    """Keep at most `width` tasks in the pool. The compilations whose
+    starting state is known go first, so that the first chunks are ready
+    as soon as possible.
+    """
+    done = Queue.Queue()
+    results = {'summary': {}, 'compiled': {}}
+    states = [State()] # starting state of each chunk, as far as known
+    next_summary = 0
+    next_compile = 0
+    next_yield = 0
+    running = 0
+    while next_yield < len(ranges):
+        while running < width:
+            if next_compile < len(states):
+                kind, index, function = 'compiled', next_compile, compile_range
+                args = ranges[index] + (states[index], resolution, rapid)
+                next_compile += 1
+            elif next_summary < len(ranges) - 1: # the last one is useless
+                kind, index, function = 'summary', next_summary, summarize
+                args = ranges[index]
+                next_summary += 1
+            else:
+                break
+            pool.apply_async(_run, ((function, (filename,) + args)),
+                             callback=lambda result, kind=kind, index=index:
+                                 done.put((kind, index) + result))
+            running += 1
+        kind, index, result, error = done.get()
+        running -= 1
+        if error is not None:
+            raise error
+        results[kind][index] = result
+        summaries, compiled = results['summary'], results['compiled']
+        while len(states) - 1 in summaries and len(states) < len(ranges):
+            states.append(states[-1].then(summaries.pop(len(states) - 1)))
+        while next_yield in compiled:
+            yield compiled.pop(next_yield)
+            next_yield += 1
+
+
+def records(chunks):
+    """Yield the (x, y, z, a, speed) records of flat arrays of records, as
+    yielded by compile_file(), to stream them to a driver.
+    """
+    size = len(AXES) + 1
+    for values in chunks:
+        for i in xrange(0, len(values), size):
+            yield tuple(values[i:i + size])
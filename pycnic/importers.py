@@ -0,0 +1,537 @@
+# coding: utf-8
+"""SVG and DXF import
+
+Read the paths of SVG drawings and the entities of DXF drawings, flatten
+their curves into polylines within a tolerance, and convert them into
+toolpath records in steps, ready to be streamed or written to a toolpath
+file.
+
+The files are parsed incrementally: the SVG elements are dropped once their
+path is read, the DXF entities are read one at a time, and the polylines
+and records are generated on the fly, so that a very large drawing is
+imported in constant memory. Only one path is held at once.
+
+Béziers are flattened with a number of segments computed from the bound of
+the distance between the curve and its chords, and arcs from the sagitta
+of their chords; the points of a curve are then computed in one batch from
+tables of coefficients cached for each number of segments.
+
+Supported SVG elements: path (all the commands), polyline, polygon and line.
+Transforms are not applied. SVG user units are 1/96 inch and the Y axis
+points down, so the Y coordinates are negated by default: the drawing is
+then below the origin, and can be moved with the `offset` of toolpath().
+
+Supported DXF entities: LINE, LWPOLYLINE and POLYLINE (with bulges), ARC,
+CIRCLE and SPLINE (from its control points). DXF units are supposed to be
+mm.
+
+>>> from StringIO import StringIO
+>>> from pycnic.importers import svg_paths, toolpath
+>>> from pycnic.machine import MachineModel, Converter
+>>> drawing = StringIO('''<svg xmlns="http://www.w3.org/2000/svg">
+...   <path d="M 0 0 L 96 0 Q 96 96 0 96 Z"/>
+... </svg>''')
+>>> paths = list(svg_paths(drawing, tolerance=0.1))
+>>> len(paths), paths[0][:2], paths[0][-1]
+(1, [(0.0, 0.0), (25.4, 0.0)], (0.0, 0.0))
+>>> converter = Converter(MachineModel((10, 10, 10, 1)))
+>>> records = list(toolpath(paths, converter, depth=-1, clearance=5,
+...                         feed=600))
+>>> records[:4]
+[(0, 0, 50, 0, 500), (0, 0, 50, 0, 0), (0, 0, -10, 0, 100), (254, 0, -10, 0, 100)]
+>>> records[-1]
+(0, 0, 50, 0, 500)
+"""
+import logging
+import math
+import re
+
+from pycnic.gcode import RAPID
+
+logger = logging.getLogger('PyCNiC')
+
+TOLERANCE = 0.01 # in mm, greatest distance between a curve and its chords
+MM_PER_UNIT = 25.4 / 96 # SVG user unit
+BATCH = 4096 # records converted at once
+MAX_SEGMENTS = 10000 # for one curve
+
+NUMBER = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+PATH_TOKEN = re.compile(r'[MmLlHhVvCcSsQqTtAaZz]|' + NUMBER)
+NUMBERS = re.compile(NUMBER)
+
+_tables = {} # (degree, segments): Bernstein coefficients
+
+
+def _bernstein(degree, segments):
+    """Return the Bernstein coefficients of the points t = 1/n..1 of a
+    Bézier of degree 2 or 3 cut in n segments
+    """
+    key = (degree, segments)
+    if key not in _tables:
+        table = []
+        for k in xrange(1, segments + 1):
+            t = float(k) / segments
+            s = 1 - t
+            if degree == 2:
+                table.append((s * s, 2 * s * t, t * t))
+            else:
+                table.append((s * s * s, 3 * s * s * t, 3 * s * t * t,
+                              t * t * t))
+        _tables[key] = table
+    return _tables[key]
+
+
+def bezier(points, tolerance=TOLERANCE):
+    """Return the points of a quadratic or cubic Bézier, given its control
+    points, after the first one
+
+    >>> bezier([(0, 0), (1, 2), (2, 0)], tolerance=1)
+    [(2.0, 0.0)]
+    >>> len(bezier([(0, 0), (1, 2), (2, 0)], tolerance=0.01))
+    10
+    """
+    degree = len(points) - 1
+    # bound of the second differences of the control points
+    length = max(math.hypot(points[i][0] - 2 * points[i + 1][0]
+                            + points[i + 2][0],
+                            points[i][1] - 2 * points[i + 1][1]
+                            + points[i + 2][1])
+                 for i in range(degree - 1))
+    segments = int(math.ceil(math.sqrt(
+        degree * (degree - 1) / 8.0 * length / tolerance)))
+    segments = min(max(segments, 1), MAX_SEGMENTS)
+    xs = [float(p[0]) for p in points]
+    ys = [float(p[1]) for p in points]
+    if degree == 2:
+        return [(b0 * xs[0] + b1 * xs[1] + b2 * xs[2],
+                 b0 * ys[0] + b1 * ys[1] + b2 * ys[2])
+                for b0, b1, b2 in _bernstein(2, segments)]
+    return [(b0 * xs[0] + b1 * xs[1] + b2 * xs[2] + b3 * xs[3],
+             b0 * ys[0] + b1 * ys[1] + b2 * ys[2] + b3 * ys[3])
+            for b0, b1, b2, b3 in _bernstein(3, segments)]
+
+
+def arc(center, radii, rotation, start, sweep, tolerance=TOLERANCE):
+    """Return the points of an elliptic arc after its start. The angles are
+    in radians, counterclockwise for a positive sweep.
+
+    >>> [(round(x, 6), round(y, 6)) for x, y
+    ...  in arc((0, 0), (1, 1), 0, 0, math.pi, tolerance=0.3)]
+    [(0.0, 1.0), (-1.0, 0.0)]
+    """
+    radius = max(radii)
+    if tolerance < radius:
+        step = 2 * math.acos(1 - tolerance / radius)
+        segments = int(math.ceil(abs(sweep) / step))
+    else:
+        segments = 1
+    segments = min(max(segments, 1), MAX_SEGMENTS)
+    cx, cy = center
+    rx, ry = radii
+    cos_r, sin_r = math.cos(rotation), math.sin(rotation)
+    points = []
+    for k in xrange(1, segments + 1):
+        angle = start + sweep * k / segments
+        x, y = rx * math.cos(angle), ry * math.sin(angle)
+        points.append((cx + x * cos_r - y * sin_r, cy + x * sin_r + y * cos_r))
+    return points
+
+
+def _svg_arc(start, radii, rotation, large, sweep, end, tolerance):
+    """Return the points of an SVG arc, from its endpoint parameters
+    """
+    (x1, y1), (x2, y2) = start, end
+    rx, ry = abs(radii[0]), abs(radii[1])
+    if not rx or not ry:
+        return [end]
+    phi = math.radians(rotation)
+    cos_r, sin_r = math.cos(phi), math.sin(phi)
+    dx, dy = (x1 - x2) / 2.0, (y1 - y2) / 2.0
+    x1p, y1p = cos_r * dx + sin_r * dy, -sin_r * dx + cos_r * dy
+    scale = (x1p / rx) ** 2 + (y1p / ry) ** 2
+    if scale > 1:
+        rx, ry = rx * math.sqrt(scale), ry * math.sqrt(scale)
+    numerator = (rx * ry) ** 2 - (rx * y1p) ** 2 - (ry * x1p) ** 2
+    denominator = (rx * y1p) ** 2 + (ry * x1p) ** 2
+    if not denominator:
+        return [end]
+    coefficient = math.sqrt(max(numerator, 0) / denominator)
+    if large == sweep:
+        coefficient = -coefficient
+    cxp, cyp = coefficient * rx * y1p / ry, -coefficient * ry * x1p / rx
+    cx = cos_r * cxp - sin_r * cyp + (x1 + x2) / 2.0
+    cy = sin_r * cxp + cos_r * cyp + (y1 + y2) / 2.0
+    theta = math.atan2((y1p - cyp) / ry, (x1p - cxp) / rx)
+    delta = math.atan2((-y1p - cyp) / ry, (-x1p - cxp) / rx) - theta
+    if sweep and delta < 0:
+        delta += 2 * math.pi
+    elif not sweep and delta > 0:
+        delta -= 2 * math.pi
+    points = arc((cx, cy), (rx, ry), phi, theta, delta, tolerance)
+    points[-1] = end # exactly
+    return points
+
+
+def parse_path(data, tolerance=TOLERANCE):
+    """Yield the polylines of the subpaths of SVG path data
+
+    >>> list(parse_path('M1,2 h3 v-1 l-1-1 z m 10 0 10 0'))
+    [[(1.0, 2.0), (4.0, 2.0), (4.0, 1.0), (3.0, 0.0), (1.0, 2.0)], [(11.0, 2.0), (21.0, 2.0)]]
+    >>> list(parse_path('M0 0 A 1 1 0 01 2 0'))[0][-1]
+    (2.0, 0.0)
+    """
+    tokens = PATH_TOKEN.findall(data)
+    tokens.reverse() # popped from the end
+    polyline = []
+    current = start = (0.0, 0.0)
+    control = None # last control point, for the smooth curves
+    command = None
+
+    def number():
+        return float(tokens.pop())
+
+    def flag():
+        token = tokens.pop()
+        if len(token) > 1: # flags written without separator
+            tokens.append(token[1:])
+        return token[0] == '1'
+
+    def point(relative):
+        x, y = number(), number()
+        if relative:
+            return current[0] + x, current[1] + y
+        return x, y
+
+    while tokens:
+        if tokens[-1].isalpha():
+            command = tokens.pop()
+        elif command is None:
+            raise ValueError(u'Path data must start with a command')
+        relative = command.islower()
+        kind = command.upper()
+        previous, control = control, None
+        if kind == 'M':
+            if len(polyline) > 1:
+                yield polyline
+            current = start = point(relative)
+            polyline = [current]
+            command = 'l' if relative else 'L' # implicit lines
+            continue
+        if kind == 'Z':
+            if current != start:
+                polyline.append(start)
+            if len(polyline) > 1:
+                yield polyline
+            current = start
+            polyline = [current]
+            command = None
+            continue
+        if kind == 'L':
+            points = [point(relative)]
+        elif kind == 'H':
+            x = number()
+            points = [(current[0] + x if relative else x, current[1])]
+        elif kind == 'V':
+            y = number()
+            points = [(current[0], current[1] + y if relative else y)]
+        elif kind in 'CS':
+            if kind == 'C':
+                first = point(relative)
+            elif previous is not None and previous[1] in 'CS':
+                first = (2 * current[0] - previous[0][0],
+                         2 * current[1] - previous[0][1])
+            else:
+                first = current
+            second, end = point(relative), point(relative)
+            points = bezier([current, first, second, end], tolerance)
+            control = (second, kind)
+        elif kind in 'QT':
+            if kind == 'Q':
+                middle = point(relative)
+            elif previous is not None and previous[1] in 'QT':
+                middle = (2 * current[0] - previous[0][0],
+                          2 * current[1] - previous[0][1])
+            else:
+                middle = current
+            end = point(relative)
+            points = bezier([current, middle, end], tolerance)
+            control = (middle, kind)
+        elif kind == 'A':
+            radii = number(), number()
+            rotation = number()
+            large, sweep = flag(), flag()
+            end = point(relative)
+            points = _svg_arc(current, radii, rotation, large, sweep, end,
+                              tolerance)
+        else:
+            raise ValueError(u'Unknown path command: %s' % command)
+        polyline.extend(points)
+        current = points[-1]
+    if len(polyline) > 1:
+        yield polyline
+
+
+def _points(text):
+    values = [float(value) for value in NUMBERS.findall(text or '')]
+    return zip(values[0::2], values[1::2])
+
+
+def svg_paths(source, tolerance=TOLERANCE, scale=MM_PER_UNIT, flip=True):
+    """Yield the polylines of an SVG file or file-like object, in mm
+    """
+    from xml.etree import cElementTree
+    sy = -scale if flip else scale
+    root = None
+    for event, element in cElementTree.iterparse(source, ('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            continue
+        tag = element.tag.rsplit('}', 1)[-1]
+        polylines = []
+        if tag == 'path':
+            polylines = parse_path(element.get('d', ''), tolerance / scale)
+        elif tag in ('polyline', 'polygon'):
+            points = _points(element.get('points'))
+            if tag == 'polygon' and points:
+                points.append(points[0])
+            polylines = [points]
+        elif tag == 'line':
+            polylines = [[(float(element.get(x, 0)), float(element.get(y, 0)))
+                          for x, y in (('x1', 'y1'), ('x2', 'y2'))]]
+        for polyline in polylines:
+            if len(polyline) > 1:
+                yield [(x * scale + 0.0, y * sy + 0.0) for x, y in polyline]
+        element.clear()
+        if tag != 'svg' and root is not None:
+            root.clear() # drop the elements already read
+
+
+def _dxf_pairs(source):
+    """Yield the (group code, value) pairs of a DXF file
+    """
+    lines = iter(source)
+    for code in lines:
+        if not code.strip():
+            continue
+        value = next(lines, '')
+        yield int(code), value.strip()
+
+
+def _dxf_entities(source):
+    """Yield the (type, list of (code, value)) of the entities of the
+    ENTITIES section of a DXF file, one at a time
+    """
+    section = None
+    entity, codes = None, []
+    for code, value in _dxf_pairs(source):
+        if code == 0:
+            if entity is not None and section == 'ENTITIES':
+                yield entity, codes
+            entity, codes = value, []
+            if value == 'ENDSEC':
+                section = None
+            continue
+        if entity == 'SECTION' and code == 2:
+            section = value
+            entity = None
+            continue
+        codes.append((code, value))
+    if entity is not None and section == 'ENTITIES':
+        yield entity, codes
+
+
+def _bulge(start, end, bulge, tolerance):
+    """Return the points of the arc of a polyline vertex with a bulge, the
+    tangent of a quarter of its angle
+    """
+    if not bulge:
+        return [end]
+    angle = 4 * math.atan(bulge)
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    chord = math.hypot(dx, dy)
+    if not chord:
+        return [end]
+    radius = chord / (2 * math.sin(angle / 2))
+    distance = radius * math.cos(angle / 2) # from the chord to the center
+    center = ((start[0] + end[0]) / 2.0 - dy / chord * distance,
+              (start[1] + end[1]) / 2.0 + dx / chord * distance)
+    first = math.atan2(start[1] - center[1], start[0] - center[0])
+    points = arc(center, (abs(radius),) * 2, 0, first, angle, tolerance)
+    points[-1] = end
+    return points
+
+
+def _vertices(vertices, closed, tolerance):
+    """Return the polyline of (x, y, bulge) vertices
+    """
+    if closed and vertices:
+        vertices = vertices + [vertices[0]]
+    polyline = [vertices[0][:2]] if vertices else []
+    for (x1, y1, bulge), (x2, y2, ignored) in zip(vertices, vertices[1:]):
+        polyline.extend(_bulge((x1, y1), (x2, y2), bulge, tolerance))
+    return polyline
+
+
+def _spline(degree, knots, controls, weights, tolerance):
+    """Return the points of a NURBS curve, evaluated with the de Boor
+    algorithm on each span of the knots
+    """
+    knots = [float(knot) for knot in knots]
+    homogeneous = [(float(x) * w, float(y) * w, float(w))
+                   for (x, y), w in zip(controls, weights)]
+    second = max([math.hypot(controls[i][0] - 2 * controls[i + 1][0]
+                             + controls[i + 2][0],
+                             controls[i][1] - 2 * controls[i + 1][1]
+                             + controls[i + 2][1])
+                  for i in range(len(controls) - 2)] or [0])
+    segments = int(math.ceil(math.sqrt(
+        degree * (degree - 1) / 8.0 * second / tolerance))) if second else 1
+    segments = min(max(segments, 1), MAX_SEGMENTS)
+
+    def point(span, u):
+        d = [homogeneous[j + span - degree] for j in range(degree + 1)]
+        for r in range(1, degree + 1):
+            for j in range(degree, r - 1, -1):
+                low = knots[j + span - degree]
+                width = knots[j + 1 + span - r] - low
+                alpha = (u - low) / width if width else 0.0
+                d[j] = tuple((1 - alpha) * a + alpha * b
+                             for a, b in zip(d[j - 1], d[j]))
+        x, y, w = d[degree]
+        return x / w, y / w
+
+    polyline = [point(degree, knots[degree])]
+    for span in range(degree, len(controls)):
+        low, high = knots[span], knots[span + 1]
+        if high <= low:
+            continue
+        for k in xrange(1, segments + 1):
+            polyline.append(point(span, low + (high - low) * k / segments))
+    return polyline
+
+
+def dxf_paths(source, tolerance=TOLERANCE):
+    """Yield the polylines of the entities of a DXF file or file-like
+    object
+
+    >>> from StringIO import StringIO
+    >>> drawing = StringIO('\\n'.join(['0', 'SECTION', '2', 'ENTITIES',
+    ...     '0', 'LINE', '10', '0', '20', '0', '11', '10', '21', '0',
+    ...     '0', 'LWPOLYLINE', '70', '0', '10', '0', '20', '0', '42', '1',
+    ...     '10', '10', '20', '0', '0', 'ENDSEC', '0', 'EOF']))
+    >>> paths = list(dxf_paths(drawing, tolerance=0.5))
+    >>> paths[0]
+    [(0.0, 0.0), (10.0, 0.0)]
+    >>> [(round(x, 6), round(y, 6)) for x, y in paths[1]]
+    [(0.0, 0.0), (1.464466, -3.535534), (5.0, -5.0), (8.535534, -3.535534), (10.0, 0.0)]
+    """
+    polyline = None # of the POLYLINE entity being read
+    for entity, codes in _dxf_entities(source):
+        values = {}
+        for code, value in codes:
+            values.setdefault(code, []).append(value)
+
+        def number(code, default=0.0):
+            return float(values.get(code, [default])[0])
+
+        if entity == 'LINE':
+            yield [(number(10), number(20)), (number(11), number(21))]
+        elif entity == 'LWPOLYLINE':
+            vertices = []
+            for code, value in codes:
+                if code == 10:
+                    vertices.append([float(value), 0.0, 0.0])
+                elif code == 20 and vertices:
+                    vertices[-1][1] = float(value)
+                elif code == 42 and vertices:
+                    vertices[-1][2] = float(value)
+            points = _vertices([tuple(v) for v in vertices],
+                               int(number(70)) & 1, tolerance)
+            if len(points) > 1:
+                yield points
+        elif entity == 'POLYLINE':
+            polyline = ([], int(number(70)) & 1)
+        elif entity == 'VERTEX' and polyline is not None:
+            polyline[0].append((number(10), number(20), number(42)))
+        elif entity == 'SEQEND' and polyline is not None:
+            points = _vertices(polyline[0], polyline[1], tolerance)
+            polyline = None
+            if len(points) > 1:
+                yield points
+        elif entity in ('ARC', 'CIRCLE'):
+            center, radius = (number(10), number(20)), number(40)
+            start = math.radians(number(50))
+            sweep = 2 * math.pi
+            if entity == 'ARC':
+                sweep = (math.radians(number(51)) - start) % (2 * math.pi)
+            first = (center[0] + radius * math.cos(start),
+                     center[1] + radius * math.sin(start))
+            yield [first] + arc(center, (radius, radius), 0, start, sweep,
+                                tolerance)
+        elif entity == 'SPLINE':
+            controls = zip([float(x) for x in values.get(10, [])],
+                           [float(y) for y in values.get(20, [])])
+            if not controls:
+                # only fit points
+                controls = zip([float(x) for x in values.get(11, [])],
+                               [float(y) for y in values.get(21, [])])
+                if len(controls) > 1:
+                    yield controls
+                continue
+            degree = int(number(71, 3))
+            knots = [float(knot) for knot in values.get(40, [])]
+            weights = [float(w) for w in values.get(41, [])]
+            if len(weights) != len(controls):
+                weights = [1.0] * len(controls)
+            if len(knots) != len(controls) + degree + 1:
+                logger.warning(u'Skipping a spline with inconsistent knots')
+                continue
+            yield _spline(degree, knots, controls, weights, tolerance)
+
+
+def toolpath(polylines, converter, depth, clearance, feed, rapid=RAPID,
+             offset=(0.0, 0.0)):
+    """Yield the (x, y, z, a, speed) records in steps of the polylines in
+    mm: each one is cut at the `depth` Z at `feed` mm/min, and the tool
+    travels between them at the `clearance` Z, at `rapid` mm/min. The
+    records are converted in batches by the machine.Converter.
+    """
+    batch = []
+    position = None
+    ox, oy = offset
+    for polyline in polylines:
+        x, y = polyline[0]
+        x, y = x + ox, y + oy
+        if position != (x, y):
+            if position is None:
+                batch.append((0.0, 0.0, clearance, 0.0, rapid))
+            else:
+                batch.append(position + (clearance, 0.0, rapid))
+            batch.append((x, y, clearance, 0.0, rapid))
+            batch.append((x, y, depth, 0.0, feed))
+        for x, y in polyline[1:]:
+            batch.append((x + ox, y + oy, depth, 0.0, feed))
+        position = batch[-1][:2]
+        if len(batch) >= BATCH:
+            for record in converter.records(batch):
+                yield record
+            batch = []
+    if position is not None:
+        batch.append(position + (clearance, 0.0, rapid))
+    for record in converter.records(batch):
+        yield record
+
+
+def import_file(filename, converter, depth, clearance, feed,
+                tolerance=TOLERANCE, **options):
+    """Yield the toolpath records of an SVG or DXF file, by extension
+    """
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension == 'svg':
+        polylines = svg_paths(open(filename, 'rb'), tolerance)
+    elif extension == 'dxf':
+        polylines = dxf_paths(open(filename, 'rU'), tolerance)
+    else:
+        raise ValueError(u'Unsupported drawing format: %s' % extension)
+    return toolpath(polylines, converter, depth, clearance, feed, **options)
@@ -0,0 +1,272 @@
+# coding: utf-8
+"""Job scheduler
+
+A Scheduler runs the jobs of one machine by priority. A job is a sequence
+of toolpath records (see pycnic.toolpath) streamed to the driver, and the
+index of the last record acknowledged by the controller is recorded while
+it runs:
+
+- between two records, a job is preempted if a job of higher priority was
+  submitted, and resumed where it stopped afterwards;
+- if the link to the controller drops, the driver is closed and
+  reconnected, the machine is homed again, and the job resumes from the
+  last acknowledged record instead of restarting;
+- before resuming, the tool is raised to the clearance height, moved above
+  the last acknowledged record, and lowered to its Z, so that it does not
+  cut through the stock on its way back;
+- the checkpoints of the interrupted jobs can be persisted in a json file,
+  so that a job submitted again with the same name resumes where it
+  stopped, even after a restart of the program.
+
+>>> from pycnic.jobs import Scheduler, Job
+>>> from pycnic.soprolec import InterpCNC, Simulator
+>>> class FlakySimulator(Simulator):
+...     failures = 1
+...     def write(self, data):
+...         if data.startswith('LX5') and FlakySimulator.failures:
+...             FlakySimulator.failures -= 1
+...             raise IOError(u'Could not write to the device')
+...         return Simulator.write(self, data)
+>>> ports = []
+>>> def connect():
+...     ports.append(FlakySimulator())
+...     return InterpCNC(port=ports[-1])
+>>> scheduler = Scheduler(connect, home=lambda cnc: cnc.reset_all_axis())
+>>> job = scheduler.submit(Job('drill', [(i, 0, 0, 0, 0) for i in range(10)]))
+>>> scheduler.run()
+>>> job.state, job.next, job.interruptions
+('done', 10, 1)
+>>> [c[:3] for c in ports[1].commands if c.startswith('L')]
+['LZ0', 'LX4', 'LZ0', 'LX4', 'LX5', 'LX6', 'LX7', 'LX8', 'LX9']
+>>> ports[0].fd is None
+True
+"""
+from collections import namedtuple
+import heapq
+import itertools
+import logging
+import threading
+from pycnic.discovery import IdentityCache
+
+logger = logging.getLogger('PyCNiC')
+
+RETRIES = 3 # reconnections for a job before it fails
+CHECKPOINT_EVERY = 1000 # records between two persisted checkpoints
+
+# job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+ABORTED = 'aborted'
+FAILED = 'failed'
+
+Checkpoint = namedtuple('Checkpoint', 'next position')
+
+
+class CheckpointStore(IdentityCache):
+    """Checkpoints of the interrupted jobs, keyed by job name, in memory or
+    persisted in a json file
+    """
+
+    def checkpoint(self, name):
+        """Return the Checkpoint of the job, or None
+        """
+        values = self.get(name)
+        if values is not None:
+            return Checkpoint(values['next'], values['position'])
+
+
+class Job(object):
+    """A named sequence of (x, y, z, a, speed) records. The higher the
+    priority, the sooner the job runs.
+    """
+
+    def __init__(self, name, records, priority=0):
+        self.name = name
+        self.records = records
+        self.priority = priority
+        self.next = 0 # index of the first record not acknowledged
+        self.state = QUEUED
+        self.interruptions = 0
+        self.error = None
+
+    @property
+    def position(self):
+        """Target of the last acknowledged record, or None
+        """
+        if self.next > 0:
+            return tuple(self.records[self.next - 1][:4])
+
+    def __repr__(self):
+        return '<Job %s priority=%s %s %s/%s>' % (
+            self.name, self.priority, self.state, self.next,
+            len(self.records))
+
+
+class Scheduler(object):
+    """Run jobs on one machine. `connect` returns a connected driver, and
+    `home` is called with it after each connection. `clearance` is the Z,
+    in steps, where the tool moves freely above the stock.
+    """
+
+    def __init__(self, connect, home=None, store=None, retries=RETRIES,
+                 clearance=0):
+        self.connect = connect
+        self.home = home
+        self.store = store if store is not None else CheckpointStore()
+        self.retries = retries
+        self.clearance = clearance
+        self.cnc = None
+        self.running = None
+        self._queue = []
+        self._counter = itertools.count() # first in, first out
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """Queue the job, resuming it from its checkpoint if it has one.
+        Return the job.
+        """
+        checkpoint = self.store.checkpoint(job.name)
+        if checkpoint is not None:
+            logger.info(u'Job %s resumes at record %s', job.name,
+                        checkpoint.next)
+            job.next = checkpoint.next
+        job.state = QUEUED
+        self._lock.acquire()
+        try:
+            heapq.heappush(self._queue,
+                           (-job.priority, next(self._counter), job))
+        finally:
+            self._lock.release()
+        return job
+
+    def _pop(self):
+        """Return the next job, or None
+        """
+        self._lock.acquire()
+        try:
+            if not self._queue:
+                return None
+            return heapq.heappop(self._queue)[2]
+        finally:
+            self._lock.release()
+
+    def _preempted(self, job):
+        self._lock.acquire()
+        try:
+            return bool(self._queue) and -self._queue[0][0] > job.priority
+        finally:
+            self._lock.release()
+
+    def run(self):
+        """Run the queued jobs until there is none left. A job submitted
+        while another one runs preempts it if its priority is higher:
+
+        >>> from pycnic.soprolec import InterpCNC, Simulator
+        >>> scheduler = Scheduler(lambda: InterpCNC(port=Simulator()))
+        >>> urgent = [Job('urgent', [(0, 0, 10, 0, 0)], priority=1)]
+        >>> class Engraving(list):
+        ...     def __getitem__(self, index):
+        ...         if index == 3 and urgent:
+        ...             scheduler.submit(urgent.pop())
+        ...         return list.__getitem__(self, index)
+        >>> job = scheduler.submit(Job('engraving',
+        ...                            Engraving((i, 0, 0) for i in range(5))))
+        >>> scheduler.run()
+        >>> [c for c in scheduler.cnc.port.commands if c.startswith('L')]
+        ['LX0Y0Z0', 'LX1Y0Z0', 'LX2Y0Z0', 'LX3Y0Z0', 'LZ10X0Y0', 'LZ0', 'LX3Y0', 'LZ0', 'LX3Y0Z0', 'LX4Y0Z0']
+        """
+        while True:
+            job = self._pop()
+            if job is None:
+                return
+            self._run(job)
+
+    def _checkpoint(self, job):
+        self.store.set(job.name, next=job.next, position=job.position)
+
+    def _feed(self, job, start):
+        """Yield the records of the job from `start`, and record the
+        acknowledgements: the stream asks for a record once the previous
+        one was sent and acknowledged.
+        """
+        for index in xrange(start, len(job.records)):
+            if self._preempted(job):
+                return
+            yield job.records[index]
+            job.next = max(job.next, index + 1)
+            if not job.next % CHECKPOINT_EVERY:
+                self._checkpoint(job)
+
+    def _connect(self):
+        self.cnc = self.connect()
+        if not self.cnc.name:
+            raise IOError(u'The device is not connected')
+        if self.home is not None:
+            self.home(self.cnc)
+
+    def _disconnect(self):
+        """Close the driver, to release its port and its I/O thread before
+        connecting again
+        """
+        cnc, self.cnc = self.cnc, None
+        if cnc is None:
+            return
+        try:
+            if hasattr(cnc, 'disconnect'):
+                cnc.disconnect()
+            else:
+                cnc.off() # techlf.TinyCN
+        except Exception, e:
+            logger.warning(u'Could not close the driver: %s', e)
+
+    def _approach(self, job):
+        """Bring the tool back to the last acknowledged record of the job
+        from wherever it is: up to the clearance, above the record, then
+        down to its Z
+        """
+        x, y, z = job.position[:3]
+        self.cnc.move(z=self.clearance)
+        self.cnc.move(x=x, y=y)
+        self.cnc.move(z=z)
+
+    def _run(self, job):
+        self.running = job
+        job.state = RUNNING
+        attempts = 0
+        # after homing, the last acknowledged record brings the machine
+        # back where the job stopped
+        start = max(job.next - 1, 0)
+        try:
+            while True:
+                try:
+                    if self.cnc is None:
+                        self._connect()
+                    if start > 0:
+                        self._approach(job)
+                    self.cnc.stream(self._feed(job, start))
+                    break
+                except IOError, e:
+                    logger.warning(u'Job %s interrupted at record %s: %s',
+                                   job.name, job.next, e)
+                    self._checkpoint(job)
+                    job.interruptions += 1
+                    self._disconnect()
+                    attempts += 1
+                    if attempts > self.retries:
+                        job.state, job.error = FAILED, e
+                        return
+                    start = max(job.next - 1, 0)
+            if job.next >= len(job.records):
+                job.state = DONE
+                self.store.forget(job.name)
+            elif self.cnc.control.aborted:
+                job.state = ABORTED
+                self._checkpoint(job)
+            else:
+                logger.info(u'Job %s preempted at record %s',
+                            job.name, job.next)
+                self._checkpoint(job)
+                self.submit(job)
+        finally:
+            self.running = None
@@ -0,0 +1,189 @@
+# coding: utf-8
+"""Continuous jogging
+
+Jogging with one blocking move per key press ramps from zero each time,
+and lags behind the operator. A Jogger instead follows a velocity vector,
+in steps/s, which the input can change at any time from a callback, or
+which is read from an iterator of input events. It sends short constant
+speed segments, and keeps only a short horizon of them queued on the
+controller, so that a change of the velocity reaches the machine within
+that horizon.
+
+When a moving axis stops or reverses, the queued segments are cancelled
+with an abort of the driver, if it stops the controller (an InterpCNC with
+an abort_command), and the jog restarts from the position where the
+machine stopped. An abort which only drops the moves not sent yet would
+leave the queued segments running while the position is read.
+
+The latency from each change of the input to the predicted start of the
+first segment which follows it is measured.
+
+>>> import time
+>>> from pycnic.soprolec import InterpCNC, Simulator
+>>> from pycnic.jog import Jogger
+>>> cnc = InterpCNC(port=Simulator())
+>>> cnc.reset_all_axis()
+>>> def joystick():
+...     yield (2000, 0, -1000)
+...     time.sleep(0.2)
+...     yield (0, 0, 0)
+>>> jogger = Jogger(cnc, period=0.01, horizon=0.03)
+>>> jogger.cancel
+False
+>>> jogger.follow(joystick())
+>>> 300 <= cnc.x <= 520, cnc.x == -2 * cnc.z
+(True, True)
+>>> [c for c in cnc.port.commands if c.startswith('L')][0]
+'LLX20Z-10V2000'
+>>> len(jogger.latencies), jogger.worst_latency < 0.1
+(2, True)
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger('PyCNiC')
+
+PERIOD = 0.02 # in seconds, duration of a jog segment
+HORIZON = 0.06 # in seconds, of segments queued ahead of the machine
+AXES = ('x', 'y', 'z')
+
+
+class Jogger(object):
+    """Jog a driver with move(x, y, z, speed, ramp), starting from
+    `position` in steps, or from the position read from the driver.
+    By default, the queued segments are only cancelled if the driver has
+    an abort_command to stop the controller.
+    """
+
+    def __init__(self, cnc, period=PERIOD, horizon=HORIZON, position=None,
+                 cancel=None):
+        self.cnc = cnc
+        self.period = period
+        self.horizon = max(horizon, period)
+        self.position = position
+        if cancel is None:
+            cancel = getattr(cnc, 'abort_command', None) is not None
+        self.cancel = cancel
+        self.latencies = [] # in seconds, of each change of the velocity
+        self.worst_latency = 0.0
+        self._velocity = (0,) * len(AXES)
+        self._changed = None # time of the change not followed yet
+        self._cancelled = False
+        self._running = False
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def set_velocity(self, x=0, y=0, z=0):
+        """Set the velocity of each axis, in steps/s. Any thread can call
+        it, like the callback of an input device.
+        """
+        velocity = (x, y, z)
+        self._condition.acquire()
+        try:
+            if velocity == self._velocity:
+                return
+            previous, self._velocity = self._velocity, velocity
+            self._changed = time.time()
+            if self.cancel and any(p and v * p <= 0
+                                   for p, v in zip(previous, velocity)):
+                self._cancelled = True # stopped or reversed
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def start(self):
+        """Start jogging in a thread, at zero velocity
+        """
+        if self.position is None:
+            self.position = [getattr(self.cnc, axis) for axis in AXES]
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='PyCNiC jog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Set the velocity to zero and stop the thread once the queued
+        segments are sent
+        """
+        self.set_velocity()
+        self._condition.acquire()
+        try:
+            self._running = False
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        self._thread.join()
+
+    def follow(self, events):
+        """Jog with the (x, y, z) velocities of an iterator of input events,
+        until the end of the events
+        """
+        self.start()
+        try:
+            for velocity in events:
+                self.set_velocity(*velocity)
+        finally:
+            self.stop()
+
+    def _resync(self):
+        """Cancel the queued segments and restart from the actual position
+        """
+        self.cnc.abort()
+        self.cnc.resume()
+        self.position = [getattr(self.cnc, axis) for axis in AXES]
+
+    def _run(self):
+        exact = [float(p) for p in self.position]
+        end = time.time() # predicted end of the queued segments
+        while True:
+            self._condition.acquire()
+            try:
+                now = time.time()
+                velocity = self._velocity
+                ahead = end - now
+                idle = not any(velocity) and not self._cancelled
+                if idle and self._changed is not None:
+                    # stopped once the queued segments are done
+                    self._measure(self._changed, now, end)
+                    self._changed = None
+                if idle and not self._running:
+                    return
+                if idle or ahead > self.horizon - self.period:
+                    self._condition.wait(
+                        self.period if idle else ahead - self.horizon
+                        + self.period)
+                    continue
+                changed, self._changed = self._changed, None
+                cancelled, self._cancelled = self._cancelled, False
+            finally:
+                self._condition.release()
+            if cancelled:
+                self._resync()
+                exact = [float(p) for p in self.position]
+                end = now = time.time()
+                if not any(velocity):
+                    self._measure(changed, now, now)
+                    continue
+            end = max(end, now)
+            targets = {}
+            for i, axis in enumerate(AXES):
+                if velocity[i]:
+                    exact[i] += velocity[i] * self.period
+                    targets[axis] = int(round(exact[i]))
+            self.cnc.move(speed=int(round(max(abs(v) for v in velocity))),
+                          ramp=False, **targets)
+            self.position = [int(round(p)) for p in exact]
+            self._measure(changed, time.time(), end)
+            end += self.period
+
+    def _measure(self, changed, sent, start):
+        """Record the latency from the change of the input at `changed` to
+        the start of the segment sent at `sent`, predicted at `start`
+        """
+        if changed is None:
+            return
+        latency = max(sent, start) - changed
+        self.latencies.append(latency)
+        self.worst_latency = max(self.worst_latency, latency)
+        logger.debug(u'Jog latency %.1f ms', latency * 1000)
@@ -0,0 +1,149 @@
+# coding: utf-8
+"""Machine model: conversion of toolpaths in mm to steps
+
+A MachineModel holds the conversion of each axis of one machine
+configuration, as declared by a techlf.Motor and Tool: the resolution of
+the axis, its micro-stepping and the gear ratio of the tool give the number
+of steps per mm, the inversion flag gives the direction, and the backlash
+is the play of the axis when it reverses, in mm.
+
+A Converter turns whole toolpaths in mm into toolpath records in steps, in
+one pass over the records. The positions are rounded from the exact
+absolute position, so the fractional steps are carried from one segment to
+the next instead of being truncated on each segment. When an axis reverses,
+the backlash is added to the moves in the new direction.
+
+To stream a toolpath in mm to a TinyCN:
+
+    converter = Converter(model(tiny.motor, tiny.tool))
+    tiny.stream(list(converter.records(records)))
+
+>>> from pycnic.techlf import Motor, Tool
+>>> from pycnic.machine import model, Converter
+>>> motor = Motor()
+>>> motor.res_x, motor.res_y, motor.micro_step = 10, 10, 2
+>>> motor.inv_y = True
+>>> motor.backlash_x = 0.1
+>>> converter = Converter(model(motor, Tool()))
+>>> list(converter.records([(1.04, 1, 0, 0, 600), (1.08, 2, 0, 0, 0),
+...                         (0.5, 2, 0, 0, 600)]))
+[(21, -20, 0, 0, 146), (22, -40, 0, 0, 0), (8, -40, 0, 0, 241)]
+>>> model(motor, Tool()) is converter.model
+True
+"""
+from array import array
+import logging
+import math
+
+from pycnic.toolpath import AXES, FIELDS
+
+logger = logging.getLogger('PyCNiC')
+
+_models = {} # MachineModel of each configuration
+
+
+class MachineModel(object):
+    """Steps per mm, direction (1 or -1) and backlash in mm of each axis
+    """
+
+    def __init__(self, scales, signs=(1,) * len(AXES),
+                 backlash=(0.0,) * len(AXES)):
+        self.scales = tuple(float(scale) for scale in scales)
+        self.signs = tuple(signs)
+        self.backlash = tuple(float(play) for play in backlash)
+
+    def __repr__(self):
+        return 'MachineModel(%r, %r, %r)' % (self.scales, self.signs,
+                                             self.backlash)
+
+    def speed(self, feed, axis='x'):
+        """Return the step rate in Hz of the axis moving at `feed` mm/min
+
+        >>> MachineModel((80, 80, 400, 10)).speed(600, 'z')
+        4000
+        """
+        return int(round(feed / 60.0 * self.scales[AXES.index(axis)]))
+
+
+def configuration(motor, tool):
+    """Return the conversion parameters declared by a Motor and a Tool
+    """
+    micro_step = motor.micro_step or 1
+    ratio = float(tool.numerateur) / tool.denominateur
+    scales, signs, backlash = [], [], []
+    for axis in AXES:
+        resolution = getattr(motor, 'res_' + axis)
+        scales.append((resolution or 0) * micro_step * ratio)
+        signs.append(-1 if getattr(motor, 'inv_' + axis) else 1)
+        backlash.append(getattr(motor, 'backlash_' + axis) or 0.0)
+    return tuple(scales), tuple(signs), tuple(backlash)
+
+
+def model(motor, tool):
+    """Return the MachineModel of a Motor and a Tool, built once for each
+    configuration
+    """
+    key = configuration(motor, tool)
+    if key not in _models:
+        _models[key] = MachineModel(*key)
+    return _models[key]
+
+
+class Converter(object):
+    """Convert toolpaths in mm into toolpaths in steps. The position and the
+    direction of each axis are kept from one call to the next, so that a
+    long toolpath can be converted in chunks.
+    """
+
+    def __init__(self, model, position=(0.0,) * len(AXES)):
+        self.model = model
+        self.position = list(position) # in mm, last target
+        self.directions = [0] * len(AXES) # of the last move of each axis
+        self.steps = [self._steps(i, p) for i, p in enumerate(position)]
+
+    def _steps(self, i, position):
+        offset = -self.model.backlash[i] if self.directions[i] < 0 else 0.0
+        return self.model.signs[i] * int(math.floor(
+            (position + offset) * self.model.scales[i] + 0.5))
+
+    def convert(self, records):
+        """Convert (x, y, z, a, feed) records, in mm and mm/min, into a flat
+        array of (x, y, z, a, speed) toolpath records, in steps and Hz. A
+        feed of 0 or None keeps the current speed.
+        """
+        values = array('i')
+        axes = range(len(AXES))
+        scales, signs = self.model.scales, self.model.signs
+        backlash = self.model.backlash
+        position, directions, steps = self.position, self.directions, \
+            self.steps
+        for record in records:
+            length = 0.0
+            most = 0
+            for i in axes:
+                target = record[i]
+                delta = target - position[i]
+                if delta:
+                    length += delta * delta
+                    directions[i] = 1 if delta > 0 else -1
+                    offset = -backlash[i] if directions[i] < 0 else 0.0
+                    target_steps = signs[i] * int(math.floor(
+                        (target + offset) * scales[i] + 0.5))
+                    most = max(most, abs(target_steps - steps[i]))
+                    steps[i] = target_steps
+                    position[i] = target
+            feed = record[len(AXES)] if len(record) > len(AXES) else None
+            speed = 0
+            if feed and length:
+                speed = int(round(feed / 60.0 * most / math.sqrt(length)))
+            values.extend(steps)
+            values.append(speed)
+        return values
+
+    def records(self, records):
+        """Yield the converted (x, y, z, a, speed) records
+        """
+        values = self.convert(records)
+        size = len(FIELDS)
+        for i in xrange(0, len(values), size):
+            yield tuple(values[i:i + size])
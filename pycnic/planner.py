@@ -0,0 +1,122 @@
+# coding: utf-8
+"""Motion planner
+
+Turn a sequence of absolute step targets into relative segments with a
+trapezoidal speed profile, so that a controller can chain them without
+stopping at each point. Speeds are in steps/s and accelerations in steps/s²
+of the axis doing the most steps in the segment, which is what the step
+generator of the Arduino firmware uses.
+
+The speed at the junction of two segments depends on the angle between them,
+and a lookahead window makes sure the machine can always stop at the end of
+the planned moves.
+
+>>> from pycnic.planner import plan
+>>> for segment in plan([(1000, 0, 0), (2000, 0, 0), (2000, 1000, 0)],
+...                     speed=4000, accel=20000, start_speed=200):
+...     print segment
+Segment(dx=1000, dy=0, dz=0, entry=200, cruise=4000, exit=4000, accel=20000, accel_until=399, decel_after=1000)
+Segment(dx=1000, dy=0, dz=0, entry=4000, cruise=4000, exit=200, accel=20000, accel_until=0, decel_after=601)
+Segment(dx=0, dy=1000, dz=0, entry=200, cruise=4000, exit=200, accel=20000, accel_until=399, decel_after=601)
+"""
+from collections import namedtuple
+import math
+
+Segment = namedtuple('Segment', 'dx dy dz entry cruise exit accel '
+                                'accel_until decel_after')
+
+LOOKAHEAD = 32 # number of segments considered before emitting one
+
+
+def profile(length, entry, cruise, exit, accel):
+    """Return (accel_until, decel_after) step indexes of a trapezoidal
+    profile, or a triangular one if the cruise speed cannot be reached.
+
+    >>> profile(1000, 0, 1000, 0, 1000)
+    (500, 500)
+    >>> profile(1000, 0, 100, 0, 1000)
+    (5, 995)
+    """
+    if accel <= 0:
+        return 0, length
+    up = (cruise * cruise - entry * entry) / (2.0 * accel)
+    down = (cruise * cruise - exit * exit) / (2.0 * accel)
+    if up + down > length:
+        up = (2.0 * accel * length + exit * exit - entry * entry) / (4 * accel)
+        up = min(max(up, 0), length)
+        down = length - up
+    return int(up), int(length - down)
+
+
+def _junction(previous, current, cruise, start_speed):
+    """Maximum speed when going from the previous to the current direction
+    """
+    if previous is None:
+        return start_speed
+    dot = sum(a * b for a, b in zip(previous, current))
+    norms = math.sqrt(sum(a * a for a in previous) *
+                      sum(b * b for b in current))
+    cosine = dot / norms if norms else 0
+    return max(start_speed, cruise * cosine)
+
+
+def _solve(blocks, entry, start_speed, accel):
+    """Backward then forward pass over the window. The last block ends at
+    start_speed, so that the machine can always stop.
+    Return the list of (entry, exit) speeds.
+    """
+    exits = [0] * len(blocks)
+    limit = start_speed
+    for i in range(len(blocks) - 1, -1, -1):
+        length, cruise, junction = blocks[i][1:4]
+        exits[i] = limit
+        limit = min(junction, cruise,
+                    math.sqrt(limit * limit + 2.0 * accel * length))
+    speeds = []
+    for i, block in enumerate(blocks):
+        length, cruise = block[1:3]
+        entry = min(entry, cruise)
+        exit = min(exits[i], cruise,
+                   math.sqrt(entry * entry + 2.0 * accel * length))
+        speeds.append((entry, exit))
+        entry = exit
+    return speeds
+
+
+def _segment(block, entry, exit, accel):
+    delta, length, cruise = block[0:3]
+    entry, exit = int(entry), int(exit)
+    return Segment(*(tuple(delta) + (entry, int(cruise), exit, accel)
+                     + profile(length, entry, cruise, exit, accel)))
+
+
+def plan(targets, speed, accel, start=(0, 0, 0), start_speed=200,
+         lookahead=LOOKAHEAD):
+    """Yield the Segments going through the (x, y, z) targets, in steps.
+    A target may have a fourth value overriding the speed of its segment.
+    """
+    position = list(start)
+    direction = None
+    blocks = [] # (delta, length, cruise, junction)
+    entry = start_speed
+    for target in targets:
+        delta = [int(target[i]) - position[i] for i in range(3)]
+        length = max(abs(d) for d in delta)
+        if length == 0:
+            continue
+        position = [int(t) for t in target[:3]]
+        cruise = target[3] if len(target) > 3 and target[3] else speed
+        blocks.append((delta, length, cruise,
+                       _junction(direction, delta, cruise, start_speed)))
+        direction = delta
+        if len(blocks) > lookahead:
+            # the first half of the window is final
+            emitted = len(blocks) // 2
+            speeds = _solve(blocks, entry, start_speed, accel)
+            for block, (block_entry, exit) in zip(blocks[:emitted], speeds):
+                yield _segment(block, block_entry, exit, accel)
+            entry = speeds[emitted - 1][1]
+            del blocks[:emitted]
+    for block, (block_entry, exit) in zip(
+            blocks, _solve(blocks, entry, start_speed, accel)):
+        yield _segment(block, block_entry, exit, accel)
@@ -0,0 +1,147 @@
+# coding: utf-8
+"""Pre-flight validation of toolpaths
+
+Check a whole toolpath against the travel of each axis and the maximum speed
+of the machine before streaming it, instead of discovering the problem when
+the controller stops in the middle of the job.
+
+>>> from pycnic.preflight import Envelope, validate
+>>> envelope = Envelope(x=(0, 1000), y=(0, 500), speed=8000)
+>>> validate([(10, 10, 0, 0, 500), (20, 600, 0, 0, 9000)], envelope)
+[Violation(index=1, field='y', value=600, limit=500), Violation(index=1, field='speed', value=9000, limit=8000)]
+>>> validate([(10, 10, 0, 0, 500)], envelope)
+[]
+"""
+from collections import namedtuple
+import array
+import logging
+
+from pycnic.toolpath import AXES, FIELDS, CHUNK
+
+logger = logging.getLogger('PyCNiC')
+
+Violation = namedtuple('Violation', 'index field value limit')
+
+
+class Envelope(object):
+    """The allowed (min, max) travel of each axis in steps, and the maximum
+    speed in Hz. None means unlimited.
+    """
+
+    def __init__(self, x=None, y=None, z=None, a=None, speed=None):
+        self.x, self.y, self.z, self.a = x, y, z, a
+        self.speed = speed
+
+    def __repr__(self):
+        return '<%s.%s x=%s y=%s z=%s a=%s speed=%s>' % (
+                self.__module__,
+                self.__class__.__name__,
+                self.x, self.y, self.z, self.a, self.speed)
+
+    @classmethod
+    def from_interpcnc(cls, cnc):
+        """Build the envelope of an InterpCNC from its EEPROM parameters.
+        The machine is supposed to be homed, so the travel starts at zero,
+        and goes toward the negative steps if the home sensor is searched
+        in the positive direction (EE_ORIGINE_<axis>SENS = 1).
+
+        >>> from pycnic.soprolec import InterpCNC, Simulator
+        >>> cnc = InterpCNC(port=Simulator())
+        >>> cnc.params['EE_ORIGINE_YSENS'] = 1
+        >>> envelope = Envelope.from_interpcnc(cnc)
+        >>> envelope.x, envelope.y
+        ((0, 40000), (-40000, 0))
+        """
+        travel = {}
+        for axis in AXES:
+            name = axis.upper()
+            course = int(cnc.params['EE_MAX_COURSE_' + name])
+            if course <= 0:
+                continue
+            if int(cnc.params['EE_ORIGINE_%sSENS' % name]):
+                travel[axis] = (-course, 0)
+            else:
+                travel[axis] = (0, course)
+        return cls(speed=cnc.max_linear_speed, **travel)
+
+    @classmethod
+    def from_motor(cls, motor, speed=None):
+        """Build the envelope from the table dimensions (mm) and resolution
+        (step/mm) of a techlf.Motor
+
+        >>> from pycnic.techlf import Motor
+        >>> motor = Motor()
+        >>> motor.dim_x, motor.res_x = 300, 200
+        >>> Envelope.from_motor(motor, speed=5000).x
+        (0, 60000)
+        """
+        travel = {}
+        for axis in AXES:
+            dim = getattr(motor, 'dim_' + axis)
+            res = getattr(motor, 'res_' + axis)
+            if dim is not None and res is not None:
+                travel[axis] = (0, int(dim * res))
+        return cls(speed=speed, **travel)
+
+    def limits(self):
+        """Return a list of (column, name, min, max) to check
+        """
+        limits = []
+        for column, axis in enumerate(AXES):
+            travel = getattr(self, axis)
+            if travel is not None:
+                limits.append((column, axis, travel[0], travel[1]))
+        if self.speed is not None:
+            limits.append((len(AXES), 'speed', None, self.speed))
+        return limits
+
+
+def _chunks(toolpath):
+    """Yield (first segment index, flat array of int) from a Toolpath or any
+    sequence of records
+    """
+    if hasattr(toolpath, 'chunks'):
+        for chunk in toolpath.chunks():
+            yield chunk
+        return
+    start, values = 0, array.array('i')
+    for index, record in enumerate(toolpath):
+        values.extend(record)
+        if index - start + 1 == CHUNK:
+            yield start, values
+            start, values = index + 1, array.array('i')
+    if values:
+        yield start, values
+
+
+def validate(toolpath, envelope):
+    """Check every segment of the toolpath against the envelope in a single
+    pass, and return the list of violations ordered by segment index.
+
+    The bounding box of each chunk is computed first, and only the columns
+    which leave the envelope are scanned segment by segment.
+
+    >>> envelope = Envelope(x=(0, 100))
+    >>> validate([(50, 0, 0, 0, 0), (-1, 0, 0, 0, 0), (101, 0, 0, 0, 0)],
+    ...          envelope)
+    [Violation(index=1, field='x', value=-1, limit=0), Violation(index=2, field='x', value=101, limit=100)]
+    """
+    width = len(FIELDS)
+    limits = envelope.limits()
+    violations = []
+    for start, values in _chunks(toolpath):
+        for column, name, low, high in limits:
+            col = values[column::width]
+            low_ok = low is None or min(col) >= low
+            high_ok = high is None or max(col) <= high
+            if low_ok and high_ok:
+                continue
+            for i, value in enumerate(col):
+                if low is not None and value < low:
+                    violations.append(Violation(start + i, name, value, low))
+                elif high is not None and value > high:
+                    violations.append(Violation(start + i, name, value, high))
+    violations.sort(key=lambda v: v.index) # stable: keeps the field order
+    if violations:
+        logger.warning(u'%s segments out of the envelope', len(violations))
+    return violations
@@ -0,0 +1,197 @@
+# coding: utf-8
+"""Surface probing and Z compensation
+
+For PCB and engraving work, the height of the surface is probed on a grid
+and the Z of the toolpath follows it.
+
+The grid is probed adaptively: the surface is first probed at the corners
+of coarse cells, and a cell is only split in four when the height measured
+at its center differs from the one interpolated from its corners by more
+than the tolerance. Flat regions are thus probed coarsely, and the other
+points of the fine grid are interpolated.
+
+The resulting HeightMap is a regular grid, in steps, which can be saved and
+loaded, and the compensation is applied to toolpath records as they are
+streamed. Long moves are split at the grid spacing, so that they follow
+the surface between the probed points.
+
+>>> from pycnic.probing import probe_grid, compensate
+>>> probed = []
+>>> def probe(x, y):
+...     probed.append((x, y))
+...     return x // 10 if x > 40 else 0 # flat, then a slope
+>>> heights = probe_grid(probe, (0, 0), (80, 80), spacing=10, levels=2,
+...                      tolerance=1)
+>>> heights.columns, heights.rows, len(probed)
+(9, 9, 41)
+>>> heights.height(55, 0), heights.height(0, 80)
+(5.5, 0.0)
+>>> list(compensate([(80, 0, -10, 0, 500)], heights, start=(0, 0, -10)))
+[(10, 0, -10, 0, 500), (20, 0, -10, 0, 500), (30, 0, -10, 0, 500), (40, 0, -10, 0, 500), (50, 0, -5, 0, 500), (60, 0, -4, 0, 500), (70, 0, -3, 0, 500), (80, 0, -2, 0, 500)]
+"""
+from array import array
+import json
+import logging
+import math
+
+logger = logging.getLogger('PyCNiC')
+
+
+class HeightMap(object):
+    """Heights of the surface, in steps, on a regular grid starting at
+    `origin` with `spacing` steps between two points
+    """
+
+    def __init__(self, origin, spacing, columns, rows, heights=None):
+        self.origin = tuple(origin)
+        self.spacing = spacing
+        self.columns = columns
+        self.rows = rows
+        if heights is None:
+            heights = [0.0] * (columns * rows)
+        self.heights = array('d', heights)
+
+    def __getitem__(self, point):
+        i, j = point
+        return self.heights[j * self.columns + i]
+
+    def __setitem__(self, point, height):
+        i, j = point
+        self.heights[j * self.columns + i] = height
+
+    def height(self, x, y):
+        """Return the bilinear interpolation of the height at (x, y). The
+        heights of the border are used outside of the map.
+        """
+        u = min(max((x - self.origin[0]) / float(self.spacing), 0),
+                self.columns - 1)
+        v = min(max((y - self.origin[1]) / float(self.spacing), 0),
+                self.rows - 1)
+        i = min(int(u), self.columns - 2) if self.columns > 1 else 0
+        j = min(int(v), self.rows - 2) if self.rows > 1 else 0
+        u, v = u - i, v - j
+        heights, index = self.heights, j * self.columns + i
+        h00 = heights[index]
+        h10 = heights[index + 1] if u else h00
+        h01 = heights[index + self.columns] if v else h00
+        h11 = heights[index + self.columns + 1] if u and v else (
+              h10 if u else h01)
+        return ((h00 * (1 - u) + h10 * u) * (1 - v)
+                + (h01 * (1 - u) + h11 * u) * v)
+
+    def save(self, filename):
+        output = open(filename, 'w')
+        try:
+            json.dump({'origin': self.origin, 'spacing': self.spacing,
+                       'columns': self.columns, 'rows': self.rows,
+                       'heights': self.heights.tolist()}, output)
+        finally:
+            output.close()
+
+    @classmethod
+    def load(cls, filename):
+        """Load a height map saved with save()
+
+        >>> import os, tempfile
+        >>> filename = tempfile.mktemp()
+        >>> HeightMap((0, 0), 10, 2, 1, [1, 2]).save(filename)
+        >>> HeightMap.load(filename).height(5, 0)
+        1.5
+        >>> os.remove(filename)
+        """
+        data = open(filename)
+        try:
+            values = json.load(data)
+        finally:
+            data.close()
+        return cls(values['origin'], values['spacing'], values['columns'],
+                   values['rows'], values['heights'])
+
+
+def probe_grid(probe, start, end, spacing, levels=2, tolerance=0):
+    """Probe the rectangle between the start and end (x, y) corners with
+    probe(x, y), which returns the height at this point, in steps. The
+    coarse cells are 2**levels times the spacing of the returned HeightMap.
+    """
+    size = 2 ** levels
+    cells = [int(math.ceil((end[k] - start[k]) / float(spacing * size)))
+             for k in (0, 1)]
+    heights = HeightMap(start, spacing, cells[0] * size + 1,
+                        cells[1] * size + 1)
+    measured = set()
+
+    def measure(i, j):
+        if (i, j) not in measured:
+            heights[i, j] = probe(start[0] + i * spacing,
+                                  start[1] + j * spacing)
+            measured.add((i, j))
+        return heights[i, j]
+
+    def refine(i, j, size):
+        corners = [measure(i, j), measure(i + size, j),
+                   measure(i, j + size), measure(i + size, j + size)]
+        if size == 1:
+            return
+        half = size // 2
+        center = measure(i + half, j + half)
+        if abs(center - sum(corners) / 4.0) <= tolerance:
+            # flat enough, interpolate the points which were not probed
+            for b in range(size + 1):
+                for a in range(size + 1):
+                    if (i + a, j + b) not in measured:
+                        u, v = a / float(size), b / float(size)
+                        heights[i + a, j + b] = (
+                            (corners[0] * (1 - u) + corners[1] * u) * (1 - v)
+                            + (corners[2] * (1 - u) + corners[3] * u) * v)
+            return
+        for b in (0, half):
+            for a in (0, half):
+                refine(i + a, j + b, half)
+
+    for row in range(cells[1]):
+        for column in range(cells[0]):
+            refine(column * size, row * size, size)
+    logger.info(u'Probed %s points out of %s', len(measured),
+                heights.columns * heights.rows)
+    return heights
+
+
+class Prober(object):
+    """probe(x, y) function for probe_grid using a driver: raise to the
+    clearance height, move above the point and probe down to `depth`.
+    """
+
+    def __init__(self, cnc, clearance, depth, speed=None):
+        self.cnc = cnc
+        self.clearance = clearance
+        self.depth = depth
+        self.speed = speed
+
+    def __call__(self, x, y):
+        self.cnc.move(z=self.clearance)
+        self.cnc.move(x=x, y=y)
+        return self.cnc.probe('z', self.depth, self.speed)
+
+
+def compensate(records, heights, start=None):
+    """Yield the (x, y, z, a, speed) records with the height of the surface
+    added to z. The moves longer than the spacing of the height map are
+    split, starting from the `start` position or from the first record.
+    """
+    spacing = float(heights.spacing)
+    height = heights.height
+    previous = start
+    for record in records:
+        x, y, z = record[:3]
+        rest = tuple(record[3:])
+        if previous is not None:
+            dx, dy, dz = x - previous[0], y - previous[1], z - previous[2]
+            pieces = int(math.hypot(dx, dy) / spacing)
+            for k in xrange(1, pieces):
+                t = k / float(pieces)
+                px, py = previous[0] + dx * t, previous[1] + dy * t
+                yield ((int(round(px)), int(round(py)),
+                        int(round(previous[2] + dz * t + height(px, py))))
+                       + rest)
+        yield (x, y, int(round(z + height(x, y)))) + rest
+        previous = (x, y, z)
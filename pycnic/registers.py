@@ -0,0 +1,73 @@
+# coding: utf-8
+"""Cache of the controller registers
+
+Drivers remember the last value acknowledged for each settable register of
+the controller, and skip the writes which would not change anything. The
+cache must be invalidated whenever the state of the controller is unknown:
+on connection, after an error or an abort.
+
+>>> from pycnic.registers import RegisterCache
+>>> sent = []
+>>> cache = RegisterCache()
+>>> cache.write('speed', 500, lambda: sent.append(500))
+True
+>>> cache.write('speed', 500, lambda: sent.append(500))
+False
+>>> sent, cache.sent, cache.saved
+([500], 1, 1)
+>>> cache.invalidate()
+>>> cache.write('speed', 500, lambda: sent.append(500))
+True
+"""
+import logging
+
+logger = logging.getLogger('PyCNiC')
+
+
+class RegisterCache(object):
+    """Last known value of each register, with counters of the writes sent
+    and of the round trips saved.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self.sent = 0
+        self.saved = 0
+
+    def __contains__(self, register):
+        return register in self._values
+
+    def get(self, register, default=None):
+        return self._values.get(register, default)
+
+    def update(self, register, value):
+        """Record a value read from, or set as a side effect on, the
+        controller
+        """
+        self._values[register] = value
+
+    def write(self, register, value, send):
+        """Call send() unless the register already holds the value.
+        Return True if the write was sent. If send() fails, the whole state
+        of the controller is considered unknown.
+        """
+        if register in self._values and self._values[register] == value:
+            self.saved += 1
+            logger.debug(u'    %s is already %s', register, value)
+            return False
+        try:
+            send()
+        except Exception:
+            self.invalidate()
+            raise
+        self._values[register] = value
+        self.sent += 1
+        return True
+
+    def invalidate(self, register=None):
+        """Forget one register, or all of them
+        """
+        if register is None:
+            self._values.clear()
+        else:
+            self._values.pop(register, None)
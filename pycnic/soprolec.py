@@ -1,23 +1,33 @@
 # coding: utf-8
 """Module supporting Soprolec controllers
 See soprolec.txt
+
+The serial and usb libraries are only imported when connecting.
 """
 from UserDict import UserDict
 import logging
 import os
 import pycnic
-import serial
-import usb
+import re
+import threading
 import time
+from pycnic import discovery
+from pycnic.actor import IOActor, serialized
+from pycnic.completion import Predictor, Completion, estimate, wait_for
+from pycnic.control import ControlChannel, HOLD, RESUME, ABORT
+from pycnic.registers import RegisterCache
+from pycnic.stateboard import control_flags
+from pycnic.tracing import FlightRecorder, WRITE, READ, event
 
 logger = logging.getLogger('PyCNiC')
-logging.basicConfig(level=logging.INFO)
 
 TIMEOUT = 2 # in seconds, for serial port reads or writes
 MAXTIMEOUT = 30 # in seconds, for any move command
 VENDOR_ID = 0x067b
 PRODUCT_ID = 0x2303
 PRODUCT_NAME = u'serial to usb converter'
+HOMING_TIMEOUT = 10 # in seconds, when the homing parameters are unknown
+CALIBRATION_PARAMS = ('EE_FDC_ORIGINE', 'EE_ORIGINE_', 'EE_MAX_COURSE_')
 
 def tuple2hex(tup):
     """Converts a data tuple of integers to its hex representation
@@ -40,13 +50,34 @@ class InterpCNC(object):
     _paramlist = None
     params = None
     port = None # serial
+    serial_number = None # of the usb to serial converter, if known
+    identities = discovery.identities
     handle = None # usb
     device = None # usb
     _speed = None
+    _stale_prompts = 0 # prompts answering control commands
     configfile = 'soprolec.csv'
-
-    def __init__(self, speed=1000):
+    # stop command of the firmware, sent without waiting, and the number of
+    # prompts answering it. It is not documented: set it for your card,
+    # otherwise abort only drops the moves not sent yet.
+    abort_command = None
+    abort_prompts = 1
+    # the card can calibrate several axis at once with one H command. It is
+    # not documented: set it for your card, otherwise the axes are homed one
+    # after the other.
+    concurrent_homing = False
+    board = None # stateboard.StateBoard where the state is published
+    _done = 0 # moves sent by the current stream
+
+    def __init__(self, speed=1000, port=None):
         self._speed = speed
+        self.port = port
+        self.control = ControlChannel(self._send_control)
+        self.registers = RegisterCache()
+        self.motion = Predictor()
+        self.recorder = FlightRecorder()
+        self.actor = IOActor()
+        self._targets = dict.fromkeys('xyz') # last commanded positions
         try:
             self.connect()
         except IOError:
@@ -109,14 +140,22 @@ class InterpCNC(object):
     #
     # Lowlevel methods
     #
-    def connect(self, serial_port=0):
+    def connect(self, serial_port=None):
+        """Connect to the card. If no serial port is given, all the serial
+        ports are probed at once and the first one with a card is used.
+        """
+        import serial
         # first try the serial port
         if (self.port is None
             or self.port.fd is None
-            or not self.name):
+            or not self.name and isinstance(self.port, serial.Serial)):
+            self.serial_number = None
+            if serial_port is None:
+                serial_port, self.serial_number = discovery.find_interpcnc()
             self.port = serial.Serial(serial_port,
                                       self.serial_speed,
                                       timeout=TIMEOUT)
+            self.registers.invalidate()
         if self.port.fd is not None:
             self.name = self.execute('RI')
             self.speed = self._speed
@@ -125,6 +164,7 @@ class InterpCNC(object):
         else:
             self.port = None
         # otherwise try the usb port
+            import usb
             busses = usb.busses()
             # try to find the device
             self.device = None
@@ -157,6 +197,8 @@ class InterpCNC(object):
 
 
     def disconnect(self):
+        self.actor.close()
+        self.registers.invalidate()
         # serial
         if self.port is not None and self.port.fd is not None:
             self.port.flush()
@@ -185,16 +227,23 @@ class InterpCNC(object):
                 size = 1
                 buffer = self.handle.bulkRead(0x83, size, TIMEOUT)
                 response += buffer
+            if response == self.prompt and self._stale_prompts:
+                # this is the answer to a control command
+                self._stale_prompts -= 1
+                response = ''
             if time.time() - time1 > 0.9 * timeout:
+                self.recorder.record(READ, response)
                 raise IOError(u'Could not read from the device')
                 break
 
+        self.recorder.record(READ, response)
         return response
 
     def _write(self, command):
         """Write a command to the controller.
         """
-        logger.debug(u'    we write the command %s...' % command)
+        logger.debug(u'    we write the command %s...', command)
+        self.recorder.record(WRITE, command)
         time1 = time.time()
 
         if self.port is not None: # serial
@@ -202,7 +251,7 @@ class InterpCNC(object):
             self.port.flush()
         elif self.handle is not None: # usb
             bytes = self.handle.bulkWrite(0x02, command, TIMEOUT)
-            logger.debug(u'    %s bytes written' % bytes)
+            logger.debug(u'    %s bytes written', bytes)
 
         if time.time() - time1 > TIMEOUT:
             raise IOError(u'Could not write to the device')
@@ -211,20 +260,72 @@ class InterpCNC(object):
         """execute a command by sending it to the controller,
         and returning its response.
         The result should be interpreted by the caller.
+        Any thread can execute commands: they are sent one after the other
+        by the actor of the driver, and the identical read commands waiting
+        at the same time share one round trip.
         """
+        key = command if command[:1] == 'R' else None # no side effect
+        return self.actor.call(self._execute, (command, timeout), key=key)
+
+    def _execute(self, command, timeout=None):
         if not self.name and command != 'RI':
             raise IOError(u'The device is not connected')
-        if command.startswith('H'):
-            timeout = 10 # the card does not respond while calibrating
+        if command[:1] in ('H', 'P', 'T') and timeout is None:
+            # the card does not respond while calibrating or probing
+            timeout = self._homing_timeout(
+                re.match('[XYZA]*', command[1:]).group())
         command += ';'
-        logger.debug(u'Executing command: %s' % command)
-        self._write(command)
-        response = self._read(timeout=timeout)
+        event('execute', command=command)
+        try:
+            self._write(command)
+            response = self._read(timeout=timeout)
+        except IOError, e:
+            # we don't know what the card has received
+            self.registers.invalidate()
+            self.recorder.fault(e)
+            raise
         if response.startswith('=') and response.endswith(self.prompt):
             return response[1:-1]
         else:
             return ''
 
+    def _homing_timeout(self, axes):
+        """Longest time the calibration of the axes can take: the whole
+        course at the fast homing speed, and some more for the way back.
+        It is never shorter than a read of the serial port, which _read
+        would take as a timeout.
+
+        >>> cnc = InterpCNC(port=Simulator())
+        >>> cnc._homing_timeout('X')
+        31.0
+        >>> cnc.params['EE_MAX_COURSE_Z'] = 100
+        >>> cnc._homing_timeout('Z')
+        4
+        """
+        if not axes:
+            return HOMING_TIMEOUT
+        try:
+            speed = int(self.params['EE_ORIGINE_SPEED_RAPIDE'])
+            course = max(int(self.params['EE_MAX_COURSE_' + axis])
+                         for axis in axes)
+        except (ValueError, IOError, NotImplementedError):
+            return HOMING_TIMEOUT
+        if speed <= 0:
+            return HOMING_TIMEOUT
+        return max(1.5 * estimate(course, speed) + 1, 2 * TIMEOUT)
+
+    def _send_control(self, action):
+        """Send a control command right away, even if another thread is
+        waiting for the response of a command. Feed hold and resume are
+        handled on the host: the card finishes its current move.
+        """
+        if action == ABORT and self.abort_command is not None:
+            self.registers.invalidate()
+            self._targets = dict.fromkeys('xyz')
+            self.motion.reset()
+            self._stale_prompts += self.abort_prompts
+            self._write(self.abort_command + ';')
+
     def _eeprom_read(self, param):
         """Read a parameter in the EEPROM
 
@@ -236,23 +337,83 @@ class InterpCNC(object):
             param = [p for p in self.paramlist if p['name']==param][0]
         except:
             raise ValueError(u'This config does not exist')
-        return self.execute('RP'+ param['num'])
-
+        key = 'RP' + param['num']
+        if key in self.registers:
+            self.registers.saved += 1
+            return self.registers.get(key)
+        value = self.execute(key)
+        self.registers.update(key, value)
+        return value
+
+    @serialized
     def _eeprom_write(self, param, value):
         """write a parameter into the EEPROM
-        This should probably not be abused to save the EEPROM.
+        This should probably not be abused to save the EEPROM,
+        so the value is not written again if the card already has it.
+
+        >>> cnc = InterpCNC(port=Simulator())
+        >>> cnc.params['EE_DEFAULT_SPEED'] = 1200
+        >>> cnc.params['EE_DEFAULT_SPEED'] = 1200
+        >>> cnc.params['EE_DEFAULT_SPEED']
+        '1200'
+        >>> [c for c in cnc.port.commands if c.startswith('WP')]
+        ['WP3V1200']
         """
         try:
             param = [p for p in self.paramlist if p['name']==param][0]
         except:
             raise ValueError(u'This config does not exist')
-        return self.execute('WP' + param['num'] + 'V' + str(value))
+        key = 'RP' + param['num']
+        written = self.registers.write(key, str(value), lambda: self.execute(
+            'WP' + param['num'] + 'V' + str(value)))
+        if written and param['name'].startswith(CALIBRATION_PARAMS):
+            self.remember(calibration=None)
 
 
     #
     # Informative commands
     #
 
+    def _identity(self, command):
+        """Return the response of a query about a constant of the card, from
+        the identity cache if the card is already known.
+
+        >>> cnc = InterpCNC(port=Simulator())
+        >>> cnc.firmware_major, cnc.firmware_major
+        (3, 3)
+        >>> cnc.port.commands.count('RVH')
+        1
+        """
+        identity = self._known_identity()[1]
+        if command not in identity:
+            identity[command] = self.execute(command)
+            self.remember(**{command: identity[command]})
+        return identity[command]
+
+    def _known_identity(self):
+        """Return the key of the card in the identity cache, by serial number
+        or port name, and its identity, which is reset if another card is
+        now behind the same key
+        """
+        key = self.serial_number or getattr(self.port, 'port', None)
+        identity = key and self.identities.get(key) or {}
+        if identity.get('name') != self.name:
+            identity = {'name': self.name}
+        return key, identity
+
+    def remember(self, **values):
+        """Store values about this card in the identity cache
+        """
+        key, identity = self._known_identity()
+        identity.update(values)
+        if key:
+            self.identities.set(key, **identity)
+
+    def recall(self, name):
+        """Return a value stored with remember(), or None
+        """
+        return self._known_identity()[1].get(name)
+
     @property
     def firmware_major(self):
         """Get the major firmware version number
@@ -260,7 +421,7 @@ class InterpCNC(object):
         >>> InterpCNC().firmware_major
         3
         """
-        return int(self.execute('RVH'))
+        return int(self._identity('RVH'))
 
     @property
     def firmware_minor(self):
@@ -269,7 +430,7 @@ class InterpCNC(object):
         >>> InterpCNC().firmware_minor > 0
         True
         """
-        return int(self.execute('RVL'))
+        return int(self._identity('RVL'))
 
     @property
     def bootloader_major(self):
@@ -278,7 +439,7 @@ class InterpCNC(object):
         >>> InterpCNC().bootloader_major
         1
         """
-        return int(self.execute('RVBH'))
+        return int(self._identity('RVBH'))
 
     @property
     def bootloader_minor(self):
@@ -287,7 +448,7 @@ class InterpCNC(object):
         >>> InterpCNC().bootloader_minor >= 0
         True
         """
-        return int(self.execute('RVBL'))
+        return int(self._identity('RVBL'))
 
     @property
     def max_linear_speed(self):
@@ -296,7 +457,7 @@ class InterpCNC(object):
         >>> 10000 < InterpCNC().max_linear_speed < 90000
         True
         """
-        return int(self.execute('RVML'))
+        return int(self._identity('RVML'))
 
     @property
     def max_circular_speed(self):
@@ -305,11 +466,12 @@ class InterpCNC(object):
         >>> 10000 < InterpCNC().max_circular_speed < 90000
         True
         """
-        return int(self.execute('RVMC'))
+        return int(self._identity('RVMC'))
 
     #
     # linear moves
     #
+    @serialized
     def move(self, x=None, y=None, z=None, speed=None, ramp=True):
         """Move specified axis to specified step using a ramp or not
 
@@ -332,14 +494,18 @@ class InterpCNC(object):
         >>> cnc.x, cnc.y, cnc.z
         (0, 0, 0)
 
-        int are converted to floats
+        floats are rounded to the nearest step
 
         >>> cnc.move(x=10.2)
         >>> cnc.x, cnc.y, cnc.z
         (10, 0, 0)
+        >>> cnc.move(x=9.8)
+        >>> cnc.x, cnc.y, cnc.z
+        (10, 0, 0)
 
 
-        We can specify the speed of the move
+        We can specify the speed of the move. It only applies to this move,
+        the speed of the next ones is still cnc.speed.
 
         >>> cnc.move(x=200, speed=500)
         >>> cnc.move(x=0, speed=2000)
@@ -375,24 +541,193 @@ class InterpCNC(object):
         values = [('X',x), ('Y',y), ('Z',z)]
         # the card wants the biggest move to be at the left.
         values.sort(key=lambda x:x[1], reverse=True)
-        command += ''.join([val[0] + str(int(val[1])) for val in values if val[1] is not None])
+        command += ''.join([val[0] + str(int(round(val[1]))) for val in values if val[1] is not None])
 
-        # add the speed
-        if speed is not None:
+        # add the speed, unless the card already uses it
+        if speed is not None and speed != self.registers.get('VV'):
             command += 'V' + str(speed)
 
         self.execute(command)
+        self._predict(speed, x=x, y=y, z=z)
+
+    def _predict(self, speed=None, **targets):
+        """Account for a move to the targets, at the speed or the current
+        one, in the predicted end time. The length of the move is unknown
+        until the position of each moved axis is known.
+        """
+        steps = 0
+        for axis, value in targets.items():
+            if value is None:
+                continue
+            value = int(round(value))
+            previous = self._targets[axis]
+            if steps is not None and previous is not None:
+                steps = max(steps, abs(value - previous))
+            else:
+                steps = None
+            self._targets[axis] = value
+        self.motion.add(steps, speed or self._speed)
+        self._publish()
+
+    def _publish(self, **state):
+        """Publish the commanded position, the stream progress and the
+        given fields on the state board, if any. Nothing is asked to the
+        card.
+        """
+        if self.board is None:
+            return
+        for axis, value in self._targets.items():
+            if value is not None:
+                state[axis] = value
+        self.board.publish(flags=control_flags(self.control),
+                           done=self._done, **state)
+
+    def stream(self, records):
+        """Move through a sequence of (x, y, z[, a[, speed]]) records, such as
+        a toolpath.Toolpath, and return the number of moves sent. The stream
+        can be held, resumed or aborted from another thread.
+
+        >>> cnc = InterpCNC(port=Simulator())
+        >>> cnc.stream([(10, 0, 0, 0, 500), (10, 20, 0, 0, 0)])
+        2
+        >>> cnc.x, cnc.y
+        (10, 20)
+        """
+        self._done = 0
+        self._publish(total=len(records) if hasattr(records, '__len__') else 0)
+        try:
+            return self.control.stream(records, self._stream_record)
+        finally:
+            self._publish()
+
+    def _stream_record(self, record):
+        speed = record[4] if len(record) > 4 and record[4] else None
+        self._done += 1
+        self.move(x=record[0], y=record[1], z=record[2], speed=speed)
+
+    def feed_hold(self):
+        """Stop sending moves after the current one.
+        Return the latency of the acknowledgement.
+        """
+        latency = self.control.request(HOLD)
+        self._publish()
+        return latency
+
+    def resume(self):
+        """Resume the stream after a feed hold
+        """
+        latency = self.control.request(RESUME)
+        self._publish()
+        return latency
+
+    def abort(self):
+        """Stop the machine and drop the remaining moves of the stream.
+        The card is only stopped if abort_command is set.
+
+        >>> cnc = InterpCNC(port=Simulator())
+        >>> cnc.abort() < 0.1
+        True
+        >>> 'S' in cnc.port.commands
+        False
+        >>> cnc.abort_command = 'S'
+        >>> cnc.abort() < 0.1
+        True
+        >>> cnc.port.commands[-1]
+        'S'
+        """
+        latency = self.control.request(ABORT)
+        self._publish()
+        return latency
 
     def wait(self, time=None):
         """tell the controller to wait during <time> seconds. If time is not provided, wait until the
         controller is available.
         """
         if time is None:
+            # sleep until the predicted end of the moves instead of
+            # blocking on the serial port
+            wait_for(lambda: True, self.motion.end, MAXTIMEOUT)
             self.execute('RX', timeout=MAXTIMEOUT)
+            self.motion.reset()
         if time > 0:
             self.execute('WD' + str(10*time), timeout=MAXTIMEOUT)
 
 
+    @serialized
+    def home(self, axes, timeout=None):
+        """Move the axes to their home sensor and reset them to zero. When
+        concurrent_homing is True, the axes are calibrated at the same time
+        with one command. See pycnic.calibration for a full routine.
+
+        >>> cnc = InterpCNC(port=Simulator())
+        >>> cnc.move(x=10, y=20, z=30)
+        >>> cnc.home('xy')
+        >>> cnc.x, cnc.y, cnc.z
+        (0, 0, 30)
+        >>> cnc.concurrent_homing = True
+        >>> cnc.home('xy')
+        >>> [c for c in cnc.port.commands if c.startswith('H')]
+        ['HX', 'HY', 'HXY']
+        """
+        for axis in axes:
+            if axis not in ('x', 'y', 'z'):
+                raise ValueError(u'Bad axis')
+        if self.concurrent_homing:
+            self.execute('H' + axes.upper(), timeout=timeout)
+        else:
+            for axis in axes:
+                self.execute('H' + axis.upper(), timeout=timeout)
+        for axis in axes:
+            self._targets[axis] = 0
+
+    @serialized
+    def probe(self, axis, target, speed=None):
+        """Move the axis toward the target until the probe input triggers,
+        and return the position where it touched. Raise IOError if it
+        reached the target without touching anything.
+
+        >>> cnc = InterpCNC(port=Simulator())
+        >>> cnc.port.surface = lambda x, y: -120 + x
+        >>> cnc.move(x=20, y=0, z=0)
+        >>> cnc.probe('z', -500)
+        -100
+        >>> cnc.port.surface = None
+        >>> cnc.probe('z', -500)
+        Traceback (most recent call last):
+        ...
+        IOError: The probe did not touch anything
+        """
+        if axis not in ('x', 'y', 'z'):
+            raise ValueError(u'Bad axis')
+        command = 'P' + axis.upper() + str(int(target))
+        if speed is not None:
+            command += 'V' + str(speed)
+        self.execute(command)
+        position = self._get_axis(axis)
+        self._targets[axis] = position
+        if position == int(target):
+            raise IOError(u'The probe did not touch anything')
+        return position
+
+    def completion(self):
+        """Return a Completion of the moves sent so far, without blocking.
+        No other command must be sent until it is done.
+
+        >>> cnc = InterpCNC(speed=1000, port=Simulator())
+        >>> cnc.reset_all_axis()
+        >>> cnc.move(x=100)
+        >>> end = cnc.motion.end
+        >>> cnc.completion().result(timeout=1) > 0
+        True
+
+        It is done once the predicted end of the moves is reached:
+
+        >>> from pycnic.completion import MARGIN
+        >>> time.time() >= end - MARGIN
+        True
+        """
+        return Completion(lambda: self.wait() or True, self.motion.end)
+
     def _get_axis(self, axis):
         """Get the position of the X axis
 
@@ -409,6 +744,7 @@ class InterpCNC(object):
             raise ValueError(u'Bad axis')
         return int(self.execute('R' + axis.upper()))
 
+    @serialized
     def _set_axis(self, axis, value):
         """Reset the specified axis to the specified value without moving
 
@@ -435,12 +771,13 @@ class InterpCNC(object):
             raise ValueError(u'Bad axis')
         if value is None:
             # calibration with home sensor
-            if 0 < int(self.params['EE_FDC_ORIGINEX']) <= 8:
-                self.execute('HX')
-            else:
+            sensor = int(self.params['EE_FDC_ORIGINE' + axis.upper()])
+            if not 0 < sensor <= 8:
                 raise Warning(u'The input port is not configured')
+            self.home(axis)
             return
         self.execute('W' + axis.upper() + str(value))
+        self._targets[axis] = int(value)
 
     x = property(lambda self: self._get_axis('x'), lambda self, val: self._set_axis('x', val))
     y = property(lambda self: self._get_axis('y'), lambda self, val: self._set_axis('y', val))
@@ -460,6 +797,7 @@ class InterpCNC(object):
         """
         return self._speed
 
+    @serialized
     def _set_speed(self, speed):
         """Set the speed
 
@@ -472,12 +810,34 @@ class InterpCNC(object):
         >>> cnc.speed = 440
         >>> cnc.speed
         440
+
+        Setting the speed the card already uses costs no round trip:
+
+        >>> cnc = InterpCNC(speed=440, port=Simulator())
+        >>> cnc.speed = 440
+        >>> cnc.move(x=10, speed=440)
+        >>> cnc.port.commands.count('VV440'), cnc.port.commands[-1]
+        (1, 'LX10')
+        >>> cnc.registers.saved
+        1
+
+        The speed of a move does not change the current speed, only VV
+        does:
+
+        >>> cnc.move(x=20, speed=300)
+        >>> cnc.speed, cnc.port.commands[-1]
+        (440, 'LX20V300')
+        >>> cnc.speed = 300
+        >>> cnc.port.commands[-1]
+        'VV300'
         """
-        self.execute('VV' + str(speed))
+        self.registers.write('VV', speed,
+                             lambda: self.execute('VV' + str(speed)))
         self._speed = speed
 
     speed = property(_get_speed, _set_speed)
 
+    @serialized
     def reset_all_axis(self):
         """Reset all axis to zero
 
@@ -492,7 +852,124 @@ class InterpCNC(object):
         0
         """
         self.execute('E')
+        self._targets = dict.fromkeys('xyz', 0)
+
+
 
 
 
 
+class Simulator(object):
+    """Host-side emulation of an InterpCNC behind a serial port, for tests.
+    `latency` is the time spent by each command on the link, in seconds,
+    waited with `sleep`, which a benchmark can replace with a virtual clock.
+
+    >>> cnc = InterpCNC(port=Simulator())
+    >>> cnc.name
+    'InterpCNC V3.16'
+    >>> cnc.move(x=10, y=-5, speed=300)
+    >>> cnc.x, cnc.y, cnc.port.speed
+    (10, -5, 300)
+    >>> int(cnc.params['EE_MAX_COURSE_X'])
+    40000
+    """
+    name = 'InterpCNC V3.16'
+    port = 'simulator'
+    fd = 1
+    surface = None # function of (x, y) giving the Z of the probed surface
+    firmware = {'RVH': '3', 'RVL': '16', 'RVBH': '1', 'RVBL': '0',
+                'RVML': '50000', 'RVMC': '25000'}
+
+    def __init__(self, latency=0, sleep=time.sleep):
+        self.latency = latency
+        self.sleep = sleep
+        self.position = dict.fromkeys('XYZA', 0)
+        self.speed = 1000
+        self.params = {'3': '1000', '29': '1', '34': '40000', '35': '40000',
+                       '36': '10000', '42': '0', '12': '2000', '15': '200'}
+        self.commands = []
+        self._input = ''
+        self._output = ''
+        self._lock = threading.Lock() # like a port, it can be shared
+
+    # serial port interface
+    def write(self, data):
+        if self.latency:
+            self.sleep(self.latency)
+        self._lock.acquire()
+        try:
+            self._input += data
+            while ';' in self._input:
+                command, self._input = self._input.split(';', 1)
+                self.commands.append(command)
+                value = self._handle(command)
+                if value is None:
+                    self._output += '>'
+                else:
+                    self._output += '=%s>' % value
+        finally:
+            self._lock.release()
+        return len(data)
+
+    def read(self, size=1):
+        self._lock.acquire()
+        try:
+            data, self._output = self._output[:size], self._output[size:]
+        finally:
+            self._lock.release()
+        return data
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        self._lock.acquire()
+        self._output = ''
+        self._lock.release()
+
+    def close(self):
+        self.fd = None
+
+    # firmware
+    def _handle(self, command):
+        if command == 'RI':
+            return self.name
+        if command in self.firmware:
+            return self.firmware[command]
+        if command in ('RX', 'RY', 'RZ', 'RA'):
+            return self.position[command[1]]
+        if command.startswith('RP'):
+            return self.params.get(command[2:], '0')
+        if command.startswith('WP'):
+            num, value = command[2:].split('V')
+            self.params[num] = value
+            return
+        if command.startswith('VV'):
+            self.speed = int(command[2:])
+            return
+        if command == 'E':
+            self.position = dict.fromkeys('XYZA', 0)
+            return
+        if command[0] == 'W' and command[1] in self.position:
+            self.position[command[1]] = int(command[2:])
+            return
+        if command[0] == 'H' and command[1:] and all(
+                axis in self.position for axis in command[1:]):
+            for axis in command[1:]:
+                self.position[axis] = 0
+            return
+        if command[0] == 'P' and command[1] in self.position:
+            axis, target = command[1], int(re.findall('-?[0-9]+', command)[0])
+            self.position[axis] = target
+            if axis == 'Z' and self.surface is not None:
+                contact = self.surface(self.position['X'], self.position['Y'])
+                if target <= contact:
+                    self.position[axis] = contact
+            return
+        if command[0] == 'L':
+            for axis, value in re.findall('([XYZAV])(-?[0-9]+)', command):
+                if axis == 'V':
+                    self.speed = int(value)
+                else:
+                    self.position[axis] = int(value)
+            return
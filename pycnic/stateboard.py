@@ -0,0 +1,139 @@
+# coding: utf-8
+"""Live machine state shared with other processes
+
+The process driving the machine publishes a fixed-layout state record in a
+memory-mapped file. Any number of local processes (HMI, logger...) can read
+it at high rates without talking to the controller, so they do not compete
+with the motion stream.
+
+The record is protected by a seqlock: the writer makes the sequence number
+odd before changing the record and even again afterwards, and a reader
+retries until it got the same even number before and after its copy.
+
+>>> import os, tempfile
+>>> from pycnic.stateboard import StateBoard, STREAMING
+>>> filename = tempfile.mktemp()
+>>> board = StateBoard(filename, create=True)
+>>> board.publish(x=10, y=-5, flags=STREAMING, done=3, total=100)
+>>> state = StateBoard(filename).snapshot()
+>>> state.x, state.y, state.z, state.done, state.total, state.flags
+(10, -5, 0, 3, 100, 1)
+>>> board.close()
+>>> os.remove(filename)
+
+Run this module to watch the state published by another process:
+
+    python -m pycnic.stateboard [filename]
+"""
+from collections import namedtuple
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+MAGIC = 'PCSB'
+VERSION = 1
+HEADER = struct.Struct('<4sII') # magic, version, sequence number
+SEQUENCE = struct.Struct('<I')
+SEQUENCE_OFFSET = 8
+RECORD = struct.Struct('<4iiIIId') # x y z a fifo flags done total time
+SIZE = HEADER.size + RECORD.size
+TIMEOUT = 1 # in seconds, to get a snapshot while the record is written
+
+# flags
+STREAMING = 1
+HELD = 2
+ABORTED = 4
+
+State = namedtuple('State', 'x y z a fifo flags done total time')
+
+if os.path.isdir('/dev/shm'):
+    DEFAULT_FILENAME = '/dev/shm/pycnic.state' # not backed by a disk
+else:
+    DEFAULT_FILENAME = os.path.join(tempfile.gettempdir(), 'pycnic.state')
+
+
+def control_flags(control):
+    """Return the flags of the state of a control.ControlChannel
+    """
+    flags = 0
+    if control.streaming:
+        flags |= STREAMING
+    if control.held:
+        flags |= HELD
+    if control.aborted:
+        flags |= ABORTED
+    return flags
+
+
+class StateBoard(object):
+    """State record mapped from a file. Only one process must create it and
+    publish, the others only read snapshots.
+    """
+
+    def __init__(self, filename=DEFAULT_FILENAME, create=False):
+        self.filename = filename
+        self.writable = create
+        if create:
+            # readers must never see a partial file
+            tmpname = filename + '.tmp'
+            statefile = open(tmpname, 'w+b')
+            self._state = State(*RECORD.unpack('\0' * RECORD.size))
+            statefile.write(HEADER.pack(MAGIC, VERSION, 0)
+                            + RECORD.pack(*self._state))
+            statefile.flush()
+            self._map = mmap.mmap(statefile.fileno(), SIZE)
+            os.rename(tmpname, filename)
+        else:
+            statefile = open(filename, 'rb')
+            self._map = mmap.mmap(statefile.fileno(), SIZE,
+                                  access=mmap.ACCESS_READ)
+            magic, version, sequence = HEADER.unpack_from(self._map)
+            if magic != MAGIC or version != VERSION:
+                self._map.close()
+                statefile.close()
+                raise IOError(u'%s is not a state board' % filename)
+        statefile.close()
+
+    def publish(self, **changes):
+        """Update some fields of the record, keeping the other ones
+        """
+        if not self.writable:
+            raise IOError(u'This state board is read only')
+        self._state = self._state._replace(time=time.time(), **changes)
+        sequence = SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0]
+        SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET,
+                           (sequence + 1) & 0xFFFFFFFF)
+        RECORD.pack_into(self._map, HEADER.size, *self._state)
+        SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET,
+                           (sequence + 2) & 0xFFFFFFFF)
+
+    def snapshot(self):
+        """Return a consistent copy of the State
+        """
+        deadline = time.time() + TIMEOUT
+        while True:
+            before = SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0]
+            if not before & 1:
+                record = RECORD.unpack_from(self._map, HEADER.size)
+                after = SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0]
+                if after == before:
+                    return State(*record)
+            if time.time() > deadline:
+                raise IOError(u'The state board is always being written')
+            # let the writer finish, it may share our processor
+            time.sleep(0)
+
+    def close(self):
+        self._map.close()
+
+
+if __name__ == '__main__':
+    import sys
+    board = StateBoard(*sys.argv[1:2])
+    while True:
+        state = board.snapshot()
+        print ('x=%d y=%d z=%d a=%d fifo=%d flags=%d progress=%d/%d'
+               % state[:-1])
+        time.sleep(0.1)
@@ -1,18 +1,21 @@
 # coding: utf-8
 """Module supporting the TechLF controllers
 See techlf.txt
+
+The usb library is only imported when switching on.
 """
-import ctypes
-import pdb
 import logging
-import string
-import subprocess
-import sys
+import threading
 import time
-import usb
+from pycnic import discovery
+from pycnic.actor import IOActor, serialized, query
+from pycnic.completion import Predictor, Completion, wait_for, MAXTIMEOUT
+from pycnic.control import ControlChannel, HOLD, RESUME, ABORT
+from pycnic.registers import RegisterCache
+from pycnic.stateboard import control_flags
+from pycnic.tracing import FlightRecorder, Lazy, WRITE, READ
 
 logger = logging.getLogger('PyCNiC')
-logging.basicConfig(level=logging.DEBUG)
 
 TIMEOUT = 200 # timeout for usb read or write
 VENDOR_ID = 0x9999
@@ -132,7 +135,11 @@ class Motor(object):
     dim_y = None
     dim_z = None
     dim_a = None
-    micro_step = None
+    backlash_x = None # play when the axis reverses, in mm
+    backlash_y = None
+    backlash_z = None
+    backlash_a = None
+    micro_step = None # micro-steps per step
     current_x = None
     current_y = None
     current_z = None
@@ -155,38 +162,98 @@ class TinyCN(object):
     tool = None
     res = None
     interface_num = 0
+    identities = discovery.identities
+    board = None # stateboard.StateBoard where the state is published
+    _done = 0 # moves sent by the current stream
 
-    def __init__(self, fake=False, debug=False):
+    def __init__(self, fake=False, debug=False, handle=None):
         self.fake = fake
         self.debug = debug
         self.set_debug(self.debug)
-        if not self.fake:
-            self.on()
+        self.control = ControlChannel(self._send_control)
+        self.registers = RegisterCache()
+        self.motion = Predictor()
+        self.recorder = FlightRecorder()
+        self.actor = IOActor()
+        self._targets = [None] * 4 # last commanded positions
         self.motor = Motor()
         self.tool = Tool()
+        if not self.fake:
+            self.on(handle)
 
     def off(self):
         logger.debug(u'Switching off...')
+        self.actor.close()
+        self.registers.invalidate()
         if self.handle is not None:
             logger.debug(u'Releasing interface...')
             self.handle.releaseInterface()
             self.handle = None
 
-    def on(self):
+    def on(self, handle=None):
         if self.handle is not None:
             return
+        if handle is not None:
+            self.handle = handle
+        else:
+            self._open()
+
+        # misc tests and inits
+        self.set_prompt(0)
+        serial = self._serial_number()
+        identity = serial and self.identities.get(serial)
+        if identity:
+            # known device, skip the identity queries
+            self.name = str(identity['name'])
+            self.res = tuple(identity['speed_calc'])
+        else:
+            self.name = self.read_name()
+            self.res = self.get_speed_calc()
+            if serial:
+                self.identities.set(serial, name=self.name,
+                                    speed_calc=list(self.res))
+        self.set_fifo_depth(255) # 255 pulses
+        self.set_pulse_width(64) # 5µs (?)
 
-        busses = usb.busses()
+    def _serial_number(self):
+        """Read the serial number from the usb descriptor if it has one, it
+        does not go through the command pipe. Otherwise it is asked to the
+        controller, which costs a round trip, only if the identity cache can
+        use it: if it is persisted in a file or already knows some devices.
+        Return None if the serial number is not read.
+
+        >>> import os, tempfile
+        >>> from pycnic.discovery import IdentityCache
+        >>> identities, TinyCN.identities = TinyCN.identities, IdentityCache()
+        >>> sim = Simulator()
+        >>> tiny = TinyCN(handle=sim)
+        >>> [c[:2] for c in sim.commands].count((0x18, 0x84)) # get_serial
+        0
+        >>> TinyCN.identities = IdentityCache(tempfile.mktemp())
+        >>> for i in range(2):
+        ...     tiny.off()
+        ...     tiny.on(sim)
+        >>> tiny.name
+        'TinyCN'
+        >>> [c[:2] for c in sim.commands].count((0x18, 0x84)) # get_serial
+        2
+        >>> [c[:2] for c in sim.commands].count((0x18, 0x85)) # read_name
+        2
+        >>> os.remove(TinyCN.identities.filename)
+        >>> TinyCN.identities = identities
+        """
+        if self.device is not None and self.device.iSerialNumber:
+            return self.handle.getString(self.device.iSerialNumber, 64)
+        if self.identities.filename or len(self.identities):
+            return self.get_serial()
 
+    def _open(self):
         # try to find the device
         self.device = None
-        for bus in busses:
-            for device in bus.devices:
-                if device.idVendor == VENDOR_ID \
-                  and device.idProduct == PRODUCT_ID:
-                    logger.info(u"found %s!", PRODUCT_NAME)
-                    self.device = device
-                    break
+        for device in discovery.usb_devices([(VENDOR_ID, PRODUCT_ID)]):
+            logger.info(u"found %s!", PRODUCT_NAME)
+            self.device = device
+            break
 
         if self.device is None:
             raise IOError(u'No device found')
@@ -198,16 +265,9 @@ class TinyCN(object):
         #interface = self.device.configurations[0].interfaces[0][0]
         #self.handle.detachKernelDriver(interface)
 
-        logger.debug(u'Claiming interface... %s' % self.interface_num)
+        logger.debug(u'Claiming interface... %s', self.interface_num)
         self.handle.claimInterface(self.interface_num)
 
-        # misc tests and inits
-        self.set_prompt(0)
-        self.name = self.read_name()
-        self.set_fifo_depth(255) # 255 pulses
-        self.set_pulse_width(64) # 5µs (?)
-        self.res = self.get_speed_calc()
-
     def set_debug(self, debug):
         """takes one arg : debug = True or False
         """
@@ -223,197 +283,346 @@ class TinyCN(object):
         self.off()
 
     def write(self, buffer, alt=0):
-        logger.debug(u'    we write the command %s...' % tuple2hex(buffer))
+        logger.debug(u'    we write the command %s...', Lazy(tuple2hex, buffer))
+        self.recorder.record(WRITE, buffer)
         if not self.fake:
             #P1 : in 0x81, out 0x01
             #P2 : in 0x82, out 0x02
-            bytes = self.handle.bulkWrite(0x01+alt, buffer, TIMEOUT)
-            logger.debug(u'    %s bytes written' % bytes)
+            try:
+                bytes = self.handle.bulkWrite(0x01+alt, buffer, TIMEOUT)
+            except Exception, e:
+                self.registers.invalidate()
+                self.recorder.fault(e)
+                raise
+            logger.debug(u'    %s bytes written', bytes)
+
+    @serialized
+    def _set_register(self, command, value):
+        """Write a 4-byte register, unless it already holds the value.
+        Return True if the write was sent.
+
+        >>> tiny = TinyCN(handle=Simulator())
+        >>> tiny.set_pulse_width(64)
+        False
+        >>> tiny.set_pulse_width(32)
+        True
+        >>> tiny.registers.saved
+        1
+        """
+        return self.registers.write(
+            command, value, lambda: self.write(command + int2tuple(value)))
 
     def read(self, size, alt=0):
         if self.fake: return
         logger.debug(u'    Now we read the result...')
         #P1 : in 0x81, out 0x01
         #P2 : in 0x82, out 0x02
-        buffer = self.handle.bulkRead(0x81 + alt, size, TIMEOUT)
-        logger.debug(u'    %s bytes read: %s' % (len(buffer), tuple2hex(buffer)))
+        try:
+            buffer = self.handle.bulkRead(0x81 + alt, size, TIMEOUT)
+        except Exception, e:
+            self.registers.invalidate()
+            self.recorder.fault(e)
+            raise
+        self.recorder.record(READ, buffer)
+        logger.debug(u'    %s bytes read: %s', len(buffer), Lazy(tuple2hex, buffer))
         return buffer
 
+    @query
     def read_firmware(self):
         logger.debug(u'Reading firmware version...')
         self.write((0x18, 0x82, 0x04, 0x00))
         version = self.read(32)
-        logger.debug(u'  Got firmware version: %s' % tuple2str(version))
+        logger.debug(u'  Got firmware version: %s', Lazy(tuple2str, version))
         return version
 
+    @serialized
     def stop(self):
         logger.debug(u'Stopping...')
         self.write((0x80, 0x1B))
 
+    @serialized
     def restart(self):
         logger.debug(u'Restarting...')
         self.write((0x80, 0x1C))
 
+    def stop_now(self):
+        """Stop the pulse generator through the second pipe, so that it does
+        not wait behind the commands queued in the first one.
+        """
+        logger.debug(u'Stopping now...')
+        self.write((0x80, 0x1B), alt=1)
+
+    def restart_now(self):
+        """Restart the pulse generator through the second pipe
+        """
+        logger.debug(u'Restarting now...')
+        self.write((0x80, 0x1C), alt=1)
+
+    def _send_control(self, action):
+        if self.fake:
+            return
+        if action == HOLD:
+            self.stop_now()
+        elif action == RESUME:
+            self.restart_now()
+        elif action == ABORT:
+            self.registers.invalidate()
+            self._targets = [None] * 4
+            self.motion.reset()
+            self.stop_now()
+            self.write((0x80, 0x09), alt=1) # clear cmd
+
+    def stream(self, records):
+        """Move through a sequence of (x, y, z[, a[, speed]]) records, such as
+        a toolpath.Toolpath, and return the number of moves sent. The stream
+        can be held, resumed or aborted from another thread.
+
+        >>> tiny = TinyCN(handle=Simulator())
+        >>> tiny.stream([(10, 0, 0), (20, 5, 0, 8, 500)])
+        2
+        >>> tiny.get_x(), tiny.handle.position[3]
+        (20, 8)
+        >>> tiny.handle.registers[(0x12, 0x06)]
+        500
+        """
+        self._done = 0
+        self._publish(total=len(records) if hasattr(records, '__len__') else 0)
+        try:
+            return self.control.stream(records, self._stream_record)
+        finally:
+            self._publish()
+
+    def _stream_record(self, record):
+        self._done += 1
+        if len(record) > 4 and record[4]:
+            self._set_register((0x12, 0x06, 0x08, 0x00), int(record[4]))
+        self.move_const_x(record[0])
+        self.move_const_y(record[1])
+        self.move_const_z(record[2])
+        if len(record) > 3:
+            self.move_const_a(record[3])
+
+    def feed_hold(self):
+        """Pause the pulse generator and the stream.
+        Return the latency of the acknowledgement.
+        """
+        latency = self.control.request(HOLD)
+        self._publish()
+        return latency
+
+    def resume(self):
+        """Restart the pulse generator and the stream
+        """
+        latency = self.control.request(RESUME)
+        self._publish()
+        return latency
+
+    def abort(self):
+        """Stop the machine, clear the commands of the controller and drop the
+        remaining moves of the stream.
+
+        >>> tiny = TinyCN(handle=Simulator())
+        >>> tiny.abort() < 0.1
+        True
+        """
+        latency = self.control.request(ABORT)
+        self._publish()
+        return latency
+
+    @serialized
     def clear_cmd(self):
         logger.debug(u'Clearing cmd...')
         self.write((0x80, 0x09))
 
+    @query
     def read_cmd(self):
         logger.debug(u'Reading cmd...')
         self.write((0x80, 0x08))
         return self.read(16)
 
+    @serialized
     def open_buffer(self):
         logger.debug(u'Opening buffer...')
         self.write((0x80, 0x12))
 
+    @serialized
     def close_buffer(self):
         logger.debug(u'Closing buffer...')
         self.write((0x80, 0x13))
 
+    @serialized
     def clear_buffer_rx(self):
         logger.debug(u'Clearing rx buffer...')
         self.write((0x80, 0x14))
 
+    @serialized
     def clear_buffer_tx(self):
         logger.debug(u'Clearing tx buffer...')
         self.write((0x80, 0x15))
 
     def set_prompt(self, prompt):
-        logger.info(u'Setting prompt = "%s"' % prompt)
+        logger.info(u'Setting prompt = "%s"', prompt)
         command = (0x18, 0x03, 0x08, 0x00)
-        state = (prompt, 0, 0, 0)
-        self.write(command + state)
+        return self._set_register(command, prompt)
 
+    @serialized
     def wait(self, pulses):
         """Wait during the specified number of pulses
         """
-        logger.debug(u'Waiting %s pulses...' % tuple2str(pulses))
+        logger.debug(u'Waiting %s pulses...', Lazy(tuple2str, pulses))
         command = (0x18, 0x06, 0x08, 0x00)
         self.write(command + int2tuple(pulses))
 
+    @query
     def get_prompt(self):
         logger.debug(u'Reading prompt')
         self.write((0x18, 0x83, 0x04, 0x00))
         prompt = self.read(8)
-        logger.debug(u'  Got prompt: %s' % tuple2str(prompt))
+        logger.debug(u'  Got prompt: %s', Lazy(tuple2str, prompt))
         return prompt
 
+    @query
     def get_status(self):
         logger.debug(u'Reading status...')
         self.write((0x18, 0x89, 0x04, 0x00))
         value = tuple2int(self.read(8)[4:8])
-        logger.debug(u'  Got status: %s' % value)
+        logger.debug(u'  Got status: %s', value)
         return value
 
+    @query
     def get_x(self):
         logger.debug(u'Reading X...')
         self.write((0x10, 0x81, 0x04, 0x00))
         value = tuple2int(self.read(8)[4:8])
-        logger.debug(u'  Got X: %s' % value)
+        logger.debug(u'  Got X: %s', value)
         return value
 
+    @serialized
     def zero_x(self):
         logger.debug(u'Resetting X to zero...')
         command = (0x11, 0x01, 0x04, 0x00)
         self.write(command)
+        self._targets[0] = 0
 
+    @serialized
     def read_name(self):
         logger.debug(u'Reading name...')
         command = (0x18, 0x85, 0x04, 0x00)
         self.write(command)
         name = self.read(32)
         self.name = tuple2str(name)
-        logger.debug(u'Read name = %s (%s)' % (tuple2hex(name), self.name))
+        logger.debug(u'Read name = %s (%s)', Lazy(tuple2hex, name), self.name)
         return self.name
 
+    @query
     def get_serial(self):
         self.write((0x18, 0x84, 0x04, 0x00))
         serial = self.read(10)
-        logger.debug(u'Got serial number = %s', tuple2str(serial))
+        logger.debug(u'Got serial number = %s', Lazy(tuple2str, serial))
         return tuple2str(serial)
 
     def set_fifo_depth(self, depth):
-        logger.debug(u'Setting fifo pulse generator to %s pulses' % depth)
+        logger.debug(u'Setting fifo pulse generator to %s pulses', depth)
         command = (0x18, 0x10, 0x08, 0x00)
-        tupledepth = int2tuple(depth)
-        self.write(command + tupledepth)
+        return self._set_register(command, depth)
 
     def set_pulse_width(self, width):
-        logger.debug(u'Setting pulse width to %s ' % width)
+        logger.debug(u'Setting pulse width to %s ', width)
         command = (0x13, 0x08, 0x08, 0x00)
-        tuplewidth = int2tuple(width)
-        self.write(command + tuplewidth)
+        return self._set_register(command, width)
 
+    @query
     def get_speed_max(self):
         """set the max speed for the ramp
         """
         logger.debug(u'Reading max speed...')
         self.write((0x12, 0x85, 0x04, 0x00))
         speed = self.read(8)[4:8]
-        logger.debug(u'  Got max speed = %s' % tuple2hex(speed))
+        logger.debug(u'  Got max speed = %s', Lazy(tuple2hex, speed))
         return tuple2int(speed)
 
     def set_speed_max(self, speed, resolution):
-        logger.debug(u'Setting speed max to %s mm/min' % speed)
+        logger.debug(u'Setting speed max to %s mm/min', speed)
         command = (0x12, 0x05, 0x08, 0x00)
         speed = speed / 60.0 # convert to mm/s
         speed = speed * resolution * self.tool.numerateur / self.tool.denominateur # FIXME check
-        tuplespeed = int2tuple(int(speed))
-        logger.debug(u'  hex speed max = %s' % tuple2hex(tuplespeed))
-        self.write(command + tuplespeed)
+        logger.debug(u'  hex speed max = %s', Lazy(tuple2hex, int2tuple(int(speed))))
+        return self._set_register(command, int(speed))
 
+    @query
     def get_speed_calc(self):
         logger.debug(u'Reading speed calc...')
         self.write((0x12, 0x89, 0x04, 0x00))
         speed_calc = self.read(8)
-        logger.debug(u'  Got speed calc = %s' % tuple2hex(speed_calc))
+        logger.debug(u'  Got speed calc = %s', Lazy(tuple2hex, speed_calc))
         return speed_calc
 
     def set_speed(self, speed, resolution):
-        logger.debug(u'Setting speed to %s mm/min' % speed)
+        logger.debug(u'Setting speed to %s mm/min', speed)
         command = (0x12, 0x06, 0x08, 0x00)
         speed = speed / 60.0 # convert to mm/s
         speed = speed * resolution * self.tool.numerateur / self.tool.denominateur # FIXME check
-        tuplespeed = int2tuple(int(speed))
-        logger.debug(u'  hex speed = %s' % tuple2hex(tuplespeed))
-        self.write(command + tuplespeed)
+        logger.debug(u'  hex speed = %s', Lazy(tuple2hex, int2tuple(int(speed))))
+        return self._set_register(command, int(speed))
 
+    @query
     def get_speed_acca(self):
         logger.debug(u'Reading acca...')
         self.write((0x12, 0x81, 0x04, 0x00))
         value = tuple2int(self.read(8)[4:8])
-        logger.debug(u'  Got acca : %s' % value)
+        logger.debug(u'  Got acca : %s', value)
         return value
 
     def set_speed_acca(self, acc):
         """Set the slope of the acceleration curve (1 to 10)
         """
-        logger.debug(u'Setting acca to %s' % acc)
+        logger.debug(u'Setting acca to %s', acc)
         command = (0x12, 0x01, 0x08, 0x00)
-        tupleacc = int2tuple(int(acc))
-        logger.debug(u'  hex acc = %s' % tuple2hex(tupleacc))
-        self.write(command + tupleacc)
+        return self._set_register(command, int(acc))
 
     def set_speed_accb(self, acc):
         """Set the slope of the acceleration curve.
         Must be 1 for a step motor
         """
-        logger.debug(u'Setting accb to %s mm/min' % acc)
+        logger.debug(u'Setting accb to %s mm/min', acc)
         command = (0x12, 0x02, 0x08, 0x00)
-        tupleacc = int2tuple(int(acc))
-        logger.debug(u'  hex acc = %s' % tuple2hex(tupleacc))
-        self.write(command + tupleacc)
+        return self._set_register(command, int(acc))
 
     def move_ramp_xyz(self, x, y, z):
         raise NotImplementedError
 
+    @serialized
+    def move(self, x=None, y=None, z=None, speed=None, ramp=False):
+        """Move the specified axes to the specified steps at constant speed,
+        with the same arguments as the moves of the other drivers. The speed
+        is in Hz.
+
+        >>> tiny = TinyCN(handle=Simulator())
+        >>> tiny.zero_x()
+        >>> tiny.move(x=10.4, speed=500)
+        >>> tiny.get_x()
+        10
+        """
+        if (x, y, z) == (None, None, None):
+            raise ValueError(u'Please specify at least one axis to move')
+        if ramp:
+            raise NotImplementedError(u'Only constant speed moves')
+        if speed is not None:
+            self._set_register((0x12, 0x06, 0x08, 0x00), int(speed))
+        for value, move in ((x, self.move_const_x), (y, self.move_const_y),
+                            (z, self.move_const_z)):
+            if value is not None:
+                move(int(round(value)))
+
+    @serialized
     def move_ramp_x(self, steps):
         """move to x using ramp
         """
-        logger.debug(u'move x to step %s' % steps)
+        logger.debug(u'move x to step %s', steps)
         self.write((0x14, 0x01, 0x08, 0x00) + int2tuple(steps))
+        self._predict(0, steps)
 
+    @serialized
     def move_var_x(self, steps, start, stop, direction):
         """move to x with variable speed
         steps : the target step
@@ -427,51 +636,217 @@ class TinyCN(object):
             cmd = (0x14, 0x21, 0x10, 0x00)
         else:
             raise Exception(u'Wrong direction')
-        logger.debug(u'move var x to step %s' % steps)
+        logger.debug(u'move var x to step %s', steps)
         self.write(cmd + int2tuple(steps) + int2tuple(start) + int2tuple(stop))
+        self._predict(0, steps, (start + stop) / 2.0)
 
+    @serialized
     def move_const_x(self, steps):
         """Move the motor to a fixed position
         """
-        logger.debug(u'move x to step %s' % steps)
+        logger.debug(u'move x to step %s', steps)
         self.write((0x14, 0x11, 0x08, 0x00) + int2tuple(steps))
+        self._predict(0, steps)
 
+    @serialized
     def move_const_y(self, steps):
         """Move the motor to a fixed position
         """
-        logger.debug(u'move y to step %s' % steps)
+        logger.debug(u'move y to step %s', steps)
         self.write((0x14, 0x12, 0x08, 0x00) + int2tuple(steps))
+        self._predict(1, steps)
 
+    @serialized
     def move_const_z(self, steps):
         """Move the motor to a fixed position
         """
-        logger.debug(u'move z to step %s' % steps)
+        logger.debug(u'move z to step %s', steps)
         self.write((0x14, 0x13, 0x08, 0x00) + int2tuple(steps))
+        self._predict(2, steps)
 
+    @serialized
     def move_const_a(self, steps):
         """Move the motor to a fixed position
         """
-        logger.debug(u'move a to step %s' % steps)
+        logger.debug(u'move a to step %s', steps)
         self.write((0x14, 0x14, 0x08, 0x00) + int2tuple(steps))
+        self._predict(3, steps)
 
+    def _predict(self, axis, steps, speed=None):
+        """Account for a move of the axis in the predicted end time
+        """
+        previous, self._targets[axis] = self._targets[axis], steps
+        if previous is None:
+            self.motion.add(None, speed)
+            return
+        if speed is None:
+            speed = self.registers.get((0x12, 0x06, 0x08, 0x00))
+        self.motion.add(steps - previous, speed)
+        self._publish()
+
+    def _publish(self, **state):
+        """Publish the commanded position, the stream progress and the
+        given fields on the state board, if any. Nothing is asked to the
+        controller.
+
+        >>> import os, tempfile
+        >>> from pycnic.stateboard import StateBoard
+        >>> tiny = TinyCN(handle=Simulator())
+        >>> tiny.board = StateBoard(tempfile.mktemp(), create=True)
+        >>> tiny.zero_x()
+        >>> tiny.stream([(10, 0, 0), (20, 5, 0)])
+        2
+        >>> reader = StateBoard(tiny.board.filename)
+        >>> reader.snapshot()[:-1]
+        (20, 5, 0, 0, 0, 0, 2, 2)
+        >>> os.remove(reader.filename)
+        """
+        if self.board is None:
+            return
+        for axis, value in zip(('x', 'y', 'z', 'a'), self._targets):
+            if value is not None:
+                state[axis] = value
+        self.board.publish(flags=control_flags(self.control),
+                           done=self._done, **state)
+
+    def wait_idle(self, timeout=MAXTIMEOUT):
+        """Wait until the pulse generator has emptied its fifo: sleep until
+        the predicted end of the moves, then poll with a backoff.
+
+        >>> tiny = TinyCN(handle=Simulator())
+        >>> tiny.zero_x()
+        >>> tiny.set_speed(60000, 1)
+        True
+        >>> tiny.move_const_x(100)
+        >>> end = tiny.motion.end
+        >>> tiny.wait_idle() > 0
+        True
+        >>> from pycnic.completion import MARGIN
+        >>> time.time() >= end - MARGIN
+        True
+        """
+        elapsed = wait_for(lambda: self.get_fifo_count() == 0,
+                           self.motion.end, timeout)
+        self.motion.reset()
+        return elapsed
+
+    def completion(self, timeout=MAXTIMEOUT):
+        """Return a Completion of the moves sent so far, without blocking
+        """
+        return Completion(lambda: self.get_fifo_count() == 0,
+                          self.motion.end, timeout)
+
+    @query
     def get_state(self):
         logger.debug(u'get_state')
         self.write((0x80, 0x19))
         state = self.read(4, alt=1)
-        logger.debug(tuple2hex(state))
+        logger.debug(u'  Got state %s', Lazy(tuple2hex, state))
         return tuple2int(state)
 
+    @query
     def get_buffer_state(self):
         logger.debug(u'get_buffer_state')
         self.write((0x80, 0x18))
         state = self.read(4, alt=1)
-        logger.debug(tuple2hex(state))
+        logger.debug(u'  Got buffer state %s', Lazy(tuple2hex, state))
         return tuple2int(state)
 
+    @query
     def get_fifo_count(self):
         logger.debug(u'get_fifo_count')
         self.write((0x80, 0x10), alt=1)
         state = self.read(4, alt=1)
-        logger.debug(tuple2hex(state))
-        return tuple2int(state)
+        logger.debug(u'  Got fifo count %s', Lazy(tuple2hex, state))
+        count = tuple2int(state)
+        self._publish(fifo=count)
+        return count
+
 
+
+class Simulator(object):
+    """Host-side emulation of a TinyCN behind a usb handle, for tests.
+    `latency` is the time spent by each bulk write, in seconds, waited with
+    `sleep`, which a benchmark can replace with a virtual clock.
+
+    >>> tiny = TinyCN(handle=Simulator())
+    >>> tiny.name
+    'TinyCN'
+    >>> tiny.move_const_x(100)
+    >>> tiny.get_x()
+    100
+    >>> tiny.get_fifo_count()
+    0
+    """
+    name = 'TinyCN'
+    serial = '0000000001'
+    firmware = 'TinyCN firmware 1.0'
+
+    def __init__(self, latency=0, sleep=time.sleep):
+        self.latency = latency
+        self.sleep = sleep
+        self.position = [0, 0, 0, 0]
+        self.registers = {}
+        self.commands = []
+        self._output = {0x81: [], 0x82: []}
+        self._lock = threading.Lock()
+
+    def claimInterface(self, interface):
+        pass
+
+    def releaseInterface(self):
+        pass
+
+    def bulkWrite(self, endpoint, buffer, timeout=None):
+        if self.latency:
+            self.sleep(self.latency)
+        buffer = tuple(buffer)
+        self._lock.acquire()
+        try:
+            self.commands.append(buffer)
+            response = self._handle(buffer)
+            if response is not None:
+                self._output[0x80 + endpoint].append(tuple(response))
+        finally:
+            self._lock.release()
+        return len(buffer)
+
+    def bulkRead(self, endpoint, size, timeout=None):
+        self._lock.acquire()
+        try:
+            if not self._output[endpoint]:
+                raise IOError(u'Could not read from the device')
+            return self._output[endpoint].pop(0)[:size]
+        finally:
+            self._lock.release()
+
+    def _register(self, value):
+        return (0, 0, 0, 0) + int2tuple(value)
+
+    def _handle(self, buffer):
+        command = buffer[:2]
+        if command == (0x80, 0x10): # fifo count
+            return int2tuple(0)
+        if command in ((0x80, 0x18), (0x80, 0x19)): # buffer state, state
+            return int2tuple(0)
+        if command == (0x18, 0x85):
+            return [ord(c) for c in self.name]
+        if command == (0x18, 0x84):
+            return [ord(c) for c in self.serial]
+        if command == (0x18, 0x82):
+            return [ord(c) for c in self.firmware]
+        if command == (0x18, 0x83):
+            return self._register(self.registers.get((0x18, 0x03), 0))
+        if command == (0x10, 0x81):
+            return self._register(self.position[0])
+        if command == (0x11, 0x01):
+            self.position[0] = 0
+        elif command in ((0x14, 0x01), (0x14, 0x11)):
+            self.position[0] = tuple2int(buffer[4:8])
+        elif command[0] == 0x14 and 0x12 <= command[1] <= 0x14:
+            self.position[command[1] - 0x11] = tuple2int(buffer[4:8])
+        elif command[1] & 0x80 and command[0] != 0x80: # register read
+            return self._register(
+                self.registers.get((command[0], command[1] & 0x7F), 0))
+        elif command[0] != 0x80: # register write
+            self.registers[command] = tuple2int(buffer[4:8])
@@ -1,8 +1,23 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest, doctest
 import techlf, soprolec
+import toolpath, preflight, arduino, planner, control, registers
+import discovery, drivers, completion, stateboard, gcode, jobs, probing
+import calibration, bench, tracing, actor, machine, jog, importers
 import tests
 
+DOCTEST_FLAGS = doctest.NORMALIZE_WHITESPACE + doctest.ELLIPSIS
+DOCTEST_MODULES = (toolpath, preflight, arduino, planner, control, registers,
+                   discovery, drivers, completion, stateboard, gcode, jobs,
+                   probing, calibration, bench, tracing, actor, machine, jog,
+                   importers)
+IMPORT_BUDGET = 0.3 # seconds, to import a module in a new interpreter
+
 class TestTinyCN(unittest.TestCase):
     def test_release_resources(self):
         """Check USB resources are correctly released.
@@ -17,8 +32,7 @@ class TestTinyCN(unittest.TestCase):
         tiny = techlf.TinyCN()
         tiny.move_ramp_x(200)
         tiny.move_ramp_x(0)
-        while tiny.get_fifo_count() > 0:
-            time.sleep(0.5)
+        tiny.wait_idle()
         del tiny
 
 
@@ -28,10 +42,233 @@ class TestSoprolec(unittest.TestCase):
         self.assertTrue(s.x == 0)
 
 
+class TestImport(unittest.TestCase):
+    """Importing pycnic must stay fast and free of transport libraries
+    """
+    modules = ('pycnic', 'pycnic.drivers', 'pycnic.soprolec',
+               'pycnic.techlf', 'pycnic.arduino')
+
+    def _import(self, module):
+        """Import the module in a new interpreter and return the import time
+        and the transport libraries loaded
+        """
+        code = ('import sys, time; start = time.time(); import %s; '
+                'print time.time() - start; '
+                'print " ".join(m for m in ("serial", "usb") '
+                'if m in sys.modules)' % module)
+        output = subprocess.Popen(
+            [sys.executable, '-c', code], stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            ).communicate()[0].split('\n')
+        return float(output[0]), output[1].split()
+
+    def test_no_transport_import(self):
+        for module in self.modules:
+            self.assertEqual(self._import(module)[1], [], module)
+
+    def test_import_time(self):
+        for module in self.modules:
+            duration = self._import(module)[0]
+            self.assertTrue(duration < IMPORT_BUDGET,
+                            '%s took %.3fs to import' % (module, duration))
+
+
+class TestStateBoard(unittest.TestCase):
+    """Snapshots read while another process publishes must be consistent
+    """
+    def test_consistent_snapshots(self):
+        filename = tempfile.mktemp()
+        code = ('from pycnic.stateboard import StateBoard; '
+                'board = StateBoard(%r, create=True)\n'
+                'for i in xrange(1, 200001): '
+                'board.publish(x=i, y=-i, z=i, done=i)' % filename)
+        writer = subprocess.Popen(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        while not os.path.exists(filename):
+            self.assertEqual(writer.poll(), None)
+        board = stateboard.StateBoard(filename)
+        try:
+            last = 0
+            while writer.poll() is None or last < 200000:
+                state = board.snapshot()
+                self.assertEqual((state.y, state.z, state.done),
+                                 (-state.x, state.x, state.x))
+                self.assertTrue(state.x >= last)
+                last = state.x
+        finally:
+            board.close()
+            os.remove(filename)
+        self.assertEqual(writer.returncode, 0)
+
+
+class TestFlightRecorder(unittest.TestCase):
+    """A fault hands the last exchanges to the on_error hook
+    """
+    def test_dump_on_error(self):
+        faults = []
+        cnc = soprolec.InterpCNC(port=soprolec.Simulator())
+        cnc.recorder.on_error = lambda recorder, error: faults.append(
+            (recorder.entries(), error))
+        cnc.execute('RX')
+        cnc.port.read = lambda size=1: time.sleep(0.01) or '' # no answer
+        self.assertRaises(IOError, cnc.execute, 'RY', timeout=0.01)
+        entries, error = faults[0]
+        self.assertEqual([(kind, data) for timestamp, kind, data
+                          in entries[-5:]],
+                         [('>', 'RX;'), ('<', '=0>'), ('>', 'RY;'),
+                          ('<', ''), ('!', str(error))])
+
+    def test_ring(self):
+        recorder = tracing.FlightRecorder(records=4, record_size=20)
+        for i in range(10):
+            recorder.record(tracing.WRITE, 'command %s, too long' % i)
+        self.assertEqual([data for timestamp, kind, data
+                          in recorder.entries()],
+                         ['command %s' % i for i in range(6, 10)])
+
+
+class TestControl(unittest.TestCase):
+    """A stream started after a feed hold and an abort must run
+    """
+    def test_hold_abort_stream(self):
+        cnc = soprolec.InterpCNC(port=soprolec.Simulator())
+        cnc.feed_hold()
+        cnc.abort()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            cnc.stream([(1, 0, 0, 0, 0)])))
+        thread.start()
+        thread.join(2)
+        blocked = thread.isAlive()
+        if blocked:
+            cnc.control.request(control.RESUME)
+            thread.join()
+        cnc.disconnect()
+        self.assertEqual((blocked, results), (False, [1]))
+
+
+class TestBench(unittest.TestCase):
+    """The benchmarks run and measure a rate. They are compared with a
+    baseline by the command, on the machine where it was saved.
+    """
+    def test_run(self):
+        results = bench.run(repeat=1, output=None)
+        self.assertEqual(sorted(results),
+                         sorted(name for name, unit, function
+                                in bench.BENCHMARKS))
+        for name, rate in results.items():
+            self.assertTrue(rate > 0, name)
+
+    def test_no_thread_left(self):
+        threads = threading.active_count()
+        bench.run('*.stream', repeat=1, output=None)
+        self.assertEqual(threading.active_count(), threads)
+
+
+class TestIOActor(unittest.TestCase):
+    """Drivers shared between threads
+    """
+    def test_merged_queries(self):
+        io = actor.IOActor()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def busy():
+            started.set()
+            release.wait()
+
+        def position():
+            calls.append(None)
+            return 42
+
+        threading.Thread(target=io.call, args=(busy,)).start()
+        started.wait()
+        threads = [threading.Thread(target=lambda: results.append(
+            io.call(position, key='position'))) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        while len(io._queue) < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        io.close()
+        self.assertEqual((len(calls), results, io.merged), (1, [42] * 3, 2))
+
+    def test_concurrent_commands(self):
+        cnc = soprolec.InterpCNC(port=soprolec.Simulator(latency=0.0005))
+        cnc.reset_all_axis()
+        errors = []
+
+        def monitor():
+            try:
+                for i in range(50):
+                    self.assertTrue(0 <= cnc.x <= 100)
+                    self.assertEqual(cnc.y, 0)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=monitor) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for i in range(101):
+            cnc.move(x=i)
+        for thread in threads:
+            thread.join()
+        cnc.disconnect()
+        self.assertEqual((errors, cnc.x), ([], 100))
+
+
+class TestJog(unittest.TestCase):
+    """Without cancellation, a change of the velocity reaches the machine
+    within the horizon
+    """
+    def test_tinycn(self):
+        tiny = techlf.TinyCN(handle=techlf.Simulator())
+        tiny.zero_x()
+        jogger = jog.Jogger(tiny, period=0.01, horizon=0.04,
+                            position=(0, 0, 0))
+        self.assertFalse(jogger.cancel)
+        jogger.start()
+        jogger.set_velocity(x=1000)
+        time.sleep(0.1)
+        jogger.set_velocity(x=-1000)
+        time.sleep(0.1)
+        jogger.stop()
+        self.assertEqual(len(jogger.latencies), 3)
+        self.assertTrue(jogger.worst_latency < 0.04 + 0.05)
+        self.assertEqual(tiny.get_x(), jogger.position[0])
+
+    def test_cancel_needs_abort_command(self):
+        cnc = soprolec.InterpCNC(port=soprolec.Simulator())
+        self.assertFalse(jog.Jogger(cnc).cancel)
+        cnc.abort_command = 'S'
+        cnc.reset_all_axis()
+        jogger = jog.Jogger(cnc, period=0.01, horizon=0.03)
+        self.assertTrue(jogger.cancel)
+        jogger.start()
+        jogger.set_velocity(x=1000)
+        time.sleep(0.05)
+        jogger.set_velocity(x=-1000)
+        time.sleep(0.05)
+        jogger.stop()
+        self.assertTrue('S' in cnc.port.commands)
+        self.assertEqual(cnc.x, jogger.position[0])
+        cnc.disconnect()
+
+
 def test_suite( ):
-    return unittest.TestSuite((
+    suite = unittest.TestSuite((
 #        unittest.TestLoader().loadTestsFromTestCase(TestTinyCN),
         unittest.TestLoader().loadTestsFromTestCase(TestSoprolec),
+        unittest.TestLoader().loadTestsFromTestCase(TestStateBoard),
+        unittest.TestLoader().loadTestsFromTestCase(TestFlightRecorder),
+        unittest.TestLoader().loadTestsFromTestCase(TestControl),
+        unittest.TestLoader().loadTestsFromTestCase(TestBench),
+        unittest.TestLoader().loadTestsFromTestCase(TestIOActor),
+        unittest.TestLoader().loadTestsFromTestCase(TestJog),
+        unittest.TestLoader().loadTestsFromTestCase(TestImport),
 #        doctest.DocTestSuite(techlf,
 #                             optionflags=doctest.NORMALIZE_WHITESPACE+
 #                                         doctest.ELLIPSIS
@@ -49,6 +286,9 @@ def test_suite( ):
                                          doctest.ELLIPSIS
                              ),
         ))
+    for module in DOCTEST_MODULES:
+        suite.addTest(doctest.DocTestSuite(module, optionflags=DOCTEST_FLAGS))
+    return suite
 
 if __name__ == '__main__':
     unittest.main(defaultTest='test_suite')
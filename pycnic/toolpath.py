@@ -0,0 +1,121 @@
+# coding: utf-8
+"""Binary toolpath files
+
+A toolpath is a flat file of fixed-size little endian records, one per
+segment. Each record holds the target position of the segment, in steps, for
+the X, Y, Z and A axis, followed by the speed of the segment in Hz (0 means
+"keep the current speed").
+
+Toolpaths are memory-mapped when read, so that very large jobs can be
+scanned without loading them in memory.
+
+>>> import os, tempfile
+>>> from pycnic.toolpath import Toolpath, write_toolpath
+>>> filename = tempfile.mktemp()
+>>> write_toolpath(filename, [(10, 0, 0, 0, 500), (10, 20, 0, 0, 0)])
+2
+>>> path = Toolpath(filename)
+>>> len(path)
+2
+>>> path[1]
+(10, 20, 0, 0, 0)
+>>> list(path)
+[(10, 0, 0, 0, 500), (10, 20, 0, 0, 0)]
+>>> path.close()
+>>> os.remove(filename)
+"""
+import array
+import mmap
+import os
+import struct
+import sys
+
+AXES = ('x', 'y', 'z', 'a')
+FIELDS = AXES + ('speed',)
+RECORD = struct.Struct('<%di' % len(FIELDS))
+CHUNK = 65536 # number of records handled at once
+
+
+def _to_array(data):
+    """Converts little endian packed records to a flat array of int
+    """
+    values = array.array('i')
+    values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def write_toolpath(filename, records):
+    """Write an iterable of (x, y, z, a, speed) records to a toolpath file.
+    Return the number of records written.
+    """
+    count = 0
+    output = open(filename, 'wb')
+    try:
+        batch = []
+        for record in records:
+            batch.append(RECORD.pack(*record))
+            if len(batch) == CHUNK:
+                output.write(''.join(batch))
+                count += len(batch)
+                batch = []
+        output.write(''.join(batch))
+        count += len(batch)
+    finally:
+        output.close()
+    return count
+
+
+class Toolpath(object):
+    """A read-only, memory-mapped toolpath file
+    """
+    _file = None
+    _map = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        size = os.path.getsize(filename)
+        if size % RECORD.size:
+            raise ValueError(u'Truncated toolpath file: %s' % filename)
+        self._len = size // RECORD.size
+        self._file = open(filename, 'rb')
+        if size: # empty files cannot be mapped
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError(u'Segment index out of range')
+        return RECORD.unpack_from(self._map, index * RECORD.size)
+
+    def __iter__(self):
+        width = len(FIELDS)
+        for start, values in self.chunks():
+            for i in xrange(0, len(values), width):
+                yield tuple(values[i:i+width])
+
+    def chunks(self, size=CHUNK):
+        """Yield (first segment index, flat array of int) for consecutive
+        blocks of at most `size` records.
+        """
+        for start in xrange(0, self._len, size):
+            stop = min(start + size, self._len)
+            yield start, _to_array(
+                self._map[start * RECORD.size:stop * RECORD.size])
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __del__(self):
+        self.close()
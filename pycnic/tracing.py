@@ -0,0 +1,172 @@
+# coding: utf-8
+"""Tracing and flight recorder
+
+Debug logging on the hot paths of the drivers must cost nothing when it is
+disabled: the messages are formatted by the logging module only when they
+are emitted, and the expensive arguments, like the hex dump of a buffer,
+are wrapped in Lazy so that they are only computed then. Structured events
+carry their fields in the `event` and `fields` attributes of the log
+record, for handlers which need them.
+
+Whatever the log level, each driver keeps the last commands and responses
+exchanged with its controller in a FlightRecorder: a fixed-size binary ring
+buffer, so that a long job never fills the memory or the disk. When a fault
+occurs, the driver calls fault() and the recorder hands its content to its
+on_error hook, which logs it by default.
+
+>>> from pycnic.tracing import FlightRecorder, WRITE, READ, format_data
+>>> recorder = FlightRecorder(records=2)
+>>> recorder.record(WRITE, 'RX;')
+>>> recorder.record(READ, '=10>')
+>>> recorder.record(WRITE, (0x12, 0x82, 0x04, 0x00))
+>>> for timestamp, kind, data in recorder.entries():
+...     print kind, format_data(data)
+< =10>
+> 12 82 04 00
+>>> print recorder.format()
+-0.000... < =10>
+ 0.000000 > 12 82 04 00
+"""
+import itertools
+import logging
+import re
+import struct
+import time
+
+logger = logging.getLogger('PyCNiC')
+
+RECORDS = 256 # exchanges kept by a recorder
+RECORD_SIZE = 64 # in bytes, longer data is truncated
+
+# kinds of records
+WRITE = '>' # sent to the controller
+READ = '<' # received from the controller
+ERROR = '!' # a fault, with its message
+
+SLOT = struct.Struct('<dcH') # timestamp, kind, length of the data
+PRINTABLE = re.compile(r'^[\x20-\x7e]*$')
+
+
+class Lazy(object):
+    """Argument of a log message computed only if the message is emitted
+
+    >>> str(Lazy(lambda *args: '-'.join(args), 'a', 'b'))
+    'a-b'
+    """
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+    def __unicode__(self):
+        return unicode(self.function(*self.args))
+
+
+class Event(object):
+    """Structured message, formatted as "name key=value..." when emitted
+    """
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join([self.name] + ['%s=%s' % (key, self.fields[key])
+                                       for key in sorted(self.fields)])
+
+
+def event(name, **fields):
+    """Log a structured debug event, if debug logging is enabled
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(Event(name, fields),
+                     extra={'event': name, 'fields': fields})
+
+
+def format_data(data):
+    """Return recorded data as text if it is printable, in hex otherwise
+
+    >>> format_data('RX;'), format_data('\\x01\\xff')
+    ('RX;', '01 FF')
+    """
+    if PRINTABLE.match(data):
+        return data
+    return ' '.join(['%02X' % ord(c) for c in data])
+
+
+def log_dump(recorder, error):
+    """Default on_error hook: log the content of the recorder
+    """
+    logger.error(u'%s, last exchanges with the controller:\n%s',
+                 error, Lazy(recorder.format))
+
+
+class FlightRecorder(object):
+    """Ring buffer of the last `records` exchanges with a controller. The
+    data is a string or a tuple of bytes.
+    """
+
+    def __init__(self, records=RECORDS, record_size=RECORD_SIZE,
+                 on_error=log_dump):
+        self.records = records
+        self.record_size = record_size
+        self.on_error = on_error
+        self.buffer = bytearray(records * record_size)
+        self.count = 0
+        self._counter = itertools.count() # atomic, drivers are shared
+        self._size = record_size - SLOT.size
+
+    def record(self, kind, data):
+        """Record data written to or read from the controller
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        data = bytearray(data)
+        index = next(self._counter)
+        offset = index % self.records * self.record_size
+        SLOT.pack_into(self.buffer, offset, time.time(), kind, len(data))
+        start = offset + SLOT.size
+        self.buffer[start:start + min(len(data), self._size)] = \
+            data[:self._size]
+        self.count = max(self.count, index + 1)
+
+    def entries(self):
+        """Return the recorded (timestamp, kind, data), oldest first
+        """
+        entries = []
+        for index in xrange(max(self.count - self.records, 0), self.count):
+            offset = index % self.records * self.record_size
+            timestamp, kind, length = SLOT.unpack_from(self.buffer, offset)
+            start = offset + SLOT.size
+            entries.append((timestamp, kind, str(
+                self.buffer[start:start + min(length, self._size)])))
+        return entries
+
+    def format(self):
+        """Return the records as text, with their time relative to the last
+        one
+        """
+        entries = self.entries()
+        if not entries:
+            return ''
+        last = entries[-1][0]
+        return '\n'.join(['% f %s %s' % (timestamp - last, kind,
+                                          format_data(data))
+                          for timestamp, kind, data in entries])
+
+    def dump(self, output):
+        """Write the records to a file
+        """
+        output.write(self.format() + '\n')
+
+    def fault(self, error):
+        """Record the error and call the on_error hook
+        """
+        self.record(ERROR, unicode(error))
+        if self.on_error is not None:
+            self.on_error(self, error)